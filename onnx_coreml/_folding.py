@@ -0,0 +1,496 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import math
+import numpy as np
+
+from typing import Sequence, Callable, List, Optional, Text, Any, Dict, Tuple
+from onnx import TensorProto
+from ._graph import Node, tensor_dtype_to_np_dtype
+
+# NumPy implementations of ONNX ops, used to fold the nodes whose inputs are all
+# constant. Each function takes the node and its input values (None for omitted
+# optional inputs) and returns the value of its output, or the list of the values
+# of its outputs. It returns None when it can't fold the node, e.g. for attribute
+# values it doesn't support; the node is then left for the converter.
+
+# Folding a node is only worth it if it doesn't grow the constants shipped in the
+# model past this many bytes, e.g. by materializing a large Expand or ConstantOfShape
+_DEFAULT_MAX_FOLDED_BYTES = 1024 * 1024
+
+# ops broadcasting their inputs against each other, numpy style
+_BROADCASTING_OP_TYPES = {'Add', 'Sub', 'Mul', 'Div', 'Pow', 'Max', 'Min', 'Sum', 'Mean'}
+
+## Helper functions
+def _ints(value):  # type: (Any) -> List[int]
+    return [int(v) for v in np.asarray(value).reshape(-1)]
+
+def _attr_or_input(node, inputs, name, index, default=None):
+    # type: (Node, Sequence[Optional[np.ndarray]], Text, int, Any) -> Any
+    '''
+    Integer list parameter given as attribute in older opsets and as
+    input "index" in newer ones
+    '''
+    if name in node.attrs:
+        return list(node.attrs[name])
+    if len(inputs) > index and inputs[index] is not None:
+        return _ints(inputs[index])
+    return default
+
+def _normalize_axes(axes, rank):  # type: (Sequence[int], int) -> List[int]
+    return [axis + rank if axis < 0 else axis for axis in axes]
+
+def _legacy_broadcast(node, a, b):  # type: (Node, np.ndarray, np.ndarray) -> np.ndarray
+    '''
+    Aligns b on a for the "broadcast" and "axis" attributes of binary ops before opset 7
+    '''
+    if node.attrs.get('broadcast', 0) and 'axis' in node.attrs and b.ndim > 0:
+        axis = _normalize_axes([node.attrs['axis']], a.ndim)[0]
+        b = b.reshape(b.shape + (1,) * (a.ndim - axis - b.ndim))
+    return b
+
+def _broadcast_shape(a, b):  # type: (Sequence[int], Sequence[int]) -> Optional[Tuple[int, ...]]
+    '''Shape of the numpy broadcast of shapes a and b, None if they aren't compatible'''
+    rank = max(len(a), len(b))
+    a = (1,) * (rank - len(a)) + tuple(a)
+    b = (1,) * (rank - len(b)) + tuple(b)
+    shape = []
+    for x, y in zip(a, b):
+        if x != y and x != 1 and y != 1:
+            return None
+        shape.append(y if x == 1 else x)
+    return tuple(shape)
+
+def _div(a, b):  # type: (np.ndarray, np.ndarray) -> np.ndarray
+    if np.issubdtype(a.dtype, np.integer) and np.issubdtype(b.dtype, np.integer):
+        # integer division truncates towards zero
+        return np.trunc(np.true_divide(a, b)).astype(np.result_type(a, b))
+    return a / b
+
+def _erf(x):  # type: (np.ndarray) -> np.ndarray
+    return np.vectorize(math.erf, otypes=[np.float64])(x).astype(x.dtype)
+
+_UNARY_OPS = {
+    'Abs': np.abs,
+    'Acos': np.arccos,
+    'Acosh': np.arccosh,
+    'Asin': np.arcsin,
+    'Asinh': np.arcsinh,
+    'Atan': np.arctan,
+    'Atanh': np.arctanh,
+    'Ceil': np.ceil,
+    'Cos': np.cos,
+    'Cosh': np.cosh,
+    'Erf': _erf,
+    'Exp': np.exp,
+    'Floor': np.floor,
+    'Log': np.log,
+    'Neg': np.negative,
+    'Not': np.logical_not,
+    'Reciprocal': np.reciprocal,
+    'Relu': lambda x: np.maximum(x, 0),
+    'Round': np.round,
+    # not an ONNX op, see AlgebraicSimplifier
+    'Rsqrt': lambda x: 1. / np.sqrt(x),
+    'Sigmoid': lambda x: 1. / (1. + np.exp(-x)),
+    'Sign': np.sign,
+    'Sin': np.sin,
+    'Softplus': lambda x: np.log(np.exp(x) + 1.),
+    'Softsign': lambda x: x / (np.abs(x) + 1.),
+    'Sqrt': np.sqrt,
+    'Tanh': np.tanh,
+}  # type: Dict[Text, Callable[[Any], Any]]
+
+_BINARY_OPS = {
+    'Add': np.add,
+    'And': np.logical_and,
+    'Div': _div,
+    'Equal': np.equal,
+    'Greater': np.greater,
+    'Less': np.less,
+    'Mul': np.multiply,
+    'Or': np.logical_or,
+    'Pow': np.power,
+    'Sub': np.subtract,
+    'Xor': np.logical_xor,
+}  # type: Dict[Text, Callable[[Any, Any], Any]]
+
+_VARIADIC_OPS = {
+    'Max': np.maximum,
+    'Min': np.minimum,
+    'Sum': np.add,
+}  # type: Dict[Text, Callable[[Any, Any], Any]]
+
+_REDUCE_OPS = {
+    'ReduceL1': lambda x, axis, keepdims: np.sum(np.abs(x), axis=axis, keepdims=keepdims),
+    'ReduceL2': lambda x, axis, keepdims: np.sqrt(np.sum(np.square(x), axis=axis, keepdims=keepdims)),
+    'ReduceLogSum': lambda x, axis, keepdims: np.log(np.sum(x, axis=axis, keepdims=keepdims)),
+    'ReduceLogSumExp': lambda x, axis, keepdims: np.log(np.sum(np.exp(x), axis=axis, keepdims=keepdims)),
+    'ReduceMax': np.max,
+    'ReduceMean': np.mean,
+    'ReduceMin': np.min,
+    'ReduceProd': np.prod,
+    'ReduceSum': np.sum,
+    'ReduceSumSquare': lambda x, axis, keepdims: np.sum(np.square(x), axis=axis, keepdims=keepdims),
+}  # type: Dict[Text, Callable[..., Any]]
+
+
+def _fold_unary(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    return _UNARY_OPS[node.op_type](inputs[0])
+
+def _fold_binary(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    a, b = inputs[0], inputs[1]
+    return _BINARY_OPS[node.op_type](a, _legacy_broadcast(node, a, b))
+
+def _fold_variadic(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    output = inputs[0]
+    for x in inputs[1:]:
+        output = _VARIADIC_OPS[node.op_type](output, x)
+    return output
+
+def _fold_mean(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    output = inputs[0]
+    for x in inputs[1:]:
+        output = output + x
+    return output / len(inputs)
+
+def _fold_mod(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    if node.attrs.get('fmod', 0):
+        return np.fmod(inputs[0], inputs[1])
+    return np.mod(inputs[0], inputs[1])
+
+def _fold_where(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    return np.where(inputs[0], inputs[1], inputs[2])
+
+def _fold_clip(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    if 'min' in node.attrs or 'max' in node.attrs:
+        low, high = node.attrs.get('min', None), node.attrs.get('max', None)
+    else:
+        low = inputs[1] if len(inputs) > 1 else None
+        high = inputs[2] if len(inputs) > 2 else None
+    x = inputs[0]
+    if low is not None:
+        x = np.maximum(x, low)
+    if high is not None:
+        x = np.minimum(x, high)
+    return x
+
+def _fold_leaky_relu(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    return np.where(x >= 0, x, node.attrs.get('alpha', 0.01) * x)
+
+def _fold_elu(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    return np.where(x >= 0, x, node.attrs.get('alpha', 1.0) * (np.exp(x) - 1.)).astype(x.dtype)
+
+def _fold_selu(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    alpha = node.attrs.get('alpha', 1.67326319217681884765625)
+    gamma = node.attrs.get('gamma', 1.05070102214813232421875)
+    return (gamma * np.where(x > 0, x, alpha * (np.exp(x) - 1.))).astype(x.dtype)
+
+def _fold_hard_sigmoid(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    return np.clip(node.attrs.get('alpha', 0.2) * x + node.attrs.get('beta', 0.5), 0, 1).astype(x.dtype)
+
+def _fold_thresholded_relu(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    return np.where(x > node.attrs.get('alpha', 1.0), x, 0).astype(x.dtype)
+
+def _fold_prelu(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    return np.where(x < 0, inputs[1] * x, x).astype(x.dtype)
+
+def _fold_softmax(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    # the input is coerced into 2D at "axis", as in the opsets the converters support
+    x = inputs[0]
+    axis = _normalize_axes([node.attrs.get('axis', 1)], x.ndim)[0]
+    x_2d = x.reshape((int(np.prod(x.shape[:axis])), -1))
+    x_2d = x_2d - np.max(x_2d, axis=1, keepdims=True)
+    if node.op_type == 'LogSoftmax':
+        output = x_2d - np.log(np.sum(np.exp(x_2d), axis=1, keepdims=True))
+    else:
+        output = np.exp(x_2d) / np.sum(np.exp(x_2d), axis=1, keepdims=True)
+    return output.reshape(x.shape).astype(x.dtype)
+
+def _fold_cast(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    to = node.attrs['to']
+    if to == TensorProto.STRING:
+        return None
+    return inputs[0].astype(tensor_dtype_to_np_dtype(to))
+
+def _fold_identity(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    return inputs[0]
+
+def _fold_shape(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    return np.asarray(inputs[0].shape, dtype=np.int64)
+
+def _fold_size(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    return np.asarray(inputs[0].size, dtype=np.int64)
+
+def _fold_reshape(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    shape = _attr_or_input(node, inputs, 'shape', 1)
+    # a 0 in the shape copies the input dimension
+    shape = [x.shape[i] if s == 0 else s for i, s in enumerate(shape)]
+    return x.reshape(shape)
+
+def _fold_flatten(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    axis = _normalize_axes([node.attrs.get('axis', 1)], x.ndim)[0]
+    return x.reshape((int(np.prod(x.shape[:axis])), int(np.prod(x.shape[axis:]))))
+
+def _fold_transpose(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    return np.transpose(inputs[0], axes=node.attrs.get('perm', None))
+
+def _fold_concat(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    return np.concatenate(inputs, axis=node.attrs.get('axis', 0))
+
+def _fold_unsqueeze(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    axes = _attr_or_input(node, inputs, 'axes', 1)
+    for axis in sorted(_normalize_axes(axes, x.ndim + len(axes))):
+        x = np.expand_dims(x, axis=axis)
+    return x
+
+def _fold_squeeze(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    axes = _attr_or_input(node, inputs, 'axes', 1)
+    if axes is None:
+        return np.squeeze(x)
+    return np.squeeze(x, axis=tuple(_normalize_axes(axes, x.ndim)))
+
+def _fold_expand(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    return x * np.ones(_ints(inputs[1]), dtype=x.dtype)
+
+def _fold_tile(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    return np.tile(inputs[0], _ints(inputs[1]))
+
+def _fold_constant_of_shape(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    value = node.attrs.get('value', None)
+    value = np.zeros((1,), dtype=np.float32) if value is None else np.asarray(value)
+    return np.full(_ints(inputs[0]), value.reshape(-1)[0], dtype=value.dtype)
+
+def _fold_slice(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    starts = _attr_or_input(node, inputs, 'starts', 1)
+    ends = _attr_or_input(node, inputs, 'ends', 2)
+    axes = _attr_or_input(node, inputs, 'axes', 3, list(range(len(starts))))
+    steps = _attr_or_input(node, inputs, 'steps', 4, [1] * len(starts))
+    slices = [slice(None)] * x.ndim
+    for start, end, axis, step in zip(starts, ends, _normalize_axes(axes, x.ndim), steps):
+        slices[axis] = slice(start, end, step)
+    return x[tuple(slices)]
+
+def _fold_gather(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    indices = np.asarray(inputs[1]).astype(np.int64)
+    return np.take(inputs[0], indices, axis=node.attrs.get('axis', 0))
+
+def _fold_split(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    axis = node.attrs.get('axis', 0)
+    split = _attr_or_input(node, inputs, 'split', 1)
+    if split is None:
+        return np.split(x, len(node.outputs), axis=axis)
+    return np.split(x, np.cumsum(split)[:-1], axis=axis)
+
+def _fold_pad(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    pads = _attr_or_input(node, inputs, 'pads', 1)
+    if pads is None or len(pads) != 2 * x.ndim or any(p < 0 for p in pads):
+        return None
+    pad_width = list(zip(pads[:x.ndim], pads[x.ndim:]))
+    mode = node.attrs.get('mode', b'constant')
+    mode = mode.decode() if isinstance(mode, bytes) else mode
+    if mode == 'constant':
+        if 'value' in node.attrs:
+            value = node.attrs['value']
+        elif len(inputs) > 2 and inputs[2] is not None:
+            value = np.asarray(inputs[2]).reshape(-1)[0]
+        else:
+            value = 0
+        return np.pad(x, pad_width, mode='constant', constant_values=value)
+    if mode in ('reflect', 'edge'):
+        return np.pad(x, pad_width, mode=mode)
+    return None
+
+def _fold_depth_to_space(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    b, c, h, w = x.shape
+    bs = node.attrs['blocksize']
+    mode = node.attrs.get('mode', b'DCR')
+    mode = mode.decode() if isinstance(mode, bytes) else mode
+    if mode == 'DCR':
+        x = x.reshape((b, bs, bs, c // (bs * bs), h, w)).transpose((0, 3, 4, 1, 5, 2))
+    else:
+        x = x.reshape((b, c // (bs * bs), bs, bs, h, w)).transpose((0, 1, 4, 2, 5, 3))
+    return x.reshape((b, c // (bs * bs), h * bs, w * bs))
+
+def _fold_space_to_depth(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    b, c, h, w = x.shape
+    bs = node.attrs['blocksize']
+    x = x.reshape((b, c, h // bs, bs, w // bs, bs)).transpose((0, 3, 5, 1, 2, 4))
+    return x.reshape((b, c * bs * bs, h // bs, w // bs))
+
+def _fold_top_k(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    k = node.attrs['k'] if 'k' in node.attrs else _ints(inputs[1])[0]
+    axis = _normalize_axes([node.attrs.get('axis', -1)], x.ndim)[0]
+    # ties are broken by the lower index, hence the stable sort
+    if node.attrs.get('largest', 1):
+        order = np.argsort(-x, axis=axis, kind='mergesort')
+    else:
+        order = np.argsort(x, axis=axis, kind='mergesort')
+    indices = np.take(order, np.arange(k), axis=axis).astype(np.int64)
+    return [np.take_along_axis(x, indices, axis=axis), indices]
+
+def _fold_non_zero(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    return np.asarray(np.nonzero(inputs[0]), dtype=np.int64)
+
+def _fold_reduce(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    x = inputs[0]
+    axes = _attr_or_input(node, inputs, 'axes', 1)
+    axis = None if not axes else tuple(_normalize_axes(axes, x.ndim))
+    keepdims = bool(node.attrs.get('keepdims', 1))
+    return _REDUCE_OPS[node.op_type](x, axis=axis, keepdims=keepdims)
+
+def _fold_arg_reduce(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    if node.attrs.get('select_last_index', 0):
+        return None
+    x = inputs[0]
+    axis = _normalize_axes([node.attrs.get('axis', 0)], x.ndim)[0]
+    f = np.argmax if node.op_type == 'ArgMax' else np.argmin
+    output = f(x, axis=axis).astype(np.int64)
+    if node.attrs.get('keepdims', 1):
+        output = np.expand_dims(output, axis=axis)
+    return output
+
+def _fold_matmul(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    return np.matmul(inputs[0], inputs[1])
+
+def _fold_gemm(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Any
+    A, B = inputs[0], inputs[1]
+    A = np.transpose(A) if node.attrs.get('transA', False) else A
+    B = np.transpose(B) if node.attrs.get('transB', False) else B
+    output = node.attrs.get('alpha', 1.0) * np.dot(A, B)
+    if len(inputs) > 2 and inputs[2] is not None:
+        output = output + node.attrs.get('beta', 1.0) * inputs[2]
+    return output
+
+
+_CONSTANT_FOLDING_REGISTRY = {
+    'ArgMax': _fold_arg_reduce,
+    'ArgMin': _fold_arg_reduce,
+    'Cast': _fold_cast,
+    'Clip': _fold_clip,
+    'Concat': _fold_concat,
+    'ConstantOfShape': _fold_constant_of_shape,
+    'DepthToSpace': _fold_depth_to_space,
+    'Elu': _fold_elu,
+    'Expand': _fold_expand,
+    'Flatten': _fold_flatten,
+    'Gather': _fold_gather,
+    'Gemm': _fold_gemm,
+    'HardSigmoid': _fold_hard_sigmoid,
+    'Identity': _fold_identity,
+    'LeakyRelu': _fold_leaky_relu,
+    'LogSoftmax': _fold_softmax,
+    'MatMul': _fold_matmul,
+    'Mean': _fold_mean,
+    'Mod': _fold_mod,
+    'NonZero': _fold_non_zero,
+    'Pad': _fold_pad,
+    'PRelu': _fold_prelu,
+    'Reshape': _fold_reshape,
+    'Selu': _fold_selu,
+    'Shape': _fold_shape,
+    'Size': _fold_size,
+    'Slice': _fold_slice,
+    'Softmax': _fold_softmax,
+    'SpaceToDepth': _fold_space_to_depth,
+    'Split': _fold_split,
+    'Squeeze': _fold_squeeze,
+    'ThresholdedRelu': _fold_thresholded_relu,
+    'Tile': _fold_tile,
+    'TopK': _fold_top_k,
+    'Transpose': _fold_transpose,
+    'Unsqueeze': _fold_unsqueeze,
+    'Where': _fold_where,
+}  # type: Dict[Text, Callable[[Node, Sequence[Optional[np.ndarray]]], Any]]
+
+for op_type in _UNARY_OPS:
+    _CONSTANT_FOLDING_REGISTRY[op_type] = _fold_unary
+for op_type in _BINARY_OPS:
+    _CONSTANT_FOLDING_REGISTRY[op_type] = _fold_binary
+for op_type in _VARIADIC_OPS:
+    _CONSTANT_FOLDING_REGISTRY[op_type] = _fold_variadic
+for op_type in _REDUCE_OPS:
+    _CONSTANT_FOLDING_REGISTRY[op_type] = _fold_reduce
+
+
+def _fold_node(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Optional[List[np.ndarray]]
+    '''
+    Returns the values of the outputs of the node, computed from its input
+    values, or None if the node can't be folded.
+    '''
+    fold = _CONSTANT_FOLDING_REGISTRY.get(node.op_type)
+    if fold is None:
+        return None
+    try:
+        outputs = fold(node, inputs)
+    except (ValueError, TypeError, IndexError, KeyError, ZeroDivisionError):
+        # invalid or unsupported parameters: leave the node for the converter to report
+        return None
+    if outputs is None:
+        return None
+    if not isinstance(outputs, list):
+        outputs = [outputs]
+    return [np.asarray(output) for output in outputs]
+
+
+def _estimate_output_nbytes(node, inputs):  # type: (Node, Sequence[Optional[np.ndarray]]) -> Optional[int]
+    '''
+    Size of the output of the ops generating tensors much larger than their inputs,
+    computed without folding them. None for other ops.
+    '''
+    try:
+        if node.op_type == 'Expand':
+            shape = _broadcast_shape(inputs[0].shape, _ints(inputs[1]))
+            if shape is None:
+                return None
+            return int(np.prod(shape)) * inputs[0].itemsize
+        if node.op_type == 'Tile':
+            return inputs[0].nbytes * int(np.prod(_ints(inputs[1])))
+        if node.op_type == 'ConstantOfShape':
+            value = node.attrs.get('value', None)
+            itemsize = 4 if value is None else np.asarray(value).itemsize
+            return int(np.prod(_ints(inputs[0]))) * itemsize
+    except (ValueError, TypeError, IndexError):
+        return None
+    return None
+
+def _broadcast_source(node, inputs):
+    # type: (Node, Sequence[Optional[np.ndarray]]) -> Optional[Tuple[np.ndarray, Tuple[int, ...]]]
+    '''
+    For ops whose output is the broadcast of a small value, returns that value, with
+    the rank of the output, and the output shape. None for other ops.
+    '''
+    try:
+        if node.op_type == 'Expand':
+            x = inputs[0]
+            shape = _broadcast_shape(x.shape, _ints(inputs[1]))
+            if shape is None:
+                return None
+            return x.reshape((1,) * (len(shape) - x.ndim) + x.shape), shape
+        if node.op_type == 'ConstantOfShape':
+            shape = tuple(_ints(inputs[0]))
+            value = node.attrs.get('value', None)
+            value = np.zeros((1,), dtype=np.float32) if value is None else np.asarray(value)
+            return value.reshape(-1)[:1].reshape((1,) * len(shape)), shape
+    except (ValueError, TypeError, IndexError):
+        return None
+    return None
@@ -4,9 +4,23 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 from onnx import numpy_helper, ValueInfoProto, AttributeProto, GraphProto, NodeProto, TensorProto, TensorShapeProto
-from typing import Any, Text, Iterable, List, Dict, Sequence, Optional, Tuple, Union
+from typing import Any, Text, Iterable, Iterator, List, Dict, Sequence, Optional, Tuple, Union, Set
+from collections import OrderedDict
+import heapq
+import itertools
 from typing_extensions import Protocol
 import numpy as np
+import os
+import sys
+
+try:
+    from onnx.helper import tensor_dtype_to_np_dtype
+except ImportError:
+    from onnx.mapping import TENSOR_TYPE_TO_NP_TYPE
+
+    def tensor_dtype_to_np_dtype(tensor_dtype):  # type: (int) -> np.dtype
+        return TENSOR_TYPE_TO_NP_TYPE[tensor_dtype]
+from onnx.external_data_helper import ExternalDataInfo
 
 
 class Transformer(Protocol):
@@ -24,11 +38,106 @@ def _input_from_onnx_input(input):  # type: (ValueInfoProto) -> EdgeInfo
     return (name, type, shape)
 
 
+# tensor types whose raw_data can be viewed as a numpy array as is
+_RAW_DATA_TYPES = {
+    TensorProto.FLOAT, TensorProto.DOUBLE, TensorProto.FLOAT16,
+    TensorProto.INT8, TensorProto.INT16, TensorProto.INT32, TensorProto.INT64,
+    TensorProto.UINT8, TensorProto.UINT16, TensorProto.UINT32, TensorProto.UINT64,
+    TensorProto.BOOL,
+}
+
+
+class LazyTensor(object):
+    '''
+    Handle to the value of an ONNX TensorProto, decoded only when it is read.
+    Shape, dtype and size are available without decoding. Little-endian raw_data
+    is exposed as a read-only numpy view over the proto buffer, without copying it.
+    Tensors stored as external data are memory-mapped from their file, whose
+    location is relative to base_dir.
+    '''
+    __slots__ = ('proto', 'base_dir', '_value')
+
+    def __init__(self, proto, base_dir=None):  # type: (TensorProto, Optional[Text]) -> None
+        self.proto = proto
+        self.base_dir = base_dir
+        self._value = None  # type: Optional[np.ndarray[Any]]
+
+    @property
+    def shape(self):  # type: () -> Tuple[int, ...]
+        return tuple(self.proto.dims)
+
+    @property
+    def dtype(self):  # type: () -> np.dtype
+        return np.dtype(tensor_dtype_to_np_dtype(self.proto.data_type))
+
+    @property
+    def nbytes(self):  # type: () -> int
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    @property
+    def is_loaded(self):  # type: () -> bool
+        return self._value is not None
+
+    @property
+    def is_external(self):  # type: () -> bool
+        return self.proto.data_location == TensorProto.EXTERNAL
+
+    def _map_external_data(self):  # type: () -> np.ndarray[Any]
+        info = ExternalDataInfo(self.proto)
+        path = os.path.join(self.base_dir or '', info.location)
+        # external data is always stored little-endian
+        dtype = self.dtype.newbyteorder('<')
+        count = int(np.prod(self.shape))
+        if count == 0:
+            return np.zeros(self.shape, dtype=dtype)
+        data = np.memmap(path, dtype=dtype, mode='r', offset=info.offset or 0, shape=(count,))
+        return data.reshape(self.shape)
+
+    def numpy(self):  # type: () -> np.ndarray[Any]
+        if self._value is None:
+            proto = self.proto
+            if self.is_external:
+                self._value = self._map_external_data()
+            elif proto.data_type in _RAW_DATA_TYPES and len(proto.raw_data) > 0 \
+                    and sys.byteorder == 'little':
+                self._value = np.frombuffer(proto.raw_data, dtype=self.dtype).reshape(self.shape)
+            else:
+                self._value = numpy_helper.to_array(proto)
+        return self._value
+
+
+class TensorDict(Dict[Text, Any]):
+    '''
+    Dict whose LazyTensor values are decoded into numpy arrays when they are read.
+    get_lazy gives access to the stored value without decoding it.
+    '''
+    def __getitem__(self, key):  # type: (Text) -> Any
+        value = dict.__getitem__(self, key)
+        if isinstance(value, LazyTensor):
+            return value.numpy()
+        return value
+
+    def get(self, key, default=None):  # type: ignore
+        if key in self:
+            return self[key]
+        return default
+
+    def get_lazy(self, key, default=None):  # type: (Text, Any) -> Any
+        return dict.get(self, key, default)
+
+    def values(self):  # type: ignore
+        return [self[key] for key in self]
+
+    def items(self):  # type: ignore
+        return [(key, self[key]) for key in self]
+
+
 def _convertAttributeProto(onnx_arg):  # type: (AttributeProto) -> AttributeValue
     """
     Convert an ONNX AttributeProto into an appropriate Python object
     for the type.
-    NB: Tensor attribute gets returned as numpy array
+    NB: Tensor attribute gets returned as a LazyTensor, which Attributes
+    decodes into a numpy array when it is read
     """
     if onnx_arg.HasField('f'):
         return onnx_arg.f
@@ -37,7 +146,7 @@ def _convertAttributeProto(onnx_arg):  # type: (AttributeProto) -> AttributeValu
     elif onnx_arg.HasField('s'):
         return onnx_arg.s
     elif onnx_arg.HasField('t'):
-        return numpy_helper.to_array(onnx_arg.t)
+        return LazyTensor(onnx_arg.t)
     elif len(onnx_arg.floats):
         return list(onnx_arg.floats)
     elif len(onnx_arg.ints):
@@ -47,24 +156,173 @@ def _convertAttributeProto(onnx_arg):  # type: (AttributeProto) -> AttributeValu
     else:
         return None
 
-def _extract_node_names(graph): # type : (Graph) -> List[Text]
-    node_names = []
-    for node in graph.nodes:
-        node_names.append(node.name)
-    return node_names
+class ShapeDict(Dict[Text, Tuple[int, ...]]):
+    '''
+    Dict of edge shapes recording the edges whose shape was set or removed since
+    the last call to take_changes, for the PassManager to revisit their consumers.
+    '''
+    def __init__(self, *args, **kwargs):  # type: (*Any, **Any) -> None
+        super(ShapeDict, self).__init__(*args, **kwargs)
+        self.changed = set()  # type: Set[Text]
+
+    def __setitem__(self, key, value):  # type: (Text, Tuple[int, ...]) -> None
+        if dict.get(self, key) != value:
+            self.changed.add(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):  # type: (Text) -> None
+        self.changed.add(key)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):  # type: ignore
+        if key in self:
+            self.changed.add(key)
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):  # type: ignore
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):  # type: ignore
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def take_changes(self):  # type: () -> Set[Text]
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+def _topologically_sorted(nodes):  # type: (List[Node]) -> List[Node]
+    '''
+    Returns the nodes in topological order, as close as possible to their current
+    order. Nodes already sorted are returned as is, after a linear check.
+    '''
+    position = {node: i for i, node in enumerate(nodes)}
+    for node in nodes:
+        if any(position.get(parent, -1) > position[node] for parent in node.parents):
+            break
+    else:
+        return nodes
+
+    pending_parents = {node: len([p for p in node.parents if p in position]) for node in nodes}
+    ready = [(position[node], node.id) for node in nodes if pending_parents[node] == 0]
+    heapq.heapify(ready)
+    node_of = {node.id: node for node in nodes}
+    sorted_nodes = []  # type: List[Node]
+    while len(ready) > 0:
+        _, node_id = heapq.heappop(ready)
+        node = node_of[node_id]
+        sorted_nodes.append(node)
+        for child in node.children:
+            if child in pending_parents:
+                pending_parents[child] -= 1
+                if pending_parents[child] == 0:
+                    heapq.heappush(ready, (position[child], child.id))
+    if len(sorted_nodes) != len(nodes):
+        raise ValueError("Graph has a cycle")
+    return sorted_nodes
+
+class PassManager(object):
+    '''
+    Applies a list of transformers until none of them changes the graph anymore.
+
+    Instead of re-running every transformer over the whole graph until the
+    graph stops changing, a worklist of touched nodes is kept per transformer.
+    A transformer is only re-run when a node it cares about (as declared by its
+    optional "op_types" attribute) was touched since its last run, and the
+    touched nodes are exposed to it as "graph.worklist" so it can limit its
+    scan to them. Transformers whose "op_types" are all absent from the graph
+    are skipped entirely. Transformers without "op_types" are re-run whenever
+    anything in the graph changed.
+
+    The touched nodes are read from the change logs of the graph instead of
+    diffing the whole graph: the nodes added or explicitly touched (see
+    Graph.touch), the producers and consumers of the edges the mutation helpers
+    rewired, and the consumers of the edges whose entry in graph.shape_dict changed.
+
+    "iterations" records how many times each transformer actually ran.
+    '''
+    def __init__(self,
+                 transformers,  # type: Iterable[Transformer]
+                 ):
+        # type: (...) -> None
+        self.transformers = list(transformers)
+        self.iterations = OrderedDict()  # type: Dict[Text, int]
+        for transformer in self.transformers:
+            self.iterations[type(transformer).__name__] = 0
+
+    @staticmethod
+    def _take_changes(graph, shape_dict):  # type: (Graph, ShapeDict) -> Tuple[Set[Node], ShapeDict]
+        '''
+        Returns the nodes touched since the last call, and the shape dict to track
+        from now on. "shape_dict" is the one tracked until now.
+        '''
+        touched_edges, touched = graph.index.take_changes()
+        touched = set(node for node in touched if graph.index.has_node(node))
+        if graph.shape_dict is shape_dict:
+            shape_edges = shape_dict.take_changes()
+        else:
+            # the transformer gave the graph a new shape dict: diff it against the old one
+            new_shape_dict = graph.shape_dict
+            shape_edges = set(name for name in set(shape_dict).union(new_shape_dict)
+                              if dict.get(shape_dict, name) != new_shape_dict.get(name))
+            if not isinstance(new_shape_dict, ShapeDict):
+                new_shape_dict = ShapeDict(new_shape_dict)
+                graph.shape_dict = new_shape_dict
+            new_shape_dict.take_changes()
+            shape_dict = new_shape_dict
+        for edge in touched_edges:
+            producer = graph.producer(edge)
+            if producer is not None:
+                touched.add(producer)
+            touched.update(graph.consumers(edge))
+        for edge in shape_edges:
+            touched.update(graph.consumers(edge))
+        return touched, shape_dict
+
+    def __call__(self, graph):  # type: (Graph) -> Graph
+        if not isinstance(graph.shape_dict, ShapeDict):
+            graph.shape_dict = ShapeDict(graph.shape_dict)
+        shape_dict = graph.shape_dict
+        shape_dict.take_changes()
+        graph.index.take_changes()
+        # nodes touched since each transformer last ran; None until the first run, for all nodes
+        pending = [None for _ in self.transformers]  # type: List[Optional[Set[Node]]]
+        while any(worklist is None or len(worklist) > 0 for worklist in pending):
+            for i, transformer in enumerate(self.transformers):
+                worklist = pending[i]
+                if worklist is not None:
+                    # drop the nodes removed since they were touched
+                    worklist = set(node for node in worklist if graph.index.has_node(node))
+                    if len(worklist) == 0:
+                        pending[i] = worklist
+                        continue
+                pending[i] = set()
+                op_types = getattr(transformer, 'op_types', None)
+                if op_types is not None:
+                    if not any(op_type in graph.index.op_types for op_type in op_types):
+                        continue
+                    if worklist is not None and not any(node.op_type in op_types for node in worklist):
+                        continue
+
+                graph.worklist = worklist
+                new_graph = transformer(graph)
+                graph.worklist = None
+                graph = new_graph
+                self.iterations[type(transformer).__name__] += 1
+
+                touched, shape_dict = self._take_changes(graph, shape_dict)
+                if len(touched) > 0:
+                    for nodes in pending:
+                        if nodes is not None:
+                            nodes.update(touched)
+        return graph
 
 def _apply_graph_transformations(graph, transformers): # (Graph, Iterable[Transformer]) -> Graph
-    old_node_names = _extract_node_names(graph) # type: ignore
-    while True:
-        for transformer in transformers:
-            graph = transformer(graph)
-        new_node_names = _extract_node_names(graph) # type: ignore
-        if new_node_names == old_node_names:
-            break
-        old_node_names = new_node_names
-    return graph
+    return PassManager(transformers)(graph)
 
-class Attributes(Dict[Text, Any]):
+class Attributes(TensorDict):
     @staticmethod
     def from_onnx(args):  # type: (Iterable[AttributeProto]) -> Attributes
         d = Attributes()
@@ -75,7 +333,66 @@ class Attributes(Dict[Text, Any]):
         return d
 
 
+class NodeSet(object):
+    '''
+    Insertion-ordered set of nodes, used for the parents and children of a Node.
+    Membership tests, insertions and removals are O(1). It also supports the few
+    list operations the transformers rely on (append, extend, indexing).
+    '''
+    __slots__ = ('_nodes',)
+
+    def __init__(self, nodes=()):  # type: (Iterable[Node]) -> None
+        self._nodes = {}  # type: Dict[Node, None]
+        for node in nodes:
+            self._nodes[node] = None
+
+    def add(self, node):  # type: (Node) -> None
+        self._nodes[node] = None
+
+    append = add
+
+    def extend(self, nodes):  # type: (Iterable[Node]) -> None
+        for node in nodes:
+            self._nodes[node] = None
+
+    def remove(self, node):  # type: (Node) -> None
+        if node not in self._nodes:
+            raise ValueError('{} not in NodeSet'.format(node))
+        del self._nodes[node]
+
+    def discard(self, node):  # type: (Node) -> None
+        self._nodes.pop(node, None)
+
+    def __getitem__(self, i):  # type: (int) -> Node
+        if i == 0:
+            for node in self._nodes:
+                return node
+            raise IndexError('NodeSet index out of range')
+        return list(self._nodes)[i]
+
+    def __contains__(self, node):  # type: (object) -> bool
+        return node in self._nodes
+
+    def __iter__(self):  # type: () -> Iterator[Node]
+        return iter(list(self._nodes))
+
+    def __len__(self):  # type: () -> int
+        return len(self._nodes)
+
+    def __repr__(self):  # type: () -> str
+        return 'NodeSet({})'.format(list(self._nodes))
+
+
+_node_ids = itertools.count()
+
 class Node(object):
+    '''
+    A node of the graph. Nodes are identified by a unique integer id, names
+    are only used for naming the converted CoreML layers.
+    '''
+    __slots__ = ('id', 'name', 'op_type', 'attrs', 'inputs', 'outputs',
+                 'input_tensors', '_parents', '_children', 'metadata')
+
     def __init__(self,
                  name,  # type: Optional[Text]
                  op_type,  # type: Text
@@ -84,27 +401,42 @@ class Node(object):
                  outputs,  # type: List[Text]
                  ):
         # type: (...) -> None
+        self.id = next(_node_ids)
         self.name = name
         self.op_type = op_type
         self.attrs = attrs
         self.inputs = inputs
         self.outputs = outputs
-        self.input_tensors = {}  # type: Dict[Text, np._ArrayLike[Any]]
-        self.parents = []  # type: List[Node]
-        self.children = []  # type: List[Node]
+        self.input_tensors = TensorDict()  # type: Dict[Text, np._ArrayLike[Any]]
+        self._parents = NodeSet()
+        self._children = NodeSet()
         self.metadata = {}  # type: Dict[Any, Any]
 
+    @property
+    def parents(self):  # type: () -> NodeSet
+        return self._parents
+
+    @parents.setter
+    def parents(self, nodes):  # type: (Iterable[Node]) -> None
+        self._parents = NodeSet(nodes)
+
+    @property
+    def children(self):  # type: () -> NodeSet
+        return self._children
+
+    @children.setter
+    def children(self, nodes):  # type: (Iterable[Node]) -> None
+        self._children = NodeSet(nodes)
+
     def add_parent(self, parent_node):  # type: (Node) -> None
         assert parent_node not in self.parents
-        self.parents.append(parent_node)
-        if self not in parent_node.children:
-            parent_node.children.append(self)
+        self.parents.add(parent_node)
+        parent_node.children.add(self)
 
     def add_child(self, child_node):  # type: (Node) -> None
         assert child_node not in self.children
-        self.children.append(child_node)
-        if self not in child_node.parents:
-            child_node.parents.append(self)
+        self.children.add(child_node)
+        child_node.parents.add(self)
 
     def get_only_parent(self):  # type: () -> Node
         if len(self.parents) != 1:
@@ -112,6 +444,9 @@ class Node(object):
                              .format(self, len(self.parents)))
         return self.parents[0]
 
+    def __repr__(self):  # type: () -> str
+        return 'Node({}, {}, {})'.format(self.id, self.op_type, self.name)
+
     @staticmethod
     def from_onnx(node):  # type: (NodeProto) -> Node
         attrs = Attributes.from_onnx(node.attribute)
@@ -123,6 +458,114 @@ class Node(object):
         )
 
 
+class DefUseIndex(object):
+    '''
+    Def-use information of a graph: for every edge, the node producing it and the
+    nodes consuming it, plus the set of edge names in use and the nodes of each op type.
+    It is shared by all the graphs derived from one another with "create_graph" and
+    kept up to date by the Graph mutation helpers, so that lookups and updates are O(1).
+    '''
+    def __init__(self):  # type: () -> None
+        self.producers = {}  # type: Dict[Text, Node]
+        # edge name to the nodes consuming it, with the number of times each one uses it
+        self.consumers = {}  # type: Dict[Text, OrderedDict[Node, int]]
+        # every edge name ever used in the graph, so that freshly generated names never clash
+        self.edge_names = set()  # type: Set[Text]
+        # next suffix to try when generating a unique name from a given base name
+        self.name_counters = {}  # type: Dict[Text, int]
+        # op type to the nodes of that type
+        self.op_types = {}  # type: Dict[Text, OrderedDict[Node, None]]
+        # change log read by the PassManager: the edges whose producer or consumers
+        # changed, and the nodes added or touched, since the last call to take_changes
+        self.changed_edges = set()  # type: Set[Text]
+        self.changed_nodes = set()  # type: Set[Node]
+
+    def take_changes(self):  # type: () -> Tuple[Set[Text], Set[Node]]
+        changes = (self.changed_edges, self.changed_nodes)
+        self.changed_edges = set()
+        self.changed_nodes = set()
+        return changes
+
+    def has_node(self, node):  # type: (Node) -> bool
+        nodes = self.op_types.get(node.op_type)
+        return nodes is not None and node in nodes
+
+    def add_use(self, edge, node):  # type: (Text, Node) -> None
+        self.edge_names.add(edge)
+        self.changed_edges.add(edge)
+        uses = self.consumers.get(edge)
+        if uses is None:
+            uses = OrderedDict()
+            self.consumers[edge] = uses
+        uses[node] = uses.get(node, 0) + 1
+
+    def remove_use(self, edge, node):  # type: (Text, Node) -> None
+        uses = self.consumers.get(edge)
+        if uses is None or node not in uses:
+            return
+        self.changed_edges.add(edge)
+        if uses[node] > 1:
+            uses[node] -= 1
+        else:
+            del uses[node]
+            if len(uses) == 0:
+                del self.consumers[edge]
+
+    def set_producer(self, edge, node):  # type: (Text, Node) -> None
+        self.edge_names.add(edge)
+        self.changed_edges.add(edge)
+        self.producers[edge] = node
+
+    def remove_producer(self, edge, node):  # type: (Text, Node) -> None
+        if self.producers.get(edge) is node:
+            self.changed_edges.add(edge)
+            del self.producers[edge]
+
+    def add_node(self, node):  # type: (Node) -> None
+        for input_ in node.inputs:
+            self.add_use(input_, node)
+        for output_ in node.outputs:
+            self.set_producer(output_, node)
+        nodes = self.op_types.get(node.op_type)
+        if nodes is None:
+            nodes = OrderedDict()
+            self.op_types[node.op_type] = nodes
+        nodes[node] = None
+        self.changed_nodes.add(node)
+
+    def remove_node(self, node):  # type: (Node) -> None
+        for input_ in node.inputs:
+            self.remove_use(input_, node)
+        for output_ in node.outputs:
+            self.remove_producer(output_, node)
+        nodes = self.op_types.get(node.op_type)
+        if nodes is not None and node in nodes:
+            del nodes[node]
+            if len(nodes) == 0:
+                del self.op_types[node.op_type]
+        self.changed_nodes.discard(node)
+
+    def nodes_of_op_type(self, op_type):  # type: (Text) -> List[Node]
+        nodes = self.op_types.get(op_type)
+        if nodes is None:
+            return []
+        return list(nodes.keys())
+
+    @staticmethod
+    def build(nodes, inputs, outputs):  # type: (Iterable[Node], Iterable[EdgeInfo], Iterable[EdgeInfo]) -> DefUseIndex
+        index = DefUseIndex()
+        for input_ in inputs:
+            index.edge_names.add(input_[0])
+        for output_ in outputs:
+            index.edge_names.add(output_[0])
+        for node_ in nodes:
+            for output_ in node_.outputs:
+                if output_ in index.producers:
+                    raise ValueError("Data blob: %s, is generated by more than 1 op" %(output_))
+            index.add_node(node_)
+        return index
+
+
 class Graph(object):
     def __init__(self,
                  nodes,  # type: List[Node]
@@ -130,12 +573,13 @@ class Graph(object):
                  outputs,  # type: List[EdgeInfo]
                  shape_dict, # type: Dict[Text,Tuple[int,...]]
                  onnx_ir_version, # type: int
+                 index=None, # type: Optional[DefUseIndex]
                  ):
         # type: (...) -> None
         self.nodes = nodes
         self.inputs = inputs
         self.outputs = outputs
-        self.shape_dict = shape_dict  # data blob name to its shape
+        self.shape_dict = shape_dict  # data blob name to its shape, usually a ShapeDict
         self.constants_loaded = set() # set of constants present in graph as node
         self.onnx_ir_version = onnx_ir_version # ONNX IR Version for current graph
 
@@ -169,71 +613,299 @@ class Graph(object):
         '''
         self.onnx_coreml_shape_mapping = {} # type: Dict[Text, List[int,...]]
 
-        # data blob name to the list of op types it feeds into
-        self.blob_to_op_type = {} # type: Dict[Text, List[Text]]
-        # data blob name to the op_type that generates it
-        self.blob_from_op_type = {}  # type: Dict[Text, Text]
+        # ND conversion: rank 3 blob name to its rank 5 version, with axes [0, 3] expanded, that
+        # 1-D conv, pool and batchnorm layers work on. Runs of them pass the rank 5 version
+        # along, and the blobs are only squeezed back when another layer needs them: the names
+        # of the squeeze layers not added yet are in "pending_squeezes"
+        self.expanded_blobs = {} # type: Dict[Text, Text]
+        self.pending_squeezes = {} # type: Dict[Text, Text]
 
-        self.constant_layers_added = {} # type: Dict[Text, bool]
+        # data blob name to the list of op types it feeds into, built on first use
+        self._blob_to_op_type = None # type: Optional[Dict[Text, List[Text]]]
+        # data blob name to the op_type that generates it, built on first use
+        self._blob_from_op_type = None  # type: Optional[Dict[Text, Text]]
 
-        for node_ in nodes:
-            for input_ in node_.inputs:
-                if input_ in self.blob_to_op_type:
-                    self.blob_to_op_type[input_].append(node_.op_type)
-                else:
-                    self.blob_to_op_type[input_] = [node_.op_type]
-            for output_ in node_.outputs:
-                if output_ in self.blob_from_op_type:
-                    raise ValueError("Data blob: %s, is generated by more than 1 op" %(output_))
-                self.blob_from_op_type[output_] = node_.op_type
+        self.constant_layers_added = {} # type: Dict[Text, bool]
 
+        # nodes a transformer needs to (re)visit, set by the PassManager; None means all nodes
+        self.worklist = None # type: Optional[Set[Node]]
+        # node to its position in "nodes", built on first use
+        self._positions = None # type: Optional[Dict[Node, int]]
+
+        self.index = DefUseIndex.build(nodes, inputs, outputs) if index is None else index
+
+    @property
+    def blob_to_op_type(self):  # type: () -> Dict[Text, List[Text]]
+        if self._blob_to_op_type is None:
+            self._blob_to_op_type = {}
+            for input_, uses in self.index.consumers.items():
+                op_types = [] # type: List[Text]
+                for node_, count in uses.items():
+                    op_types.extend([node_.op_type] * count)
+                self._blob_to_op_type[input_] = op_types
+        return self._blob_to_op_type
+
+    @property
+    def blob_from_op_type(self):  # type: () -> Dict[Text, Text]
+        if self._blob_from_op_type is None:
+            self._blob_from_op_type = {
+                output_: node_.op_type for output_, node_ in self.index.producers.items()
+            }
+        return self._blob_from_op_type
 
     def create_graph(self, nodes=None, inputs=None, outputs=None, shape_dict=None, onnx_ir_version=None):
-        node = self.nodes if nodes is None else nodes
+        '''
+        Derives a new graph from this one. The def-use index is carried over: nodes
+        dropped from or added to the node list are unregistered or registered, all
+        other edge changes are expected to have gone through the mutation helpers.
+        '''
+        nodes = self.nodes if nodes is None else nodes
         inputs = self.inputs if inputs is None else inputs
         outputs = self.outputs if outputs is None else outputs
         shape_dict = self.shape_dict if shape_dict is None else shape_dict
         onnx_ir_version = self.onnx_ir_version if onnx_ir_version is None else onnx_ir_version
-        return Graph(nodes, inputs, outputs, shape_dict, onnx_ir_version)
+
+        index = self.index
+        if nodes is not self.nodes:
+            old_nodes = set(self.nodes)
+            new_nodes = set(nodes)
+            for node_ in self.nodes:
+                if node_ not in new_nodes:
+                    index.remove_node(node_)
+            for node_ in nodes:
+                if node_ not in old_nodes:
+                    index.add_node(node_)
+        for input_ in inputs:
+            index.edge_names.add(input_[0])
+        for output_ in outputs:
+            index.edge_names.add(output_[0])
+        return Graph(nodes, inputs, outputs, shape_dict, onnx_ir_version, index=index)
     
     def transformed(self, transformers):  # type: (Iterable[Transformer]) -> Graph
         graph = self
         return _apply_graph_transformations(graph, transformers) # type: ignore
 
 
+    def op_type_histogram(self):  # type: () -> Dict[Text, int]
+        return {op_type: len(nodes) for op_type, nodes in self.index.op_types.items()}
+
+    def position(self, node):  # type: (Node) -> int
+        '''Position of the node in the node list'''
+        if self._positions is None:
+            self._positions = {node_: i for i, node_ in enumerate(self.nodes)}
+        return self._positions[node]
+
+    def nodes_to_visit(self, op_types=None):  # type: (Optional[Iterable[Text]]) -> List[Node]
+        '''
+        Nodes, in graph order, that a transformer needs to look at: those in the
+        current worklist (all nodes if there is none) whose op type is in "op_types".
+        With a worklist, this only costs its size.
+        '''
+        worklist = self.worklist
+        if worklist is None:
+            if op_types is None:
+                return list(self.nodes)
+            op_types = set(op_types)
+            return [node for node in self.nodes if node.op_type in op_types]
+        nodes = [node for node in worklist if self.index.has_node(node)
+                 and (op_types is None or node.op_type in op_types)]
+        return sorted(nodes, key=self.position)
+
+    def touch(self, nodes):  # type: (Iterable[Node]) -> None
+        '''
+        Records that the nodes were modified in place (e.g. their attributes or input
+        tensors) without their edges changing, so that the PassManager revisits them
+        '''
+        self.index.changed_nodes.update(nodes)
+
+    def producer(self, edge):  # type: (Text) -> Optional[Node]
+        '''Node generating the edge, None for graph inputs and initializers'''
+        return self.index.producers.get(edge)
+
+    def consumers(self, edge):  # type: (Text) -> List[Node]
+        '''Nodes using the edge as an input'''
+        uses = self.index.consumers.get(edge)
+        if uses is None:
+            return []
+        return list(uses.keys())
+
+    def is_used(self, edge):  # type: (Text) -> bool
+        return edge in self.index.consumers
+
+    def set_input(self, node, i, edge):  # type: (Node, int, Text) -> None
+        '''Replace the i-th input of the node, keeping the def-use index up to date'''
+        self.index.remove_use(node.inputs[i], node)
+        node.inputs[i] = edge
+        self.index.add_use(edge, node)
+
+    def set_inputs(self, node, inputs):  # type: (Node, List[Text]) -> None
+        for input_ in node.inputs:
+            self.index.remove_use(input_, node)
+        node.inputs = list(inputs)
+        for input_ in node.inputs:
+            self.index.add_use(input_, node)
+
+    def set_outputs(self, node, outputs):  # type: (Node, List[Text]) -> None
+        for output_ in node.outputs:
+            self.index.remove_producer(output_, node)
+        node.outputs = list(outputs)
+        for output_ in node.outputs:
+            self.index.set_producer(output_, node)
+
+    def _link(self, node):  # type: (Node) -> None
+        '''Adds the parent and child links of the node implied by the def-use index'''
+        for input_ in node.inputs:
+            parent = self.index.producers.get(input_)
+            if parent is not None and parent is not node:
+                node.parents.add(parent)
+                parent.children.add(node)
+        for output_ in node.outputs:
+            for child in self.consumers(output_):
+                if child is not node:
+                    node.children.add(child)
+                    child.parents.add(node)
+
+    def rewire_subgraph(self, old_nodes, new_nodes):  # type: (Sequence[Node], Sequence[Node]) -> None
+        '''
+        Makes "new_nodes" (which may reuse some of "old_nodes") take the place of
+        "old_nodes" in the def-use index and in the parent/child links of the graph.
+        This only costs the size of the subgraphs; the node list is left untouched,
+        see apply_replacements.
+        '''
+        for node in old_nodes:
+            self.index.remove_node(node)
+            for parent in node.parents:
+                parent.children.discard(node)
+            for child in node.children:
+                child.parents.discard(node)
+            node.parents = []
+            node.children = []
+        for node in new_nodes:
+            self.index.add_node(node)
+        for node in new_nodes:
+            self._link(node)
+
+    def apply_replacements(self, replacements):
+        # type: (Iterable[Tuple[Sequence[Node], Sequence[Node]]]) -> Graph
+        '''
+        Returns the graph whose node list has each (old_nodes, new_nodes) replacement
+        applied, in a single pass over the nodes. New nodes take the position of the
+        first of the old nodes they replace, unless that breaks the topological order
+        (e.g. for a multi-branch subgraph), which is then restored. The replacements
+        must already have been rewired, see rewire_subgraph.
+        '''
+        replacement_of = {}  # type: Dict[Node, Sequence[Node]]
+        for old_nodes, new_nodes in replacements:
+            for node in old_nodes:
+                replacement_of[node] = new_nodes
+        if len(replacement_of) == 0:
+            return self
+        transformed_nodes = []
+        emitted = set()  # type: Set[Node]
+        for node in self.nodes:
+            new_nodes = replacement_of.get(node)
+            if new_nodes is None:
+                new_nodes = [node]
+            for new_node in new_nodes:
+                if new_node not in emitted:
+                    emitted.add(new_node)
+                    transformed_nodes.append(new_node)
+        transformed_nodes = _topologically_sorted(transformed_nodes)
+        return Graph(transformed_nodes, self.inputs, self.outputs, self.shape_dict,
+                     self.onnx_ir_version, index=self.index)
+
+    def replace_subgraphs(self, replacements):
+        # type: (Iterable[Tuple[Sequence[Node], Sequence[Node]]]) -> Graph
+        '''Replaces each subgraph of old nodes with the corresponding new nodes'''
+        replacements = list(replacements)
+        for old_nodes, new_nodes in replacements:
+            self.rewire_subgraph(old_nodes, new_nodes)
+        return self.apply_replacements(replacements)
+
+    def replace_subgraph(self, old_nodes, new_nodes):  # type: (Sequence[Node], Sequence[Node]) -> Graph
+        return self.replace_subgraphs([(old_nodes, new_nodes)])
+
+    def remove_nodes(self, nodes):  # type: (Iterable[Node]) -> Graph
+        '''
+        Removes the nodes from the graph in one linear pass. Their consumers are not
+        rewired: they are expected to have been given the values of the removed
+        outputs as input tensors, or to be removed as well.
+        '''
+        return self.replace_subgraphs([([node], []) for node in nodes])
+
+    def bypass_nodes(self, nodes):  # type: (Iterable[Node]) -> Graph
+        '''
+        Removes nodes whose first output is a pass-through of their first input
+        (e.g. Cast, zero Pad). The consumers of that output are rewired to the input,
+        and get its value as input tensor if it is a constant.
+        '''
+        nodes = list(nodes)
+        for node in nodes:
+            input_ = node.inputs[0]
+            output_ = node.outputs[0]
+            for child in self.consumers(output_):
+                for i, child_input in enumerate(child.inputs):
+                    if child_input == output_:
+                        self.set_input(child, i, input_)
+                if input_ in node.input_tensors:
+                    child.input_tensors[input_] = node.input_tensors.get_lazy(input_)
+            self.rewire_subgraph([node], [])
+            producer = self.producer(input_)
+            if producer is not None:
+                self._link(producer)
+        return self.apply_replacements([([node], []) for node in nodes])
+
     def has_edge_name(self, name):  # type: (Text) -> bool
         '''
         Check if name is already used for graph inputs/outputs or for nodes
         inputs/outputs
         '''
-        names = set()
-        for input in self.inputs:
-            names.add(input[0])
-        for output in self.outputs:
-            names.add(output[0])
-        for node in self.nodes:
-            names.update(node.inputs)
-            names.update(node.outputs)
-        return name in names
+        return name in self.index.edge_names
 
     def get_unique_edge_name(self, name):  # type: (Text) -> Text
+        '''
+        Returns a name derived from "name" that is not used in the graph yet
+        and reserves it
+        '''
         n_ = name
-        i = 0
+        i = self.index.name_counters.get(name, 0)
         while self.has_edge_name(n_):
             n_ = "{}_{}".format(name, i)
             i += 1
+        self.index.name_counters[name] = i
+        self.index.edge_names.add(n_)
         return n_
 
     @staticmethod
-    def from_onnx(graph, onnx_ir_version):  # type: (GraphProto) -> Graph
+    def from_onnx(graph, onnx_ir_version, base_dir=None):  # type: (GraphProto, int, Optional[Text]) -> Graph
+        # initializers are only decoded when a transformer or converter reads them,
+        # and those stored as external data are looked up relative to base_dir
         input_tensors = {
-            t.name: numpy_helper.to_array(t) for t in graph.initializer
+            t.name: LazyTensor(t, base_dir) for t in graph.initializer
         }
         nodes_ = []
         nodes_by_input = {}  # type: Dict[Text, List[Node]]
         nodes_by_output = {}
+        node_names = set()  # type: Set[Text]
+        # names given in the model, that renamed nodes must not take either
+        model_names = set(node.name for node in graph.node)
+        # next suffix to try when renaming a node with a given name
+        name_counters = {}  # type: Dict[Text, int]
         for node in graph.node:
             node_ = Node.from_onnx(node)
+            for attr in node_.attrs:
+                value = node_.attrs.get_lazy(attr)
+                if isinstance(value, LazyTensor):
+                    value.base_dir = base_dir
+            # names synthesized from the outputs, or duplicated in the model, can collide
+            if node_.name in node_names:
+                name = node_.name
+                i = name_counters.get(name, 1)
+                while "{}_{}".format(name, i) in node_names or "{}_{}".format(name, i) in model_names:
+                    i += 1
+                name_counters[name] = i + 1
+                node_.name = "{}_{}".format(name, i)
+            node_names.add(node_.name)
             for input_ in node_.inputs:
                 if input_ in input_tensors:
                     node_.input_tensors[input_] = input_tensors[input_]
@@ -266,7 +938,7 @@ class Graph(object):
                     node_.children.extend(nodes_by_input[output_])
 
         # Dictionary to hold the "value_info" field from ONNX graph
-        shape_dict = {} # type: Dict[Text,Tuple[int,...]]
+        shape_dict = ShapeDict() # type: Dict[Text,Tuple[int,...]]
 
         def extract_value_info(shape_dict, # type: Dict[Text,Tuple[int,...]]
                                value_info, # type: ValueInfoProto[...]
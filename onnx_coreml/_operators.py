@@ -1588,6 +1588,15 @@ def _convert_reciprocal(builder, node, graph, err):  # type: (NeuralNetworkBuild
     )
     _update_shape_mapping_unchanged(node, graph, err)
 
+def _convert_rsqrt(builder, node, graph, err):  # type: (NeuralNetworkBuilder, Node, Graph, ErrorHandling) -> None
+    builder.add_unary(
+        name=node.name,
+        input_name=node.inputs[0],
+        output_name=node.outputs[0],
+        mode='rsqrt'
+    )
+    _update_shape_mapping_unchanged(node, graph, err)
+
 def _convert_reorganize_data(builder, node, graph, err):  # type: (NeuralNetworkBuilder, Node, Graph, ErrorHandling) -> None
     mode = 'SPACE_TO_DEPTH'
     if node.op_type == 'DepthToSpace':
@@ -1931,6 +1940,7 @@ _ONNX_NODE_REGISTRY = {
     "ReduceSumSquare": _convert_reduce,
     "Relu": _convert_relu,
     "Reshape": _convert_reshape,
+    "Rsqrt": _convert_rsqrt,
     "Selu": _convert_selu,
     "Sigmoid": _convert_sigmoid,
     "Sign": _convert_sign,
@@ -18,7 +18,7 @@ from ._operators import _convert_abs, _convert_relu, _convert_sqrt, _convert_exp
                         _convert_prelu, _convert_upsample, _convert_softsign, _convert_softplus, \
                         _convert_log, _convert_neg, _convert_reciprocal, _convert_hardsigmoid, \
                         _convert_reorganize_data, _add_pool, _get_pool_params, _add_conv, _get_conv_params, \
-                        _convert_thresholdedrelu, _convert_leaky_relu, _convert_lrn
+                        _convert_thresholdedrelu, _convert_leaky_relu, _convert_lrn, _convert_rsqrt
 
 from ._operators import _convert_pad as _convert_pad_5d
 
@@ -37,11 +37,94 @@ def load_input_constants(builder, node, graph, err):
             )
             graph.constants_loaded.add(node.inputs[i])
 
+# axes rank 3 inputs of 1-D conv, pool and batchnorm layers are expanded along
+_EXPANSION_AXES = [0, 3]
+
+# ops converted on the expanded version of their first input when it has rank 3
+_EXPANDED_LAYOUT_OP_TYPES = set(['AveragePool', 'BatchNormalization', 'Conv', 'ConvTranspose', 'GlobalAveragePool',
+                                 'GlobalMaxPool', 'InstanceNormalization', 'MaxPool'])
+
+# elementwise activations, converted on the expanded version of their input if it isn't squeezed yet
+_LAYOUT_AGNOSTIC_OP_TYPES = set(['Elu', 'HardSigmoid', 'LeakyRelu', 'Relu', 'Selu', 'Sigmoid', 'Softplus',
+                                 'Softsign', 'Tanh', 'ThresholdedRelu'])
+
+def _get_input_rank(builder, node, graph):
+    # the rank of a blob whose squeeze layer isn't added yet is unknown to the builder
+    if node.inputs[0] in graph.expanded_blobs:
+        return 3
+    # shapes propagated before conversion, see ShapePropagation
+    if node.inputs[0] in graph.shape_dict:
+        return len(graph.shape_dict[node.inputs[0]])
+    return builder._get_rank(node.inputs[0])
+
+def _get_static_shape(graph, name):
+    '''Shape of the blob if all its dimensions are known, None otherwise'''
+    shape = graph.shape_dict.get(name, None)
+    if shape is None or not all(d > 0 for d in shape):
+        return None
+    return list(shape)
+
+def _expanded_input(builder, node, graph):
+    '''
+    Name of the expanded version of the first input of the node,
+    adding the expand dims layer unless an earlier layer already produced it
+    '''
+    input_name = node.inputs[0]
+    if input_name not in graph.expanded_blobs:
+        expanded_input_name = node.name + '_' + input_name + '_expanded'
+        builder.add_expand_dims(
+            name=node.name+'_ip_expand',
+            input_name=input_name,
+            output_name=expanded_input_name,
+            axes=_EXPANSION_AXES
+        )
+        graph.expanded_blobs[input_name] = expanded_input_name
+    return graph.expanded_blobs[input_name]
+
+def _add_squeeze_back(builder, graph, squeeze_name, output_name):
+    builder.add_squeeze(
+        name=squeeze_name,
+        input_name=graph.expanded_blobs[output_name],
+        output_name=output_name,
+        axes=_EXPANSION_AXES
+    )
+
+def _set_expanded_output(builder, node, graph, output_name, expanded_output_name, squeeze_name):
+    '''
+    Records the expanded version of a rank 3 output. It is squeezed back right away if it is
+    a graph output, and otherwise once a layer that can't use the expanded version needs it
+    '''
+    graph.expanded_blobs[output_name] = expanded_output_name
+    if output_name in [str(output_[0]) for output_ in graph.outputs]:
+        _add_squeeze_back(builder, graph, squeeze_name, output_name)
+    else:
+        graph.pending_squeezes[output_name] = squeeze_name
+
+def _squeeze_expanded_inputs(builder, node, graph, converter_fn):
+    '''Adds the squeeze layers of the inputs the node's converter reads as rank 3 blobs'''
+    for i, input_ in enumerate(node.inputs):
+        if input_ not in graph.pending_squeezes:
+            continue
+        if i == 0 and node.op_type in _EXPANDED_LAYOUT_OP_TYPES and \
+                converter_fn is _ONNX_NODE_REGISTRY_ND.get(node.op_type):
+            continue
+        _add_squeeze_back(builder, graph, graph.pending_squeezes.pop(input_), input_)
+
+def _convert_expanded_activation(builder, node, graph, err, converter_fn):
+    '''Converts an activation on the expanded version of its input, keeping the run expanded'''
+    input_name, output_name = node.inputs[0], node.outputs[0]
+    node.inputs[0] = graph.expanded_blobs[input_name]
+    node.outputs[0] = node.name + '_' + output_name + '_expanded'
+    converter_fn(builder, node, graph, err)
+    expanded_output_name = node.outputs[0]
+    node.inputs[0], node.outputs[0] = input_name, output_name
+    _set_expanded_output(builder, node, graph, output_name, expanded_output_name, node.name + '_squeeze_out')
+
 def _add_conv_like_op(add_func, get_params_func, params_dict,
                       builder, node, graph, err):
 
     # To do: Need to avoid dependence on rank for conversion since rank is not always available.
-    rank = builder._get_rank(node.inputs[0])
+    rank = _get_input_rank(builder, node, graph)
 
     if rank < 0 and node.op_type == "Conv" and "w_shape" in params_dict:
         rank = len(params_dict["w_shape"])
@@ -50,28 +133,15 @@ def _add_conv_like_op(add_func, get_params_func, params_dict,
         get_params_func(builder, node, graph, err, params_dict)
         add_func(node.inputs, node.outputs, params_dict=params_dict, builder=builder, node=node, graph=graph, err=err)
     elif rank == 3:
-        axes = [0, 3]
         # Make 5d tensor
-        expanded_node_output = node.name + '_' + node.inputs[0] + '_expanded'
-        builder.add_expand_dims(
-            name=node.name+'_ip_expand',
-            input_name=node.inputs[0],
-            output_name=expanded_node_output,
-            axes=axes
-        )
-        node.inputs[0] = expanded_node_output
+        node.inputs[0] = _expanded_input(builder, node, graph)
         output_name = node.outputs[0]
         node.outputs[0] = node.name + '_' + output_name + '_expanded'
         # Add conversion op
         get_params_func(builder, node, graph, err, params_dict, axis='width')
         add_func(node.inputs, node.outputs, params_dict=params_dict, builder=builder, node=node, graph=graph, err=err)
-        # Make 3d tensor back
-        builder.add_squeeze(
-            name=node.name+'_ip_squeeze_out',
-            input_name=node.outputs[0],
-            output_name=output_name,
-            axes=axes
-        )
+        # Make 3d tensor back, when needed
+        _set_expanded_output(builder, node, graph, output_name, node.outputs[0], node.name+'_ip_squeeze_out')
     else:
         return err.unsupported_op_configuration(builder, node, graph, "provided number axes {} not supported".format(rank))
 
@@ -125,21 +195,14 @@ def add_broadcastable_op_chain(builder, node, err, add_op_function):
             output_name=out_name
         )
 
-def add_bn_with_expansion(builder, node, err, node_name, input_name, output_name, channels, scale, bias, mean=None, var=None,
-                          epsilon=None, compute_mean_var=False, instance_normalization=False, axes_for_expansion=[]):
-    real_input_name = input_name
+def add_bn_with_expansion(builder, node, graph, err, node_name, input_name, output_name, channels, scale, bias, mean=None, var=None,
+                          epsilon=None, compute_mean_var=False, instance_normalization=False, expand=False):
     real_output_name = output_name
 
     # Expand input if needed
-    if len(axes_for_expansion) != 0:
-        input_name=node_name + '_' + input_name + '_expanded'
-        output_name=output_name+'_expanded'
-        builder.add_expand_dims(
-            name=node_name + '_expand',
-            input_name=real_input_name,
-            output_name=input_name,
-            axes=axes_for_expansion
-        )
+    if expand:
+        input_name = _expanded_input(builder, node, graph)
+        output_name = output_name + '_expanded'
 
     builder.add_batchnorm(
         name=node.name,
@@ -156,13 +219,8 @@ def add_bn_with_expansion(builder, node, err, node_name, input_name, output_name
     )
 
     # Squeeze output if needed
-    if len(axes_for_expansion) != 0:
-        builder.add_squeeze(
-            name=node_name+'_squeeze',
-            input_name=output_name,
-            output_name=real_output_name,
-            axes=axes_for_expansion
-        )
+    if expand:
+        _set_expanded_output(builder, node, graph, real_output_name, output_name, node_name + '_squeeze')
 # Helper function to convert RandomNormal, RandomUniform and it's variants
 def add_random(builder, node, graph, err, add_op_function):
     # Ignoring attribute `dtype` as CoreML internally represents tensors into 'Float'
@@ -332,17 +390,17 @@ def _convert_bn(builder, node, graph, err):
     var = node.input_tensors[node.inputs[4]] if node.inputs[4] in node.input_tensors else \
             np.ones(shape=channels, dtype=np.float32)
 
-    rank = builder._get_rank(node.inputs[0])
+    rank = _get_input_rank(builder, node, graph)
     # ONNX converts B x C tensor into B x C x 1 hence
     # Rank 2 BN is mapped to Rank 3 BN
     if rank == 3:
         # 1D Batch Norm
-        add_bn_with_expansion(builder, node, err, node.name, node.inputs[0], node.outputs[0], channels[0],
-                              scale, bias, mean, var, epsilon, axes_for_expansion=[0, 3])
+        add_bn_with_expansion(builder, node, graph, err, node.name, node.inputs[0], node.outputs[0], channels[0],
+                              scale, bias, mean, var, epsilon, expand=True)
     elif rank == 4:
         # 2D Batch Norm
-        add_bn_with_expansion(builder, node, err, node.name, node.inputs[0], node.outputs[0], channels[0],
-                              scale, bias, mean, var, epsilon, axes_for_expansion=[])
+        add_bn_with_expansion(builder, node, graph, err, node.name, node.inputs[0], node.outputs[0], channels[0],
+                              scale, bias, mean, var, epsilon, expand=False)
     else:
         # Unsupported 1D, 3D and above
         err.unsupported_op_configuration(builder, node, graph, "provided number axes {} not supported".format(rank))
@@ -462,6 +520,13 @@ def _convert_constant_of_shape(builder, node, graph, err):
             output_shape=output_shape,
             value=value[0]
         )
+    elif _get_static_shape(graph, node.outputs[0]) is not None:
+        builder.add_fill_static(
+            name=node.name,
+            output_name=node.outputs[0],
+            output_shape=_get_static_shape(graph, node.outputs[0]),
+            value=value[0]
+        )
     else:
         builder.add_fill_dynamic(
             name=node.name,
@@ -601,6 +666,13 @@ def _convert_expand(builder, node, graph, err):
             output_name=node.outputs[0],
             output_shape=output_shape
         )
+    elif _get_static_shape(graph, node.outputs[0]) is not None:
+        builder.add_broadcast_to_static(
+            name=node.name,
+            input_name=node.inputs[0],
+            output_name=node.outputs[0],
+            output_shape=_get_static_shape(graph, node.outputs[0])
+        )
     else:
         builder.add_broadcast_to_dynamic(
             name=node.name,
@@ -669,6 +741,37 @@ def _convert_gather(builder, node, graph, err):
         axis=axis
     )
 
+def _convert_gelu(builder, node, graph, err):
+    '''
+    GELU, x * 0.5 * (1 + erf(x / sqrt(2))), with CoreML Linear Activation, Erf and
+    Multiply Broadcastable Layers (there is no GELU layer before iOS 14):
+    https://github.com/apple/coremltools/blob/655b3be5cc0d42c3c4fa49f0f0e4a93a26b3e492/mlmodel/format/NeuralNetwork.proto#L5140
+    '''
+    builder.add_activation(
+        name=node.name + '_scale',
+        non_linearity='LINEAR',
+        input_name=node.inputs[0],
+        output_name=node.outputs[0] + '_scale',
+        params=[1.0 / np.sqrt(2.0), 0.0]
+    )
+    builder.add_erf(
+        name=node.name + '_erf',
+        input_name=node.outputs[0] + '_scale',
+        output_name=node.outputs[0] + '_erf'
+    )
+    builder.add_activation(
+        name=node.name + '_shift',
+        non_linearity='LINEAR',
+        input_name=node.outputs[0] + '_erf',
+        output_name=node.outputs[0] + '_shift',
+        params=[0.5, 0.5]
+    )
+    builder.add_multiply_broadcastable(
+        name=node.name,
+        input_names=[node.inputs[0], node.outputs[0] + '_shift'],
+        output_name=node.outputs[0]
+    )
+
 def _convert_gemm(builder, node, graph, err):
     '''
     convert to CoreML Tranpose (Optional) and Inner Product Layer:
@@ -706,15 +809,15 @@ def _convert_gemm(builder, node, graph, err):
         A = A + '_alphaA'
 
     B = node.inputs[1]
-    C = node.inputs[2]
-    if B in node.input_tensors and C in node.input_tensors:
+    C = node.inputs[2] if len(node.inputs) > 2 and node.inputs[2] != '' else None
+    if B in node.input_tensors and (C is None or C in node.input_tensors):
         B = node.input_tensors[B]
-        C = node.input_tensors[C]
+        if C is not None:
+            C = beta * node.input_tensors[C].flatten()
 
         if transB:
             B = B.transpose()
         
-        C = C.flatten()
         builder.add_batched_mat_mul(
             name=node.name,
             input_names=[A],
@@ -728,6 +831,16 @@ def _convert_gemm(builder, node, graph, err):
     else:
         ## TODO: Test coverage when B and C are non-constant
         ## Should C be of Rank-1? or it's okay to keep it that way?
+        if C is None:
+            builder.add_batched_mat_mul(
+                name=node.name,
+                input_names=[A, B],
+                output_name=node.outputs[0],
+                transpose_a=transA,
+                transpose_b=transB,
+            )
+            return
+
         if beta != 1.0:
             builder.add_load_constant_nd(
                 name=node.name + '_load_beta',
@@ -873,7 +986,7 @@ def _convert_gru(builder, node, graph, err):  # type: (NeuralNetworkBuilder, Nod
 
     # CoreML GRU expects 5-d tensor
     # Expand dimensions of input to 5-d for compatibility
-    input_rank = builder._get_rank(node.inputs[0])
+    input_rank = _get_input_rank(builder, node, graph)
     if input_rank == -1:
         return err.unsupported_op_configuration(builder, node, graph, "Rank unknown for input")
     
@@ -966,23 +1079,47 @@ def _convert_instancenorm(builder, node, graph, err):  # type: (NeuralNetworkBui
     scale = node.input_tensors[node.inputs[1]]
     bias = node.input_tensors[node.inputs[2]]
 
-    rank = builder._get_rank(node.inputs[0])
+    rank = _get_input_rank(builder, node, graph)
     # ONNX converts B x C tensor into B x C x 1 hence
     # Rank 2 BN is mapped to Rank 3 BN
     if rank == 3:
         # 1D Batch Norm
-        add_bn_with_expansion(builder, node, err, node.name, node.inputs[0], node.outputs[0], scale.shape[0],
+        add_bn_with_expansion(builder, node, graph, err, node.name, node.inputs[0], node.outputs[0], scale.shape[0],
                               scale, bias, epsilon=epsilon, compute_mean_var=True,
-                              instance_normalization=True, axes_for_expansion=[0, 3])
+                              instance_normalization=True, expand=True)
     elif rank == 4:
         # 2D Batch Norm
-        add_bn_with_expansion(builder, node, err, node.name, node.inputs[0], node.outputs[0], scale.shape[0],
+        add_bn_with_expansion(builder, node, graph, err, node.name, node.inputs[0], node.outputs[0], scale.shape[0],
                               scale, bias, epsilon=epsilon, compute_mean_var=True,
-                              instance_normalization=True, axes_for_expansion=[])
+                              instance_normalization=True, expand=False)
     else:
         # Unsupported 1D, 3D and above
         err.unsupported_op_configuration(builder, node, graph, "provided number axes {} not supported".format(rank))
 
+def _convert_layer_normalization(builder, node, graph, err):
+    '''
+    convert to CoreML Layer Normalization Layer:
+    https://github.com/apple/coremltools/blob/655b3be5cc0d42c3c4fa49f0f0e4a93a26b3e492/mlmodel/format/NeuralNetwork.proto#L5304
+    '''
+    if node.inputs[1] not in node.input_tensors or (len(node.inputs) > 2 and node.inputs[2] not in node.input_tensors):
+        return err.unsupported_op_configuration(builder, node, graph, "CoreML LayerNorm requires Scale and Bias to be known")
+
+    gamma = node.input_tensors[node.inputs[1]]
+    beta = node.input_tensors[node.inputs[2]] if len(node.inputs) > 2 else np.zeros(gamma.shape)
+    axis = node.attrs.get('axis', -1)
+    if axis >= 0 and axis + len(gamma.shape) != _get_input_rank(builder, node, graph):
+        return err.unsupported_op_configuration(builder, node, graph, "CoreML LayerNorm only normalizes the last axes")
+
+    builder.add_layer_normalization(
+        name=node.name,
+        input_name=node.inputs[0],
+        output_name=node.outputs[0],
+        normalized_shape=list(gamma.shape),
+        gamma=gamma,
+        beta=np.broadcast_to(beta, gamma.shape),
+        eps=node.attrs.get('epsilon', 1e-5)
+    )
+
 def _convert_less(builder, node, graph, err):
     '''
     convert to CoreML Less Than Layer:
@@ -1122,7 +1259,7 @@ def _convert_lstm(builder, node, graph, err):  # type: (NeuralNetworkBuilder, No
 
     # CoreML LSTM expects 5-d tensor
     # Expand dimensions of input to 5-d for compatibility
-    rank = builder._get_rank(node.inputs[0])
+    rank = _get_input_rank(builder, node, graph)
     if rank == -1:
         return err.unsupported_op_configuration(builder, node, graph, "Rank unknown for input")
     if rank < 5:
@@ -1652,7 +1789,7 @@ def _convert_reshape(builder, node, graph, err):
             )
             return
     
-        len_of_input_shape = builder._get_rank(node.inputs[0])
+        len_of_input_shape = _get_input_rank(builder, node, graph)
         if len(output_shape) == len_of_input_shape:
             builder.add_rank_preserving_reshape(
                 name=node.name,
@@ -1714,6 +1851,14 @@ def _convert_reshape(builder, node, graph, err):
                     output_name=node.outputs[0],
                     output_shape=output_shape
                 )
+    elif _get_static_shape(graph, node.outputs[0]) is not None:
+        # shape computed at runtime, but known from shape propagation
+        builder.add_reshape_static(
+            name=node.name,
+            input_name=node.inputs[0],
+            output_name=node.outputs[0],
+            output_shape=_get_static_shape(graph, node.outputs[0])
+        )
     else:
         builder.add_reshape_dynamic(
             name=node.name,
@@ -1768,7 +1913,7 @@ def _convert_reverse_sequence(builder, node, graph, err):
 
     if add_transpose:
         output_name_post = '_before_reverse'
-        rank = builder._get_rank(node.inputs[0])
+        rank = _get_input_rank(builder, node, graph)
         if rank == -1:
             return err.unsupported_op_configuration(builder, node, graph, "Rank unknown for input")
         axes = list(range(rank))
@@ -1907,7 +2052,7 @@ def _convert_slice_ir4v9(builder, node, graph, err):
     if node.inputs[0] in graph.shape_dict:
         data_shape = graph.shape_dict[node.inputs[0]]
     else:
-        rank = builder._get_rank(node.inputs[0])
+        rank = _get_input_rank(builder, node, graph)
         if rank == -1:
             return err.unsupported_op_configuration(builder, node, graph, "Input shape not available")
         data_shape = [INT_MAX] * rank
@@ -2102,7 +2247,7 @@ def _convert_softmax(builder, node, graph, err):
         )
 
     axis = node.attrs.get('axis', 1)
-    rank = builder._get_rank(node.inputs[0])
+    rank = _get_input_rank(builder, node, graph)
     if rank == -1:
         return _convert_softmax_nd(builder, node, graph, err)
 
@@ -2124,7 +2269,7 @@ def _convert_split(builder, node, graph, err):
     '''
     axis = node.attrs.get('axis', 0)
     split = node.attrs.get('split', None)
-    num_splits = len(node.outputs) if split is None else 2
+    num_splits = len(node.outputs)
         
     builder.add_split_nd(
         name=node.name,
@@ -2224,7 +2369,7 @@ def _convert_transpose(builder, node, graph, err):
     axes = node.attrs.get('perm', [])
     # If 'perm' not provided, the reverse the dimensions
     if axes == []:
-        rank = builder._get_rank(node.inputs[0])
+        rank = _get_input_rank(builder, node, graph)
         if rank == -1:
             return err.unsupported_op_configuration(builder, node, graph, "Rank unknown for input")
         axes = list(range(-1, -(rank+1), -1))
@@ -2295,6 +2440,7 @@ _ONNX_NODE_REGISTRY_ND = {
     "Flatten": _convert_flatten,
     "Floor": _convert_floor,
     "Gather": _convert_gather,
+    "Gelu": _convert_gelu,
     "Gemm": _convert_gemm,
     "Greater": _convert_greater,
     "GRU": _convert_gru,
@@ -2303,6 +2449,7 @@ _ONNX_NODE_REGISTRY_ND = {
     "HardSigmoid": _convert_hardsigmoid,
     "Identity": _convert_identity,
     "InstanceNormalization": _convert_instancenorm,
+    "LayerNormalization": _convert_layer_normalization,
     "LeakyRelu": _convert_leaky_relu,
     "Log": _convert_log,
     "LogSoftmax": _convert_softmax,
@@ -2344,6 +2491,7 @@ _ONNX_NODE_REGISTRY_ND = {
     "ReverseSequence": _convert_reverse_sequence,
     "RoiAlign": _convert_roialign,
     "Round": _convert_round,
+    "Rsqrt": _convert_rsqrt,
     "Scatter": _convert_scatter,
     "Selu": _convert_selu,
     "Sigmoid": _convert_sigmoid,
@@ -2391,5 +2539,9 @@ def _get_node_converter_fn(builder, node, err):  # type: (NeuralNetworkBuilder,
 
 def _convert_node_nd(builder, node, graph, err):  # type: (NeuralNetworkBuilder, Node, Graph, ErrorHandling) -> None
     converter_fn = _get_node_converter_fn(builder, node, err)
+    if node.op_type in _LAYOUT_AGNOSTIC_OP_TYPES and len(node.inputs) == 1 and len(node.outputs) == 1 and \
+            node.inputs[0] in graph.pending_squeezes and converter_fn is _ONNX_NODE_REGISTRY_ND.get(node.op_type):
+        return _convert_expanded_activation(builder, node, graph, err, converter_fn)
+    _squeeze_expanded_inputs(builder, node, graph, converter_fn)
     return converter_fn(builder, node, graph, err)
 
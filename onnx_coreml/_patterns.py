@@ -0,0 +1,348 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Text, Tuple, Union
+
+from ._graph import Graph, Node
+
+
+class Op(object):
+    '''
+    Describes one node of a pattern.
+
+    op_type:
+        Op type, or sequence of op types, the node may have. None matches any node.
+    attrs:
+        Attribute name -> expected value, or predicate called with the attribute
+        value. The attribute must be set on the node.
+    const_inputs:
+        Indices of the inputs that must be constant (i.e. in the node's input tensors),
+        or dict of such indices -> predicate called with the tensor.
+    num_inputs:
+        Exact number of inputs the node must have, if not None.
+    predicate:
+        Optional callable(graph, node) -> bool, for anything the above can't express.
+    inputs:
+        Only used by DAG patterns: for each input of the node, the name of the pattern
+        node producing it, a Var standing for an edge coming from outside the pattern,
+        or None for any edge. None leaves the inputs unconstrained.
+    commutative:
+        Only used by DAG patterns: the two inputs of the node may be matched in
+        either order.
+    '''
+    def __init__(self,
+                 op_type=None,  # type: Union[None, Text, Sequence[Text]]
+                 attrs=None,  # type: Optional[Dict[Text, Any]]
+                 const_inputs=(),  # type: Union[Sequence[int], Dict[int, Callable[[Any], bool]]]
+                 num_inputs=None,  # type: Optional[int]
+                 predicate=None,  # type: Optional[Callable[[Graph, Node], bool]]
+                 inputs=None,  # type: Optional[Sequence[Union[None, Text, Var]]]
+                 commutative=False,  # type: bool
+                 ):
+        # type: (...) -> None
+        if op_type is None:
+            self.op_types = None  # type: Optional[Tuple[Text, ...]]
+        elif isinstance(op_type, (tuple, list)):
+            self.op_types = tuple(op_type)
+        else:
+            self.op_types = (op_type,)
+        self.attrs = attrs or {}
+        if isinstance(const_inputs, dict):
+            self.const_inputs = dict(const_inputs)
+        else:
+            self.const_inputs = {i: None for i in const_inputs}
+        self.num_inputs = num_inputs
+        self.predicate = predicate
+        self.inputs = None if inputs is None else list(inputs)
+        self.commutative = commutative
+
+    def matches(self, graph, node):  # type: (Graph, Node) -> bool
+        if self.op_types is not None and node.op_type not in self.op_types:
+            return False
+        if self.num_inputs is not None and len(node.inputs) != self.num_inputs:
+            return False
+        for name, expected in self.attrs.items():
+            if name not in node.attrs:
+                return False
+            value = node.attrs[name]
+            if callable(expected):
+                if not expected(value):
+                    return False
+            elif value != expected:
+                return False
+        for i, predicate in self.const_inputs.items():
+            if i >= len(node.inputs) or node.inputs[i] not in node.input_tensors:
+                return False
+            if predicate is not None and not predicate(node.input_tensors[node.inputs[i]]):
+                return False
+        if self.predicate is not None and not self.predicate(graph, node):
+            return False
+        return True
+
+
+class Var(object):
+    '''
+    Edge coming into a DAG pattern from outside. All the inputs referring to
+    Vars of the same name must be the same edge.
+    '''
+    def __init__(self, name):  # type: (Text) -> None
+        self.name = name
+
+
+def _op_types(ops):  # type: (Iterable[Op]) -> Optional[Tuple[Text, ...]]
+    op_types = []  # type: List[Text]
+    for op in ops:
+        if op.op_types is not None:
+            op_types.extend([op_type for op_type in op.op_types if op_type not in op_types])
+    return tuple(op_types) if len(op_types) > 0 else None
+
+
+class Chain(object):
+    '''
+    Pattern of nodes feeding each other in sequence: the output of each node is
+    only used by the next one, and each node but the first has no other parent.
+    It is matched backwards, starting from the last node.
+    '''
+    def __init__(self, *ops):  # type: (*Op) -> None
+        assert len(ops) >= 1, "A pattern needs at least one node"
+        self.ops = ops
+
+    def __len__(self):  # type: () -> int
+        return len(self.ops)
+
+    @property
+    def anchor_op_types(self):  # type: () -> Optional[Tuple[Text, ...]]
+        '''Op types of the node matching starts from, None for any'''
+        return self.ops[-1].op_types
+
+    @property
+    def op_types(self):  # type: () -> Optional[Tuple[Text, ...]]
+        '''
+        Op types of the pattern nodes, None if none of them has a specific op type.
+        A match can only appear where a node of one of these op types was touched.
+        '''
+        return _op_types(self.ops)
+
+    def match(self, graph, node):  # type: (Graph, Node) -> Optional[List[Node]]
+        '''Returns the nodes of the match ending with "node", or None'''
+        if not self.ops[-1].matches(graph, node):
+            return None
+        nodes = [node]
+        n = node
+        output_names = None  # type: Optional[Set[Text]]
+        for op in reversed(self.ops[:-1]):
+            if len(n.parents) != 1:
+                return None
+            p = n.get_only_parent()
+            # the parent's value can't be used by any other node
+            if len(p.children) != 1:
+                return None
+            if not op.matches(graph, p):
+                return None
+            # nor be a graph output
+            if output_names is None:
+                output_names = set([str(output_[0]) for output_ in graph.outputs])
+            if any(output_ in output_names for output_ in p.outputs):
+                return None
+            nodes.append(p)
+            n = p
+        nodes.reverse()
+        return nodes
+
+
+class Match(List[Node]):
+    '''
+    Nodes matching a DAG pattern, in the order the pattern declares them.
+    "nodes" maps the pattern node names and "inputs" the Var names to what they matched.
+    '''
+    def __init__(self, nodes, inputs, names):  # type: (Dict[Text, Node], Dict[Text, Text], Sequence[Text]) -> None
+        super(Match, self).__init__([nodes[name] for name in names])
+        self.nodes = nodes
+        self.inputs = inputs
+
+
+class DAG(object):
+    '''
+    Pattern of an arbitrary small subgraph, e.g. a residual join or "x * sigmoid(x)".
+
+    "ops" is a sequence of (name, Op) pairs, whose Op "inputs" refer to other pattern
+    nodes by name or to edges from outside the pattern as Vars. The last node is the
+    one matching starts from: every other node must be one of its ancestors in the
+    pattern. Only the values of the nodes named in "outputs" (by default the last
+    one) may be used outside of the match or be graph outputs.
+    '''
+    def __init__(self,
+                 ops,  # type: Sequence[Tuple[Text, Op]]
+                 outputs=None,  # type: Optional[Sequence[Text]]
+                 ):
+        # type: (...) -> None
+        self.names = [name for name, _ in ops]
+        self.ops = [op for _, op in ops]
+        self.op_of = dict(ops)  # type: Dict[Text, Op]
+        self.anchor = self.names[-1]
+        self.outputs = set(outputs) if outputs is not None else {self.anchor}
+
+        reached = set()  # type: Set[Text]
+        to_visit = [self.anchor]
+        while len(to_visit) > 0:
+            name = to_visit.pop()
+            if name in reached:
+                continue
+            assert name in self.op_of, "Unknown pattern node: {}".format(name)
+            reached.add(name)
+            for ref in self.op_of[name].inputs or []:
+                if ref is not None and not isinstance(ref, Var):
+                    to_visit.append(ref)
+        assert reached == set(self.names), "Every pattern node must be an ancestor of the last one"
+
+    def __len__(self):  # type: () -> int
+        return len(self.ops)
+
+    @property
+    def anchor_op_types(self):  # type: () -> Optional[Tuple[Text, ...]]
+        return self.ops[-1].op_types
+
+    @property
+    def op_types(self):  # type: () -> Optional[Tuple[Text, ...]]
+        return _op_types(self.ops)
+
+    def _bind(self, graph, name, node, nodes, inputs):
+        # type: (Graph, Text, Node, Dict[Text, Node], Dict[Text, Text]) -> Iterator[Tuple[Dict[Text, Node], Dict[Text, Text]]]
+        bound = nodes.get(name)
+        if bound is not None:
+            if bound is node:
+                yield nodes, inputs
+            return
+        if node in nodes.values():
+            return
+        op = self.op_of[name]
+        if not op.matches(graph, node):
+            return
+        nodes = dict(nodes)
+        nodes[name] = node
+        if op.inputs is None:
+            yield nodes, inputs
+            return
+        if len(node.inputs) != len(op.inputs):
+            return
+        orders = [list(node.inputs)]
+        if op.commutative and len(node.inputs) == 2:
+            orders.append([node.inputs[1], node.inputs[0]])
+        for edges in orders:
+            for solution in self._bind_inputs(graph, op.inputs, edges, 0, nodes, inputs):
+                yield solution
+
+    def _bind_inputs(self, graph, refs, edges, i, nodes, inputs):
+        # type: (Graph, Sequence[Union[None, Text, Var]], Sequence[Text], int, Dict[Text, Node], Dict[Text, Text]) -> Iterator[Tuple[Dict[Text, Node], Dict[Text, Text]]]
+        if i == len(refs):
+            yield nodes, inputs
+            return
+        ref, edge = refs[i], edges[i]
+        if ref is None:
+            for solution in self._bind_inputs(graph, refs, edges, i + 1, nodes, inputs):
+                yield solution
+        elif isinstance(ref, Var):
+            if ref.name in inputs:
+                if inputs[ref.name] != edge:
+                    return
+            else:
+                inputs = dict(inputs)
+                inputs[ref.name] = edge
+            for solution in self._bind_inputs(graph, refs, edges, i + 1, nodes, inputs):
+                yield solution
+        else:
+            producer = graph.producer(edge)
+            if producer is None:
+                return
+            for nodes_, inputs_ in self._bind(graph, ref, producer, nodes, inputs):
+                for solution in self._bind_inputs(graph, refs, edges, i + 1, nodes_, inputs_):
+                    yield solution
+
+    def _escapes(self, graph, nodes, output_names):  # type: (Graph, Dict[Text, Node], Set[Text]) -> bool
+        '''Whether the value of a node not declared as an output is used outside the match'''
+        matched = set(nodes.values())
+        for name, node in nodes.items():
+            if name in self.outputs:
+                continue
+            for output_ in node.outputs:
+                if output_ in output_names:
+                    return True
+                for consumer in graph.consumers(output_):
+                    if consumer not in matched:
+                        return True
+        return False
+
+    def match(self, graph, node):  # type: (Graph, Node) -> Optional[Match]
+        '''Returns the match whose last node is "node", or None'''
+        if not self.ops[-1].matches(graph, node):
+            return None
+        output_names = None  # type: Optional[Set[Text]]
+        for nodes, inputs in self._bind(graph, self.anchor, node, {}, {}):
+            if output_names is None:
+                output_names = set([str(output_[0]) for output_ in graph.outputs])
+            if not self._escapes(graph, nodes, output_names):
+                return Match(nodes, inputs, self.names)
+        return None
+
+
+class PatternMatcher(object):
+    '''
+    Finds the matches of several patterns in a single traversal.
+
+    Patterns are compiled into a table from the op type of the node they are
+    matched from to the patterns anchored on it, so that only the nodes of those
+    op types, found through the graph's op type index, are ever looked at.
+    When the graph has a worklist, only the anchors that can reach one of its
+    nodes within the length of a pattern are looked at.
+    '''
+    def __init__(self, patterns):  # type: (Sequence[Union[Chain, DAG]]) -> None
+        self.patterns = list(patterns)
+        self.by_anchor = {}  # type: Dict[Text, List[int]]
+        self.any_anchor = []  # type: List[int]
+        for i, pattern in enumerate(self.patterns):
+            if pattern.anchor_op_types is None:
+                self.any_anchor.append(i)
+            else:
+                for op_type in pattern.anchor_op_types:
+                    self.by_anchor.setdefault(op_type, []).append(i)
+        self.max_length = max([len(pattern) for pattern in self.patterns] + [1])
+
+    def _reachable_from_worklist(self, graph):  # type: (Graph) -> Optional[Set[Node]]
+        if graph.worklist is None:
+            return None
+        reachable = set(graph.worklist)
+        frontier = reachable
+        for _ in range(self.max_length - 1):
+            next_frontier = set()  # type: Set[Node]
+            for node in frontier:
+                for child in node.children:
+                    if child not in reachable:
+                        next_frontier.add(child)
+            reachable.update(next_frontier)
+            frontier = next_frontier
+        return reachable
+
+    def candidates(self, graph):  # type: (Graph) -> List[Node]
+        '''Nodes matching may start from, in graph order'''
+        if len(self.any_anchor) > 0:
+            seeds = set(graph.nodes)  # type: Set[Node]
+        else:
+            seeds = set()
+            for op_type in self.by_anchor:
+                seeds.update(graph.index.nodes_of_op_type(op_type))
+        reachable = self._reachable_from_worklist(graph)
+        if reachable is not None:
+            seeds.intersection_update(reachable)
+        return sorted(seeds, key=graph.position)
+
+    def matches(self, graph, node):  # type: (Graph, Node) -> Iterable[Tuple[int, List[Node]]]
+        '''Yields (pattern index, matched nodes) for the patterns matching at "node", in order'''
+        indices = self.by_anchor.get(node.op_type, [])
+        if len(self.any_anchor) > 0:
+            indices = sorted(indices + self.any_anchor)
+        for i in indices:
+            nodes = self.patterns[i].match(graph, node)
+            if nodes is not None:
+                yield i, nodes
@@ -0,0 +1,783 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import heapq
+import numpy as np
+import sympy
+
+from functools import reduce
+from typing import Sequence, Callable, Iterable, List, Optional, Set, Text, Any, Dict, Tuple, Union
+from onnx import GraphProto
+from ._graph import Graph, Node, LazyTensor, tensor_dtype_to_np_dtype
+from ._folding import _fold_node, _normalize_axes, _REDUCE_OPS, _UNARY_OPS, _BINARY_OPS, _VARIADIC_OPS
+
+# Shape functions of ONNX ops, used to propagate the shapes of the tensors through
+# the graph before it is converted. Each function takes the node, the shapes of its
+# inputs and the values of its constant inputs (None for unknown shapes, non constant
+# inputs and omitted optional inputs), and returns the shape of its output or the
+# list of the shapes of its outputs. The function returns None when it can't infer
+# the rank of the output.
+#
+# A dimension is an int, a sympy expression of the named dimensions of the model
+# (the dim_param of its inputs, e.g. the batch size or the sequence length), or None
+# when it isn't known at all. Named dimensions are positive integer symbols, so that
+# the arithmetic of the ops on them simplifies, e.g. the -1 of a Reshape of a
+# [batch, seq, 768] tensor to [batch, seq, 12, -1] is inferred to be 64.
+
+Dim = Union[int, sympy.Expr, None]
+Shape = Tuple[Dim, ...]
+
+## Helper functions
+def _ints(value):  # type: (Any) -> List[int]
+    if isinstance(value, LazyTensor):
+        value = value.numpy()
+    return [int(v) for v in np.asarray(value).reshape(-1)]
+
+def _values_or_input(node, values, name, index, default=None):
+    # type: (Node, Sequence[Any], Text, int, Any) -> Any
+    '''_attr_or_input for the values of possibly lazy constant inputs'''
+    if name in node.attrs:
+        return list(node.attrs[name])
+    if len(values) > index and values[index] is not None:
+        return _ints(values[index])
+    return default
+
+def _str_attr(node, name, default):  # type: (Node, Text, Text) -> Text
+    value = node.attrs.get(name, default)
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+def _dim_symbol(name):  # type: (Text) -> sympy.Symbol
+    return sympy.Symbol(name, integer=True, positive=True)
+
+def _is_static(d):  # type: (Dim) -> bool
+    return isinstance(d, (int, np.integer))
+
+def _simplify_dim(d):  # type: (Any) -> Dim
+    '''Expressions that simplify to a constant become ints'''
+    if isinstance(d, sympy.Basic) and d.is_Integer:
+        return int(d)
+    elif isinstance(d, np.integer):
+        return int(d)
+    return d
+
+def _is_static_shape(shape):  # type: (Optional[Shape]) -> bool
+    return shape is not None and all(_is_static(d) for d in shape)
+
+def _dim_sum(dims):  # type: (Sequence[Dim]) -> Dim
+    if any(d is None for d in dims):
+        return None
+    return _simplify_dim(reduce(lambda a, b: a + b, dims, 0))
+
+def _dim_prod(dims):  # type: (Sequence[Dim]) -> Dim
+    if any(d is None for d in dims):
+        return None
+    return _simplify_dim(reduce(lambda a, b: a * b, dims, 1))
+
+def _dim_floordiv(a, b):  # type: (Dim, Dim) -> Dim
+    if a is None or b is None:
+        return None
+    if _is_static(a) and _is_static(b):
+        return a // b  # type: ignore
+    return _simplify_dim(sympy.floor(sympy.sympify(a) / b))
+
+def _dim_truncdiv(a, b):  # type: (Dim, Dim) -> Dim
+    '''ONNX integer Div, which truncates towards zero: symbolic dims are positive, so floor them'''
+    if _is_static(a) and _is_static(b):
+        return int(np.trunc(np.true_divide(a, b)))
+    return _dim_floordiv(a, b)
+
+def _dim_ceildiv(a, b):  # type: (Dim, Dim) -> Dim
+    d = _dim_floordiv(None if a is None else -a, b)  # type: ignore
+    return None if d is None else _simplify_dim(-d)  # type: ignore
+
+def _dim_scale(d, scale):  # type: (Dim, float) -> Dim
+    '''floor(d * scale)'''
+    if d is None:
+        return None
+    if _is_static(d):
+        return int(np.floor(d * scale))
+    return _simplify_dim(sympy.floor(d * sympy.nsimplify(scale, rational=True)))
+
+def _slice_dim(size, start, end, step):  # type: (Dim, int, int, int) -> Dim
+    if size is None:
+        return None
+    if _is_static(size):
+        return len(range(*slice(start, end, step).indices(size)))  # type: ignore
+    if step != 1:
+        return None
+    # clamps the bounds to [0, size] like python slices do
+    start_ = sympy.Min(sympy.Max(size + start if start < 0 else start, 0), size)
+    end_ = sympy.Min(sympy.Max(size + end if end < 0 else end, 0), size)
+    return _simplify_dim(sympy.Max(end_ - start_, 0))
+
+def _broadcast_dims(shapes):  # type: (Sequence[Shape]) -> Shape
+    '''Numpy broadcast of shapes with unknown dimensions, ValueError if they aren't compatible'''
+    rank = max(len(shape) for shape in shapes)
+    output = []  # type: List[Dim]
+    for dims in zip(*[(1,) * (rank - len(shape)) + tuple(shape) for shape in shapes]):
+        static = set(d for d in dims if _is_static(d) and d != 1)
+        symbolic = set(d for d in dims if d is not None and not _is_static(d))
+        if len(static) > 1:
+            raise ValueError('shapes can not be broadcast together')
+        if len(static) == 1:
+            # the other dimensions are 1 or the same
+            output.append(static.pop())
+        elif any(d is None for d in dims) or len(symbolic) > 1:
+            output.append(None)
+        elif len(symbolic) == 1:
+            output.append(symbolic.pop())
+        else:
+            output.append(1)
+    return tuple(output)
+
+def _spatial_output_dim(size, kernel, stride, dilation, pad_begin, pad_end, auto_pad, ceil_mode):
+    # type: (Dim, int, int, int, int, int, Text, bool) -> Dim
+    if size is None:
+        return None
+    if auto_pad in ('SAME_UPPER', 'SAME_LOWER'):
+        return _dim_ceildiv(size, stride)
+    kernel = (kernel - 1) * dilation + 1
+    if auto_pad == 'VALID':
+        return _dim_ceildiv(_dim_sum([size, 1 - kernel]), stride)
+    padded = _dim_sum([size, pad_begin + pad_end - kernel])
+    if ceil_mode:
+        return _dim_sum([_dim_ceildiv(padded, stride), 1])
+    return _dim_sum([_dim_floordiv(padded, stride), 1])
+
+
+def _infer_same(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    return shapes[0]
+
+def _infer_broadcast(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    if node.attrs.get('broadcast', 0):
+        # before opset 7 the output has the shape of the first input
+        return shapes[0]
+    return _broadcast_dims([shape for shape in shapes if shape is not None]) \
+        if all(shape is not None for shape in shapes) else None
+
+def _infer_prelu(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    # the slope is broadcast to the input
+    return shapes[0]
+
+def _infer_dropout(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    return [shapes[0], shapes[0]]
+
+def _infer_batchnorm(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    # the other outputs only exist in training mode
+    return [shapes[0]]
+
+def _infer_pool(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    if node.op_type == 'Conv':
+        W = shapes[1]
+        kernel_shape = node.attrs.get('kernel_shape', W[2:])
+        channels = W[0]
+    else:
+        kernel_shape = node.attrs['kernel_shape']
+        channels = x[1]
+    num_spatial = len(x) - 2
+    strides = node.attrs.get('strides', [1] * num_spatial)
+    dilations = node.attrs.get('dilations', [1] * num_spatial)
+    pads = node.attrs.get('pads', [0] * (2 * num_spatial))
+    auto_pad = _str_attr(node, 'auto_pad', 'NOTSET')
+    ceil_mode = bool(node.attrs.get('ceil_mode', 0))
+    output = [x[0], channels]  # type: List[Optional[int]]
+    for i in range(num_spatial):
+        output.append(_spatial_output_dim(x[2 + i], kernel_shape[i], strides[i], dilations[i],
+                                          pads[i], pads[i + num_spatial], auto_pad, ceil_mode))
+    # the indices output of MaxPool has the shape of its values
+    return [tuple(output)] * len(node.outputs)
+
+def _infer_conv_transpose(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x, W = shapes[0], shapes[1]
+    num_spatial = len(x) - 2
+    channels = _dim_prod([W[1], node.attrs.get('group', 1)])
+    output_shape = node.attrs.get('output_shape', None)
+    if output_shape is not None:
+        return (x[0], channels) + tuple(output_shape[-num_spatial:])
+    kernel_shape = node.attrs.get('kernel_shape', W[2:])
+    strides = node.attrs.get('strides', [1] * num_spatial)
+    dilations = node.attrs.get('dilations', [1] * num_spatial)
+    pads = node.attrs.get('pads', [0] * (2 * num_spatial))
+    output_padding = node.attrs.get('output_padding', [0] * num_spatial)
+    auto_pad = _str_attr(node, 'auto_pad', 'NOTSET')
+    output = [x[0], channels]  # type: List[Optional[int]]
+    for i in range(num_spatial):
+        size = x[2 + i]
+        if auto_pad in ('SAME_UPPER', 'SAME_LOWER'):
+            output.append(_dim_prod([size, strides[i]]))
+        else:
+            output.append(_dim_sum([_dim_prod([_dim_sum([size, -1]), strides[i]]),
+                                    output_padding[i] + (kernel_shape[i] - 1) * dilations[i] + 1
+                                    - pads[i] - pads[i + num_spatial]]))
+    return tuple(output)
+
+def _infer_global_pool(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    return tuple(x[:2]) + (1,) * (len(x) - 2)
+
+def _infer_reshape(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    target = _values_or_input(node, values, 'shape', 1)
+    if target is None:
+        # only the rank is known
+        return (None,) * shapes[1][0]  # type: ignore
+    output = []  # type: List[Dim]
+    for i, d in enumerate(target):
+        # a 0 copies the input dimension
+        if d == 0:
+            output.append(None if x is None else x[i])
+        else:
+            output.append(d)
+    if -1 in output:
+        i = output.index(-1)
+        size = None if x is None else _dim_prod(x)
+        rest = _dim_prod(output[:i] + output[i + 1:])
+        output[i] = None if rest == 0 else _dim_floordiv(size, rest)
+    if any(_is_static(d) and d < 0 for d in output):
+        return None
+    return tuple(output)
+
+def _infer_flatten(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    axis = _normalize_axes([node.attrs.get('axis', 1)], len(x))[0]
+    return (_dim_prod(x[:axis]), _dim_prod(x[axis:]))
+
+def _infer_transpose(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    perm = node.attrs.get('perm', list(reversed(range(len(x)))))
+    return tuple(x[p] for p in perm)
+
+def _infer_concat(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    if any(shape is None for shape in shapes):
+        return None
+    rank = len(shapes[0])
+    axis = _normalize_axes([node.attrs.get('axis', 0)], rank)[0]
+    output = []  # type: List[Dim]
+    for i in range(rank):
+        dims = [shape[i] for shape in shapes]  # type: ignore
+        if i == axis:
+            output.append(_dim_sum(dims))
+        else:
+            # the inputs have the same dimension, possibly known for some of them only
+            known = sorted([d for d in dims if d is not None], key=lambda d: not _is_static(d))
+            output.append(known[0] if len(known) > 0 else None)
+    return tuple(output)
+
+def _infer_split(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    axis = _normalize_axes([node.attrs.get('axis', 0)], len(x))[0]
+    split = _values_or_input(node, values, 'split', 1)
+    if split is None:
+        size = _dim_floordiv(x[axis], len(node.outputs))
+        split = [size] * len(node.outputs)
+    return [tuple(x[:axis]) + (s,) + tuple(x[axis + 1:]) for s in split]
+
+def _infer_slice(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    starts = _values_or_input(node, values, 'starts', 1)
+    ends = _values_or_input(node, values, 'ends', 2)
+    if starts is None or ends is None:
+        # the dimensions that are sliced aren't known, only the rank
+        return (None,) * len(x)
+    axes = _values_or_input(node, values, 'axes', 3, list(range(len(starts))))
+    steps = _values_or_input(node, values, 'steps', 4, [1] * len(starts))
+    output = list(x)
+    for start, end, axis, step in zip(starts, ends, _normalize_axes(axes, len(x)), steps):
+        output[axis] = _slice_dim(output[axis], start, end, step)
+    return tuple(output)
+
+def _infer_squeeze(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    axes = _values_or_input(node, values, 'axes', 1)
+    if axes is None:
+        # symbolic dimensions may be 1
+        if not _is_static_shape(x):
+            return None
+        return tuple(d for d in x if d != 1)
+    axes = _normalize_axes(axes, len(x))
+    return tuple(d for i, d in enumerate(x) if i not in axes)
+
+def _infer_unsqueeze(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    output = list(shapes[0])  # type: List[Dim]
+    axes = _values_or_input(node, values, 'axes', 1)
+    for axis in sorted(_normalize_axes(axes, len(output) + len(axes))):
+        output.insert(axis, 1)
+    return tuple(output)
+
+def _infer_gather(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x, indices = shapes[0], shapes[1]
+    axis = _normalize_axes([node.attrs.get('axis', 0)], len(x))[0]
+    return tuple(x[:axis]) + tuple(indices) + tuple(x[axis + 1:])
+
+def _infer_expand(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    if values[1] is None:
+        # only the rank is known
+        return (None,) * max(len(shapes[0]), shapes[1][0])  # type: ignore
+    return _broadcast_dims([shapes[0], tuple(_ints(values[1]))])
+
+def _infer_tile(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    if values[1] is None:
+        return (None,) * len(x)
+    return tuple(_dim_prod([d, r]) for d, r in zip(x, _ints(values[1])))
+
+def _infer_shape(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    return (len(shapes[0]),)
+
+def _infer_size(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    return ()
+
+def _infer_constant(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    return tuple(np.shape(node.attrs['value']))
+
+def _infer_constant_of_shape(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    if values[0] is not None:
+        return tuple(_ints(values[0]))
+    if shapes[0] is not None and shapes[0][0] is not None:
+        return (None,) * shapes[0][0]
+    return None
+
+def _infer_reduce(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    axes = _values_or_input(node, values, 'axes', 1)
+    axes = list(range(len(x))) if not axes else _normalize_axes(axes, len(x))
+    if node.attrs.get('keepdims', 1):
+        return tuple(1 if i in axes else d for i, d in enumerate(x))
+    return tuple(d for i, d in enumerate(x) if i not in axes)
+
+def _infer_arg_reduce(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    axis = _normalize_axes([node.attrs.get('axis', 0)], len(x))[0]
+    if node.attrs.get('keepdims', 1):
+        return tuple(1 if i == axis else d for i, d in enumerate(x))
+    return tuple(d for i, d in enumerate(x) if i != axis)
+
+def _infer_topk(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    axis = _normalize_axes([node.attrs.get('axis', -1)], len(x))[0]
+    k = node.attrs['k'] if 'k' in node.attrs else (_ints(values[1])[0] if values[1] is not None else None)
+    output = tuple(k if i == axis else d for i, d in enumerate(x))
+    return [output, output]
+
+def _infer_matmul(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    a, b = shapes[0], shapes[1]
+    # vectors are promoted to matrices, and the added dimension removed from the output
+    a_ = (1,) + tuple(a) if len(a) == 1 else tuple(a)
+    b_ = tuple(b) + (1,) if len(b) == 1 else tuple(b)
+    output = _broadcast_dims([a_[:-2], b_[:-2]]) + (a_[-2], b_[-1])
+    if len(a) == 1:
+        output = output[:-2] + output[-1:]
+    if len(b) == 1:
+        output = output[:-1]
+    return output
+
+def _infer_gemm(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    a, b = shapes[0], shapes[1]
+    M = a[1] if node.attrs.get('transA', 0) else a[0]
+    N = b[0] if node.attrs.get('transB', 0) else b[1]
+    return (M, N)
+
+def _infer_pad(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    pads = _values_or_input(node, values, 'pads', 1)
+    if pads is None:
+        pads = node.attrs.get('paddings', None)
+    if pads is None:
+        return (None,) * len(x)
+    rank = len(x)
+    return tuple(_dim_sum([d, pads[i] + pads[i + rank]]) for i, d in enumerate(x))
+
+def _infer_depth_to_space(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    N, C, H, W = shapes[0]
+    b = node.attrs['blocksize']
+    if node.op_type == 'DepthToSpace':
+        return (N, _dim_floordiv(C, b * b), _dim_prod([H, b]), _dim_prod([W, b]))
+    return (N, _dim_prod([C, b * b]), _dim_floordiv(H, b), _dim_floordiv(W, b))
+
+def _infer_resize(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    # Resize takes roi, scales and sizes inputs since opset 11, only scales before, like Upsample
+    if node.op_type == 'Resize' and len(values) > 2:
+        if len(values) > 3 and values[3] is not None:
+            return tuple(_ints(values[3]))
+        scales = values[2]
+    else:
+        scales = node.attrs.get('scales', values[1] if len(values) > 1 else None)
+    if scales is None:
+        return (None,) * len(x)
+    if isinstance(scales, LazyTensor):
+        scales = scales.numpy()
+    scales = np.asarray(scales, dtype=np.float64).reshape(-1)
+    if len(scales) != len(x):
+        return None
+    return tuple(_dim_scale(d, s) for d, s in zip(x, scales))
+
+def _infer_roi_align(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x, rois = shapes[0], shapes[1]
+    return (rois[0], x[1], node.attrs.get('output_height', 1), node.attrs.get('output_width', 1))
+
+def _infer_random(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    return tuple(node.attrs['shape'])
+
+def _infer_non_zero(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    # the number of non zero values is only known at runtime
+    return (len(shapes[0]), None)
+
+def _infer_recurrent(node, shapes, values):  # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Any
+    x = shapes[0]
+    num_directions = 2 if _str_attr(node, 'direction', 'forward') == 'bidirectional' else 1
+    hidden_size = node.attrs.get('hidden_size', None)
+    state = (num_directions, x[1], hidden_size)
+    # Y, Y_h and for LSTM Y_c
+    return [(x[0], num_directions, x[1], hidden_size), state, state]
+
+
+_SHAPE_INFERENCE_REGISTRY = {
+    'ArgMax': _infer_arg_reduce,
+    'ArgMin': _infer_arg_reduce,
+    'AveragePool': _infer_pool,
+    'BatchNormalization': _infer_batchnorm,
+    'Concat': _infer_concat,
+    'Constant': _infer_constant,
+    'ConstantOfShape': _infer_constant_of_shape,
+    'Conv': _infer_pool,
+    'ConvTranspose': _infer_conv_transpose,
+    'DepthToSpace': _infer_depth_to_space,
+    'Dropout': _infer_dropout,
+    'Expand': _infer_expand,
+    'Flatten': _infer_flatten,
+    'Gather': _infer_gather,
+    'Gemm': _infer_gemm,
+    'GlobalAveragePool': _infer_global_pool,
+    'GlobalMaxPool': _infer_global_pool,
+    'GRU': _infer_recurrent,
+    'LSTM': _infer_recurrent,
+    'MatMul': _infer_matmul,
+    'MaxPool': _infer_pool,
+    'NonZero': _infer_non_zero,
+    'Pad': _infer_pad,
+    'PRelu': _infer_prelu,
+    'RandomNormal': _infer_random,
+    'RandomUniform': _infer_random,
+    'Reshape': _infer_reshape,
+    'Resize': _infer_resize,
+    'RNN': _infer_recurrent,
+    'RoiAlign': _infer_roi_align,
+    'Shape': _infer_shape,
+    'Size': _infer_size,
+    'Slice': _infer_slice,
+    'SpaceToDepth': _infer_depth_to_space,
+    'Split': _infer_split,
+    'Squeeze': _infer_squeeze,
+    'Tile': _infer_tile,
+    'TopK': _infer_topk,
+    'Transpose': _infer_transpose,
+    'Unsqueeze': _infer_unsqueeze,
+    'Upsample': _infer_resize,
+    'Where': _infer_broadcast,
+}  # type: Dict[Text, Callable[[Node, Sequence[Optional[Shape]], Sequence[Any]], Any]]
+
+# ops whose output has the shape of their first input
+_SHAPE_PRESERVING_OP_TYPES = [
+    'Acos', 'Acosh', 'Asin', 'Asinh', 'Atan', 'Atanh', 'Cast', 'Clip', 'Cosh', 'Elu', 'Erf', 'Gelu',
+    'HardSigmoid', 'Hardmax', 'Identity', 'ImageScaler', 'InstanceNormalization', 'LayerNormalization',
+    'LeakyRelu', 'LogSoftmax', 'LRN', 'MeanVarianceNormalization', 'RandomNormalLike',
+    'RandomUniformLike', 'ReverseSequence', 'Scatter', 'Selu', 'Sinh', 'Softmax', 'Softplus',
+    'Softsign', 'SpatialBN', 'Tan', 'ThresholdedRelu',
+]
+
+for op_type in list(_UNARY_OPS) + _SHAPE_PRESERVING_OP_TYPES:
+    _SHAPE_INFERENCE_REGISTRY[op_type] = _infer_same
+for op_type in list(_BINARY_OPS) + list(_VARIADIC_OPS) + ['Mean', 'Mod']:
+    _SHAPE_INFERENCE_REGISTRY[op_type] = _infer_broadcast
+for op_type in _REDUCE_OPS:
+    _SHAPE_INFERENCE_REGISTRY[op_type] = _infer_reduce
+
+
+def _infer_shapes(node, shapes, values):
+    # type: (Node, Sequence[Optional[Shape]], Sequence[Any]) -> Optional[List[Optional[Shape]]]
+    '''
+    Returns the shapes of the outputs of the node, inferred from the shapes and
+    constant values of its inputs, or None if they can't be inferred.
+    '''
+    infer = _SHAPE_INFERENCE_REGISTRY.get(node.op_type)
+    if infer is None:
+        return None
+    try:
+        outputs = infer(node, shapes, values)
+    except (ValueError, TypeError, IndexError, KeyError, ZeroDivisionError):
+        # unknown input shapes, or invalid or unsupported parameters
+        return None
+    if outputs is None:
+        return None
+    if not isinstance(outputs, list):
+        outputs = [outputs]
+    return [None if output is None else tuple(_simplify_dim(d) for d in output) for output in outputs]
+
+
+def _symbolic_shapes(graph):  # type: (GraphProto) -> Dict[Text, Tuple[Union[int, Text, None], ...]]
+    '''
+    Shapes of the inputs, outputs and value infos of the ONNX graph with named dimensions,
+    given as the names of the dimensions, and None for the unknown ones
+    '''
+    shapes = {}  # type: Dict[Text, Tuple[Union[int, Text, None], ...]]
+    for value_info in list(graph.input) + list(graph.value_info) + list(graph.output):
+        shape = []  # type: List[Union[int, Text, None]]
+        for dim in value_info.type.tensor_type.shape.dim:
+            if dim.HasField('dim_value') and dim.dim_value > 0:
+                shape.append(int(dim.dim_value))
+            elif dim.HasField('dim_param') and dim.dim_param:
+                shape.append(dim.dim_param)
+            else:
+                shape.append(None)
+        if any(not isinstance(d, int) and d is not None for d in shape):
+            shapes[value_info.name] = tuple(shape)
+    return shapes
+
+def _merge_dims(known, inferred):  # type: (Dim, Dim) -> Dim
+    '''Most precise of two values of a dimension: static, then inferred, then known'''
+    if _is_static(known):
+        return known
+    if inferred is not None:
+        return inferred
+    return known
+
+def _shape_dict_shape(shape):  # type: (Sequence[int]) -> Shape
+    '''Shape of graph.shape_dict, where dimensions of 0 are unknown'''
+    return tuple(int(d) if d > 0 else None for d in shape)
+
+def _initial_shapes(graph, symbolic_shapes=None):
+    # type: (Graph, Optional[Dict[Text, Sequence[Union[int, Text, None]]]]) -> Dict[Text, Shape]
+    shapes = {}  # type: Dict[Text, Shape]
+    for name, _, shape in graph.inputs:
+        shapes[name] = tuple(d if d > 0 else None for d in shape)
+    for name, shape in graph.shape_dict.items():
+        shapes[name] = _shape_dict_shape(shape)
+    for name, shape in (symbolic_shapes or {}).items():
+        known_shape = shapes.get(name)
+        if known_shape is not None and len(known_shape) != len(shape):
+            continue
+        dims = tuple(_dim_symbol(d) if isinstance(d, (str, Text)) else d for d in shape)
+        shapes[name] = dims if known_shape is None else \
+            tuple(_merge_dims(d, d_) for d, d_ in zip(known_shape, dims))
+    return shapes
+
+def _propagate_node(node, shapes):  # type: (Node, Dict[Text, Shape]) -> List[Text]
+    '''Infers the shapes of the outputs of the node into "shapes", returns the outputs whose shape changed'''
+    input_shapes = []  # type: List[Optional[Shape]]
+    input_values = []  # type: List[Any]
+    for input_ in node.inputs:
+        value = node.input_tensors.get_lazy(input_)
+        input_values.append(value)
+        input_shapes.append(tuple(value.shape) if value is not None else shapes.get(input_))
+    output_shapes = _infer_shapes(node, input_shapes, input_values)
+    if output_shapes is None:
+        return []
+    changed = []  # type: List[Text]
+    for output_, shape in zip(node.outputs, output_shapes):
+        if output_ == '' or shape is None:
+            continue
+        known_shape = shapes.get(output_)
+        if known_shape is not None:
+            if len(known_shape) != len(shape):
+                continue
+            shape = tuple(_merge_dims(d, d_) for d, d_ in zip(known_shape, shape))
+        if shape != known_shape:
+            shapes[output_] = shape
+            changed.append(output_)
+    return changed
+
+def _propagate_shapes(graph, symbolic_shapes=None):
+    # type: (Graph, Optional[Dict[Text, Sequence[Union[int, Text, None]]]]) -> Dict[Text, Shape]
+    '''
+    Shapes of the edges of the graph, propagated through its nodes in topological
+    order from graph.shape_dict, where dimensions of 0 are unknown, and from
+    "symbolic_shapes", see _symbolic_shapes, whose named dimensions become symbols.
+    '''
+    shapes = _initial_shapes(graph, symbolic_shapes)
+    for node in graph.nodes:
+        _propagate_node(node, shapes)
+    return shapes
+
+def _update_shapes(graph, shapes, nodes):  # type: (Graph, Dict[Text, Shape], Iterable[Node]) -> Set[Text]
+    '''
+    Updates the shapes given by _propagate_shapes after "nodes" were added or modified,
+    or had an input shape recorded in graph.shape_dict: their output shapes are inferred
+    again, and so are those of the nodes whose input shapes change as a result, in
+    topological order. Returns the edges whose shape changed.
+    '''
+    changed = set()  # type: Set[Text]
+    node_of = {}  # type: Dict[int, Node]
+    ready = []  # type: List[Tuple[int, int]]
+    for node in nodes:
+        node_of[node.id] = node
+        ready.append((graph.position(node), node.id))
+    heapq.heapify(ready)
+    while len(ready) > 0:
+        _, node_id = heapq.heappop(ready)
+        node = node_of[node_id]
+        for input_ in node.inputs:
+            if input_ not in graph.shape_dict:
+                continue
+            shape = _shape_dict_shape(graph.shape_dict[input_])
+            known_shape = shapes.get(input_)
+            if known_shape is not None:
+                if len(known_shape) != len(shape):
+                    continue
+                shape = tuple(_merge_dims(d, d_) for d, d_ in zip(shape, known_shape))
+            if shape != known_shape:
+                shapes[input_] = shape
+                changed.add(input_)
+        for output_ in _propagate_node(node, shapes):
+            changed.add(output_)
+            for consumer in graph.consumers(output_):
+                if consumer.id not in node_of:
+                    node_of[consumer.id] = consumer
+                    heapq.heappush(ready, (graph.position(consumer), consumer.id))
+    return changed
+
+
+# Values of the small integer tensors computing shapes at runtime, e.g. the target
+# shape of a Reshape built with Shape, Gather, Unsqueeze and Concat nodes, evaluated
+# as object arrays of dimensions. Dimensions unknown even symbolically are given a
+# symbol of their own, so that they can still be matched to the tensor they come from.
+
+# ops evaluated on dimension values with their constant folding function
+_SHAPE_VALUE_OP_TYPES = set(['Add', 'Concat', 'Gather', 'Identity', 'Mul', 'Slice', 'Squeeze', 'Sub', 'Unsqueeze'])
+
+# largest constant input seen as a list of dimensions
+_MAX_SHAPE_VALUE_SIZE = 16
+
+def _is_integer_type(tensor_type):  # type: (int) -> bool
+    try:
+        return np.issubdtype(np.dtype(tensor_dtype_to_np_dtype(tensor_type)), np.integer)
+    except (KeyError, TypeError):
+        return False
+
+class _ShapeValues(object):
+    '''
+    Partial evaluation of the shape computations of a graph, given the shapes
+    of its edges, see _propagate_shapes. "values" maps the edges to their value.
+    Only integer arithmetic is evaluated: the evaluation stops at casts to other
+    types, e.g. the float Cast, Div and Ceil nodes computing a rounded up half.
+    '''
+    def __init__(self, graph, shapes):  # type: (Graph, Dict[Text, Shape]) -> None
+        self.shapes = shapes
+        self.unknown_dims = {}  # type: Dict[Tuple[Text, int], sympy.Symbol]
+        self.values = {}  # type: Dict[Text, np.ndarray]
+        # edges of "values" whose tensor type is an integer one
+        self.integer_edges = set()  # type: Set[Text]
+        for node in graph.nodes:
+            try:
+                outputs = self._evaluate(node)
+            except (ValueError, TypeError, IndexError, ZeroDivisionError):
+                # inputs that don't broadcast, division by zero
+                continue
+            if outputs is None:
+                continue
+            is_integer = self._is_integer_output(node)
+            for output_, value in zip(node.outputs, outputs):
+                if value.ndim <= 1:
+                    self.values[output_] = value
+                    if is_integer:
+                        self.integer_edges.add(output_)
+
+    def dim(self, edge, axis):  # type: (Text, int) -> Dim
+        '''Dimension "axis" of the edge, None if its rank isn't known'''
+        shape = self.shapes.get(edge)
+        if shape is None or axis >= len(shape):
+            return None
+        if shape[axis] is not None:
+            return shape[axis]
+        if (edge, axis) not in self.unknown_dims:
+            self.unknown_dims[(edge, axis)] = sympy.Dummy(integer=True, positive=True)
+        return self.unknown_dims[(edge, axis)]
+
+    def _input_value(self, node, input_):  # type: (Node, Text) -> Optional[np.ndarray]
+        if input_ in self.values:
+            return self.values[input_]
+        value = node.input_tensors.get_lazy(input_)
+        if value is None or len(value.shape) > 1 or int(np.prod(value.shape)) > _MAX_SHAPE_VALUE_SIZE:
+            return None
+        value = np.asarray(node.input_tensors[input_])
+        # Shape ops folded by ShapeOpRemover give float values
+        if not np.all(np.mod(value, 1) == 0):
+            return None
+        return np.array([int(v) for v in value.reshape(-1)], dtype=object).reshape(value.shape)
+
+    def _is_integer(self, node, input_):  # type: (Node, Text) -> bool
+        if input_ in self.values:
+            return input_ in self.integer_edges
+        value = node.input_tensors.get_lazy(input_)
+        return value is not None and np.issubdtype(value.dtype, np.integer)
+
+    def _is_integer_output(self, node):  # type: (Node) -> bool
+        if node.op_type == 'Shape':
+            return True
+        if node.op_type == 'Cast':
+            return _is_integer_type(node.attrs['to'])
+        return all(self._is_integer(node, input_) for input_ in node.inputs if input_ != '')
+
+    def _evaluate(self, node):  # type: (Node) -> Optional[List[np.ndarray]]
+        if node.op_type == 'Shape':
+            shape = self.shapes.get(node.inputs[0])
+            if shape is None:
+                return None
+            return [np.array([self.dim(node.inputs[0], i) for i in range(len(shape))], dtype=object)]
+        if node.op_type not in _SHAPE_VALUE_OP_TYPES and node.op_type not in ('Cast', 'Div'):
+            return None
+        inputs = []  # type: List[Optional[np.ndarray]]
+        for input_ in node.inputs:
+            value = None if input_ == '' else self._input_value(node, input_)
+            if value is None and input_ != '':
+                return None
+            inputs.append(value)
+        if node.op_type == 'Cast':
+            # casts to integer types don't change dimensions, those to float types
+            # lead to float arithmetic, e.g. rounding up a Div, which isn't evaluated
+            if not _is_integer_type(node.attrs['to']):
+                return None
+            return [inputs[0]]  # type: ignore
+        if node.op_type == 'Div':
+            if not all(self._is_integer(node, input_) for input_ in node.inputs):
+                return None
+            a, b = np.broadcast_arrays(inputs[0], inputs[1])
+            quotient = [_dim_truncdiv(x, y) for x, y in zip(a.reshape(-1), b.reshape(-1))]
+            return [np.array(quotient, dtype=object).reshape(a.shape)]
+        outputs = _fold_node(node, inputs)
+        if outputs is None:
+            return None
+        return [np.array([_simplify_dim(d) for d in output.reshape(-1)], dtype=object).reshape(output.shape)
+                for output in outputs]
+
+    def static_value(self, edge):  # type: (Text) -> Optional[np.ndarray]
+        '''Value of the edge, if none of its dimensions is symbolic'''
+        value = self.values.get(edge)
+        if value is None or not all(_is_static(d) for d in value.reshape(-1)):
+            return None
+        return value.astype(np.int64)
+
+    def reshape_target(self, node):  # type: (Node) -> Optional[np.ndarray]
+        '''
+        Static equivalent of the target shape of a Reshape node computed at runtime, where the
+        symbolic dimensions copied from the input are 0s and at most one other one is -1
+        '''
+        value = self.values.get(node.inputs[1])
+        if value is None or value.ndim != 1:
+            return None
+        target = []  # type: List[int]
+        num_unresolved = 0
+        for i, d in enumerate(value):
+            if _is_static(d):
+                target.append(int(d))
+            elif d == self.dim(node.inputs[0], i):
+                target.append(0)
+            else:
+                target.append(-1)
+                num_unresolved += 1
+        if num_unresolved > 1 or (num_unresolved == 1 and target.count(-1) > 1):
+            return None
+        return np.array(target, dtype=np.int64)
@@ -0,0 +1,124 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from typing import Dict, List, Optional, Sequence, Set, Text
+
+from ._graph import Graph, Node
+
+# Choice of the rank 5 CoreML axes (0: Sequence, 1: Batch, 2: Channel, 3: Height, 4: Width)
+# the axes of the rank 3 model inputs are mapped to, for the iOS 11/12 converters.
+# The converters derive the mapping of a node's outputs from the mapping of its first input,
+# and wrap the nodes whose axes don't line up with the CoreML layer in a pair of permute
+# layers. The mapping of the inputs is thus the only free choice: the one picked is the one
+# for which the nodes the mapping flows to need the fewest permute layers, among those the
+# converters support.
+
+# [C,H,W], [B,C,W] and [S,B,C]
+_RANK3_MAPPINGS = ([2, 3, 4], [1, 2, 4], [0, 1, 2])
+
+# ops whose converters give their outputs the mapping of their first input
+_MAPPING_PRESERVING_OP_TYPES = set([
+    'Abs', 'Add', 'AveragePool', 'BatchNormalization', 'Clip', 'Concat', 'Conv', 'ConvTranspose',
+    'Div', 'Elu', 'Exp', 'HardSigmoid', 'InstanceNormalization', 'LeakyRelu', 'Log', 'LRN',
+    'LSTM', 'Max', 'MaxPool', 'MeanVarianceNormalization', 'Min', 'Mul', 'Neg', 'Pad', 'Pow',
+    'PRelu', 'Reciprocal', 'Relu', 'Rsqrt', 'Selu', 'Sigmoid', 'Sign', 'Slice', 'Softmax',
+    'Softplus', 'Softsign', 'Split', 'Sqrt', 'Sub', 'Sum', 'Tanh', 'ThresholdedRelu',
+])
+
+# ops converted with _add_conv_like_op
+_CONV_LIKE_OP_TYPES = set(['AveragePool', 'Conv', 'ConvTranspose', 'MaxPool', 'Pad'])
+
+
+def _axis_permutes(coreml_axis, num_permutes, unsupported=(1,)):
+    # type: (int, int, Sequence[int]) -> Optional[int]
+    '''Cost of an op working along the CoreML channel axis, applied along "coreml_axis"'''
+    if coreml_axis in unsupported:
+        return None
+    return 0 if coreml_axis == 2 else num_permutes
+
+
+def _permute_cost(node, mapping):  # type: (Node, Sequence[int]) -> Optional[int]
+    '''
+    Number of permute layers the converter adds for the node when its first input has
+    the given mapping, None if the converter can't handle the mapping
+    '''
+    op_type = node.op_type
+    num_permutes = len(node.inputs) + len(node.outputs)
+    if op_type in _CONV_LIKE_OP_TYPES:
+        if list(mapping) in ([1, 2, 3], [1, 2, 4]):
+            return 0
+        if list(mapping) in ([2, 3, 4], [1, 2, 0]):
+            return 2
+        return None
+    if op_type == 'BatchNormalization':
+        if list(mapping) == [2, 3, 4]:
+            return 2
+        return 0 if mapping[1] == 2 else None
+    if op_type == 'Softmax':
+        # converted along the channel axis without permutes
+        axis = node.attrs.get('axis', 1)
+        return 0 if axis < len(mapping) and mapping[axis] == 2 else None
+    if op_type == 'LSTM':
+        return 0 if list(mapping) == [0, 1, 2] else None
+    if op_type == 'Concat':
+        axis = node.attrs.get('axis', 1)
+        if axis >= len(mapping):
+            return None
+        return 0 if mapping[axis] == 0 else _axis_permutes(mapping[axis], num_permutes)
+    if op_type == 'Split':
+        axis = node.attrs.get('axis', 0)
+        return _axis_permutes(mapping[axis], num_permutes) if axis < len(mapping) else None
+    if op_type in ('ArgMax', 'ArgMin'):
+        axis = node.attrs.get('axis', 0)
+        if axis >= len(mapping) or mapping[axis] == 1:
+            return None
+        return 2 if mapping[axis] == 0 else 0
+    if op_type == 'Slice':
+        cost = 0
+        for axis in node.attrs.get('axes', range(len(node.attrs.get('starts', [])))):
+            if axis >= len(mapping) or mapping[axis] == 1:
+                return None
+            if mapping[axis] == 0:
+                cost += 2
+        return cost
+    return 0
+
+
+def _mapping_cost(graph, edge, mapping):  # type: (Graph, Text, Sequence[int]) -> Optional[int]
+    '''
+    Number of permute layers added by the converters of the nodes "mapping" flows to
+    from "edge", None if one of them can't handle it
+    '''
+    cost = 0
+    visited = set()  # type: Set[Node]
+    to_visit = [edge]
+    while len(to_visit) > 0:
+        edge_ = to_visit.pop()
+        for node in graph.consumers(edge_):
+            if node in visited or node.inputs[0] != edge_:
+                continue
+            visited.add(node)
+            node_cost = _permute_cost(node, mapping)
+            if node_cost is None:
+                return None
+            cost += node_cost
+            if node.op_type in _MAPPING_PRESERVING_OP_TYPES:
+                to_visit.extend(node.outputs)
+    return cost
+
+
+def _choose_mapping(graph, edge, candidates):  # type: (Graph, Text, Sequence[List[int]]) -> List[int]
+    '''
+    The candidate mapping of "edge" adding the fewest permute layers, the first of
+    the cheapest ones on a tie and the first candidate if the converters support none
+    '''
+    costs = {}  # type: Dict[int, int]
+    for i, mapping in enumerate(candidates):
+        cost = _mapping_cost(graph, edge, mapping)
+        if cost is not None:
+            costs[i] = cost
+    if len(costs) == 0:
+        return list(candidates[0])
+    return list(candidates[min(costs, key=lambda i: (costs[i], i))])
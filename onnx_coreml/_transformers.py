@@ -3,12 +3,19 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from typing import Sequence, Text, Dict, List, Tuple
+from typing import Sequence, Text, Dict, List, Tuple, Optional, Set, Union, Iterable, Any, Callable
+from collections import OrderedDict
+import hashlib
 import numpy as np
 
 from onnx import TensorProto
 
-from ._graph import Graph, Node
+from ._graph import Graph, Node, LazyTensor
+from ._patterns import Op, Var, Chain, DAG, PatternMatcher
+from ._folding import _CONSTANT_FOLDING_REGISTRY, _BROADCASTING_OP_TYPES, _DEFAULT_MAX_FOLDED_BYTES, \
+    _fold_node, _estimate_output_nbytes, _broadcast_source, _broadcast_shape, _UNARY_OPS, \
+    _attr_or_input, _normalize_axes
+from ._shape_inference import _propagate_shapes, _update_shapes, _is_static, _ShapeValues
 
 def _get_fully_defined_shape(shape, blob_name, graph):
     if not np.any(shape == -1):
@@ -18,178 +25,301 @@ def _get_fully_defined_shape(shape, blob_name, graph):
     else:
         return graph.shape_dict[blob_name]
 
-def _remove_single_input_output_node(node):
-    for child in node.children:
-        for i, child_input in enumerate(child.inputs):
-            if child_input == node.outputs[0]:
-                # Pass input to child
-                child.inputs[i] = node.inputs[0]
-                # If input tensor is known, pass down the input tensor value
-                if node.inputs[0] in node.input_tensors:
-                    child.input_tensors[node.inputs[0]] = node.input_tensors[node.inputs[0]]
-                # Remove link as a parent from child node
-                child.parents.remove(node)
-                # Link current nodes parent and current child
-                for parent in node.parents:
-                    child.parents.append(parent)
-                    parent.children.append(child)
-                break
-
-    for parent in node.parents:
-        parent.children.remove(node)
+def _is_broadcast_by_consumers(graph, edge, shape):  # type: (Graph, Text, Sequence[int]) -> bool
+    '''
+    Whether all the consumers of the edge broadcast it against other inputs of known
+    shape that cover "shape", so that a value of any shape broadcasting to "shape"
+    can be given to them instead.
+    '''
+    consumers = graph.consumers(edge)
+    if len(consumers) == 0:
+        return False
+    for node in consumers:
+        if node.op_type not in _BROADCASTING_OP_TYPES or 'broadcast' in node.attrs:
+            return False
+        other_shape = None  # type: Optional[Tuple[int, ...]]
+        for input_ in node.inputs:
+            if input_ == edge:
+                continue
+            if input_ in node.input_tensors:
+                input_shape = node.input_tensors.get_lazy(input_).shape
+            elif input_ in graph.shape_dict:
+                input_shape = tuple(graph.shape_dict[input_])
+            else:
+                return False
+            if not all(isinstance(d, (int, np.integer)) and d > 0 for d in input_shape):
+                return False
+            other_shape = input_shape if other_shape is None else _broadcast_shape(other_shape, input_shape)
+            if other_shape is None:
+                return False
+        if other_shape is None or _broadcast_shape(other_shape, shape) != other_shape:
+            return False
+    return True
 
 class NodesFuser(object):
     '''
-    An abstract helper for merging nodes
+    An abstract helper for merging nodes.
+    Subclasses declare the nodes they fuse as a "pattern", a Chain or a DAG (see
+    _patterns), may refine it with "is_eligible" and implement "merge". Subclasses
+    fusing several forms of the same computation (e.g. other operand orderings)
+    declare them all as "patterns" instead.
     '''
+    pattern = None  # type: Union[Chain, DAG]
+    patterns = None  # type: Optional[Sequence[Union[Chain, DAG]]]
+
     def __init__(self,
-                 num_nodes,  # type: int
+                 num_nodes=None,  # type: Optional[int]
                  ):
         # type: (...) -> None
-        assert num_nodes >= 2, "Algorithm only works if fusing multiple nodes"
-        self.num_nodes = num_nodes
+        if self.patterns is not None:
+            self.pattern = self.patterns[0]
+        elif self.pattern is None:
+            assert num_nodes is not None and num_nodes >= 2, "Algorithm only works if fusing multiple nodes"
+            # any chain of "num_nodes" nodes, left to is_eligible
+            self.pattern = Chain(*[Op() for _ in range(num_nodes)])
+        if self.patterns is None:
+            self.patterns = [self.pattern]
+        self.num_nodes = len(self.pattern)
+        op_types = []  # type: List[Text]
+        for pattern in self.patterns:
+            if pattern.op_types is None:
+                op_types = None  # type: ignore
+                break
+            op_types.extend([op_type for op_type in pattern.op_types if op_type not in op_types])
+        self.op_types = None if op_types is None else tuple(op_types)
 
     def __call__(self, graph):  # type: (Graph) -> Graph
-        nodes = graph.nodes
-        merged_nodes = {}
-        for node in nodes:
-            nodes_window = []  # type: List[Node]
-            n = node
-            for _ in range(self.num_nodes - 1):
-                if len(n.parents) != 1:
-                    # We're only fusing nodes with single parents
-                    break
-                p = n.get_only_parent()
-                if len(p.children) != 1:
-                    # We can only fuse a node if its parent's
-                    # value isn't used by any other node.
-                    break
-                nodes_window.insert(0, n)
-                n = p
-            if len(nodes_window) > 0:
-                # add parent of chained nodes
-                first = nodes_window[0]
-                p = first.get_only_parent()
-                if len(p.children) == 1:
-                    nodes_window.insert(0, p)
-            if len(nodes_window) != self.num_nodes:
-                continue
-            if not self.is_eligible(graph, nodes_window):
-                continue
-            merged = self.merge(graph, nodes_window)
-            first, last = nodes_window[0], nodes_window[-1]
-            for parent in first.parents:
-                parent.children.remove(first)
-                if merged[0] not in parent.children:
-                    parent.add_child(merged[0])
-            for child in last.children:
-                child.parents.remove(last)
-                if merged[-1] not in child.parents:
-                    child.add_parent(merged[-1])
-            for n in nodes_window:
-                merged_nodes[n.name] = merged
-
-        transformed_nodes = []
-        added_merged = []  # type: List[Node]
-        for node in nodes:
-            if node.name in merged_nodes:
-                merged = merged_nodes[node.name]
-                if merged[0] not in added_merged:
-                    for n in merged:
-                        transformed_nodes.append(n)
-                    added_merged.append(merged[0])
-            else:
-                transformed_nodes.append(node)
-        return graph.create_graph(nodes=transformed_nodes)
+        return FuserGroup([self])(graph)
 
     def is_eligible(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> bool
-        '''Returns true if this subset of nodes is eligible for fusion.'''
-        raise NotImplementedError('Must be implemented by subclass.')
+        '''Returns true if this subset of nodes, matching the pattern, is eligible for fusion.'''
+        return True
 
     def merge(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> Sequence[Node]
         '''Merge nodes'''
-        nodes[0].outputs = nodes[-1].outputs
+        graph.set_outputs(nodes[0], nodes[-1].outputs)
         return [nodes[0]]
 
+class FuserGroup(object):
+    '''
+    Runs several NodesFusers in a single traversal of the graph. At each node, the
+    patterns of the fusers are tried in order and the first eligible match is merged.
+    '''
+    def __init__(self,
+                 fusers,  # type: Sequence[NodesFuser]
+                 ):
+        # type: (...) -> None
+        self.fusers = list(fusers)
+        # the fuser of each pattern of the matcher
+        self.pattern_fusers = [fuser for fuser in self.fusers for _ in fuser.patterns]
+        self.matcher = PatternMatcher([pattern for fuser in self.fusers for pattern in fuser.patterns])
+        op_types = []  # type: List[Text]
+        for fuser in self.fusers:
+            if fuser.op_types is None:
+                op_types = None  # type: ignore
+                break
+            op_types.extend([op_type for op_type in fuser.op_types if op_type not in op_types])
+        self.op_types = None if op_types is None else tuple(op_types)
+
+    def __call__(self, graph):  # type: (Graph) -> Graph
+        replacements = []  # type: List[Tuple[Sequence[Node], Sequence[Node]]]
+        removed = set()  # type: Set[Node]
+        for node in self.matcher.candidates(graph):
+            if node in removed:
+                continue
+            for i, nodes_window in self.matcher.matches(graph, node):
+                fuser = self.pattern_fusers[i]
+                if not fuser.is_eligible(graph, nodes_window):
+                    continue
+                merged = fuser.merge(graph, nodes_window)
+                # relink right away: the following matches are found from the links
+                graph.rewire_subgraph(nodes_window, merged)
+                replacements.append((nodes_window, merged))
+                removed.update(set(nodes_window).difference(merged))
+                break
+        return graph.apply_replacements(replacements)
+
+def _has_constant_bias(graph, node):  # type: (Graph, Node) -> bool
+    return len(node.inputs) <= 2 or node.inputs[2] in node.input_tensors
+
+def _is_vector(tensor):  # type: (np.ndarray) -> bool
+    return len(np.squeeze(tensor).shape) == 1
+
+# ops with constant weights whose output channels (along axis 1) can absorb a per-channel scale and shift
+_WEIGHTED_OP_TYPES = ('Conv', 'ConvTranspose', 'Gemm')
+
+def _output_channels(node):  # type: (Node) -> int
+    W = node.input_tensors.get_lazy(node.inputs[1])
+    if node.op_type == 'Conv':
+        return W.shape[0]
+    if node.op_type == 'ConvTranspose':
+        return W.shape[1] * node.attrs.get('group', 1)
+    return W.shape[0] if node.attrs.get('transB', 0) else W.shape[1]
+
+def _output_rank(node):  # type: (Node) -> int
+    if node.op_type == 'Gemm':
+        return 2
+    return len(node.input_tensors.get_lazy(node.inputs[1]).shape)
+
+def _per_channel_vector(parent, child, value):  # type: (Node, Node, np.ndarray) -> Optional[np.ndarray]
+    '''
+    Returns the constant input of the child, broadcast against the output of the parent,
+    as a vector of one value per output channel of the parent. None if it isn't constant
+    along the other axes.
+    '''
+    rank = _output_rank(parent)
+    channels = _output_channels(parent)
+    value = np.asarray(value)
+    if child.attrs.get('broadcast', 0) and 'axis' in child.attrs:
+        # broadcasting before opset 7 aligns the value on "axis"
+        axis = child.attrs['axis']
+        axis = axis + rank if axis < 0 else axis
+        value = value.reshape(value.shape + (1,) * (rank - axis - value.ndim))
+    if value.ndim > rank:
+        return None
+    shape = (1,) * (rank - value.ndim) + value.shape
+    if shape[0] != 1 or any(d != 1 for d in shape[2:]) or shape[1] not in (1, channels):
+        return None
+    return np.ones((channels,), dtype=value.dtype) * value.reshape(-1)
+
+def _constant_input_index(node):  # type: (Node) -> Optional[int]
+    '''Index of the constant input of a binary op, if exactly one is constant'''
+    constant = [i for i, input_ in enumerate(node.inputs) if input_ in node.input_tensors]
+    if len(node.inputs) != 2 or len(constant) != 1:
+        return None
+    return constant[0]
+
+def _set_constant_input(graph, node, i, value):  # type: (Graph, Node, int, np.ndarray) -> None
+    '''Sets the value of the i-th input of the node, without changing it for other nodes using it'''
+    name = node.inputs[i]
+    if len(graph.consumers(name)) > 1:
+        new_name = graph.get_unique_edge_name(name)
+        graph.set_input(node, i, new_name)
+        if name not in node.inputs:
+            del node.input_tensors[name]
+        name = new_name
+    node.input_tensors[name] = value
+    graph.touch([node])
+
+def _scale_output_channels(graph, node, scale):  # type: (Graph, Node, np.ndarray) -> None
+    '''Multiplies each output channel of a Conv, ConvTranspose or Gemm node by "scale"'''
+    W = node.input_tensors[node.inputs[1]]
+    if node.op_type == 'Conv':
+        scaled_W = W * scale.reshape((-1,) + (1,) * (W.ndim - 1))
+    elif node.op_type == 'ConvTranspose':
+        group = node.attrs.get('group', 1)
+        grouped_shape = (group, W.shape[0] // group) + W.shape[1:]
+        grouped_scale = scale.reshape((group, 1, W.shape[1]) + (1,) * (W.ndim - 2))
+        scaled_W = (W.reshape(grouped_shape) * grouped_scale).reshape(W.shape)
+    elif node.attrs.get('transB', 0):
+        scaled_W = W * scale.reshape((-1, 1))
+    else:
+        scaled_W = W * scale.reshape((1, -1))
+    _set_constant_input(graph, node, 1, scaled_W.astype(W.dtype))
+    if len(node.inputs) > 2 and node.inputs[2] != '':
+        bias = node.input_tensors[node.inputs[2]]
+        _set_constant_input(graph, node, 2, (bias * scale).astype(bias.dtype))
+
+def _shift_output_channels(graph, node, shift):  # type: (Graph, Node, np.ndarray) -> None
+    '''Adds "shift" to each output channel of a Conv, ConvTranspose or Gemm node'''
+    if len(node.inputs) > 2 and node.inputs[2] != '':
+        bias = node.input_tensors[node.inputs[2]]
+        if node.op_type == 'Gemm':
+            # alpha * A * B + beta * C + shift == alpha * A * B + 1 * (beta * C + shift)
+            bias = node.attrs.get('beta', 1.0) * bias
+            node.attrs['beta'] = 1.0
+        _set_constant_input(graph, node, 2, (bias + shift).astype(bias.dtype))
+    else:
+        W = node.input_tensors.get_lazy(node.inputs[1])
+        bias_name = graph.get_unique_edge_name("{}_bias".format(node.name,))
+        graph.set_inputs(node, node.inputs[:2] + [bias_name])
+        if node.op_type == 'Gemm':
+            node.attrs['beta'] = 1.0
+        node.input_tensors[bias_name] = shift.astype(W.dtype)
+
 class ConvAddFuser(NodesFuser):
     '''
-    Fuses Add layer into parent convolution layer.
+    Fuses Add of a per-channel constant into parent convolution (or Gemm) layer bias.
     '''
-    def __init__(self):  # type: () -> None
-        super(ConvAddFuser, self).__init__(2)
+    pattern = Chain(
+        Op(_WEIGHTED_OP_TYPES, const_inputs=[1], predicate=_has_constant_bias),
+        Op('Add', num_inputs=2),
+    )
 
     def is_eligible(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> bool
         parent, child = nodes[0], nodes[1]
-        if parent.op_type != 'Conv':
-            return False
-        if child.op_type != 'Add':
-            return False
-        if 'broadcast' not in child.attrs:
-            return False
-        if 'axis' not in child.attrs:
-            return False
-        if parent.inputs[1] not in parent.input_tensors:
-            return False
-        if len(parent.inputs) > 2 and parent.inputs[2] not in parent.input_tensors:
-            return False
-        if child.inputs[1] not in child.input_tensors:
+        i = _constant_input_index(child)
+        if i is None or (i == 0 and 'broadcast' in child.attrs):
             return False
+        return _per_channel_vector(parent, child, child.input_tensors[child.inputs[i]]) is not None
 
-        broadcast = child.attrs['broadcast']
-        if broadcast != 1:
-            return False
+    def merge(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> Sequence[Node]
+        parent, child = nodes[0], nodes[1]
+        i = _constant_input_index(child)
+        shift = _per_channel_vector(parent, child, child.input_tensors[child.inputs[i]])
+        _shift_output_channels(graph, parent, shift)
+        graph.set_outputs(parent, child.outputs)
+        return [parent]
 
-        axis = child.attrs['axis']
-        if axis != 1:
-            return False
+class ConvMulFuser(NodesFuser):
+    '''
+    Fuses Mul by a per-channel constant into parent convolution (or Gemm) layer weights and bias.
+    '''
+    pattern = Chain(
+        Op(_WEIGHTED_OP_TYPES, const_inputs=[1], predicate=_has_constant_bias),
+        Op('Mul', num_inputs=2),
+    )
 
-        return True
+    def is_eligible(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> bool
+        parent, child = nodes[0], nodes[1]
+        i = _constant_input_index(child)
+        if i is None or (i == 0 and 'broadcast' in child.attrs):
+            return False
+        return _per_channel_vector(parent, child, child.input_tensors[child.inputs[i]]) is not None
 
     def merge(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> Sequence[Node]
         parent, child = nodes[0], nodes[1]
-        output_channels = parent.input_tensors[parent.inputs[1]].shape[0]
-        if len(parent.inputs) > 2:
-            bias_input_name = parent.inputs[2]
-            bias = parent.input_tensors[bias_input_name]
-        else:
-            bias_input_name = "{}_bias".format(parent.name,)
-            parent.inputs.append(bias_input_name)
-            bias = np.zeros(
-                (output_channels,), dtype=np.float32
-            )
-            parent.input_tensors[bias_input_name] = bias
-        bias = bias + child.input_tensors[child.inputs[1]]
-        parent.input_tensors[bias_input_name] = bias
-        parent.outputs = child.outputs
-        parent.children.remove(child)
-        child.parents.remove(parent)
+        i = _constant_input_index(child)
+        scale = _per_channel_vector(parent, child, child.input_tensors[child.inputs[i]])
+        _scale_output_channels(graph, parent, scale)
+        graph.set_outputs(parent, child.outputs)
         return [parent]
 
-class BNBroadcastedMulFuser(NodesFuser):
+def _is_inference_batchnorm(graph, node):  # type: (Graph, Node) -> bool
+    # no running statistics outputs, and normalization over the channel axis only
+    return len(node.outputs) == 1 and node.attrs.get('spatial', 1) == 1
+
+class ConvBNFuser(NodesFuser):
     '''
-    Fuses Mul into BatchNorm
+    Folds inference BatchNormalization into parent convolution (or Gemm) layer weights and bias.
     '''
-    def __init__(self):  # type: () -> None
-        super(BNBroadcastedMulFuser, self).__init__(2)
+    pattern = Chain(
+        Op(_WEIGHTED_OP_TYPES, const_inputs=[1], predicate=_has_constant_bias),
+        Op('BatchNormalization', const_inputs=[1, 2, 3, 4], predicate=_is_inference_batchnorm),
+    )
 
     def is_eligible(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> bool
         parent, child = nodes[0], nodes[1]
-        if parent.op_type != 'BatchNormalization':
-            return False
-        if child.op_type != 'Mul':
-            return False
-        if len(child.inputs) != 2:
-            return False
-        if child.inputs[1] not in child.input_tensors:
-            return False
-        t = child.input_tensors[child.inputs[1]]
-        if len(np.squeeze(t).shape) != 1:
-            return False
-        if parent.inputs[1] not in parent.input_tensors:
-            return False
-        if parent.inputs[2] not in parent.input_tensors:
-            return False
-        return True
+        channels = _output_channels(parent)
+        return all(child.input_tensors.get_lazy(input_).shape == (channels,) for input_ in child.inputs[1:])
+
+    def merge(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> Sequence[Node]
+        parent, child = nodes[0], nodes[1]
+        gamma, beta, mean, var = [child.input_tensors[input_].astype(np.float64) for input_ in child.inputs[1:5]]
+        scale = gamma / np.sqrt(var + child.attrs.get('epsilon', 1e-5))
+        _scale_output_channels(graph, parent, scale)
+        _shift_output_channels(graph, parent, beta - mean * scale)
+        graph.set_outputs(parent, child.outputs)
+        return [parent]
+
+class BNBroadcastedMulFuser(NodesFuser):
+    '''
+    Fuses Mul into BatchNorm
+    '''
+    pattern = Chain(
+        Op('BatchNormalization', const_inputs=[1, 2]),
+        Op('Mul', num_inputs=2, const_inputs={1: _is_vector}),
+    )
 
     def merge(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> Sequence[Node]
         parent, child = nodes[0], nodes[1]
@@ -198,63 +328,35 @@ class BNBroadcastedMulFuser(NodesFuser):
         W = np.squeeze(child.input_tensors[child.inputs[1]])
         parent.input_tensors[parent.inputs[1]] = np.multiply(weight, W)
         parent.input_tensors[parent.inputs[2]] = np.multiply(bias, W)
-        parent.outputs = child.outputs
-        parent.children.remove(child)
-        child.parents.remove(parent)
+        graph.set_outputs(parent, child.outputs)
         return [parent]
 
 class BNBroadcastedAddFuser(NodesFuser):
     '''
     Fuses Add into BatchNorm
     '''
-    def __init__(self):  # type: () -> None
-        super(BNBroadcastedAddFuser, self).__init__(2)
-
-    def is_eligible(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> bool
-        parent, child = nodes[0], nodes[1]
-        if parent.op_type != 'BatchNormalization':
-            return False
-        if child.op_type != 'Add':
-            return False
-        if len(child.inputs) != 2:
-            return False
-        if child.inputs[1] not in child.input_tensors:
-            return False
-        t = child.input_tensors[child.inputs[1]]
-        if len(np.squeeze(t).shape) != 1:
-            return False
-        if parent.inputs[1] not in parent.input_tensors:
-            return False
-        if parent.inputs[2] not in parent.input_tensors:
-            return False
-        return True
+    pattern = Chain(
+        Op('BatchNormalization', const_inputs=[1, 2]),
+        Op('Add', num_inputs=2, const_inputs={1: _is_vector}),
+    )
 
     def merge(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> Sequence[Node]
         parent, child = nodes[0], nodes[1]
         bias = parent.input_tensors[parent.inputs[2]]
         b = np.squeeze(child.input_tensors[child.inputs[1]])
         parent.input_tensors[parent.inputs[2]] = bias + b
-        parent.outputs = child.outputs
-        parent.children.remove(child)
-        child.parents.remove(parent)
+        graph.set_outputs(parent, child.outputs)
         return [parent]
 
 class DropoutRemover(NodesFuser):
     '''
     Removes Dropout layer
     '''
-    def __init__(self):  # type: () -> None
-        super(DropoutRemover, self).__init__(2)
-
-    def is_eligible(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> bool
-        child = nodes[1]
-        return child.op_type == "Dropout"
+    pattern = Chain(Op(), Op('Dropout'))
 
     def merge(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> Sequence[Node]
         parent, child = nodes[0], nodes[1]
-        parent.children.remove(child)
-        child.parents.remove(parent)
-        parent.outputs = [child.outputs[0]]
+        graph.set_outputs(parent, [child.outputs[0]])
         return [parent]
 
 class ReshapeInitTensorFuser(object):
@@ -262,13 +364,11 @@ class ReshapeInitTensorFuser(object):
     Fuses Reshape operator if it is used only to reshape blob in
     graph initializer. We can reshape here instead of runtime.
     '''
+    op_types = ('Reshape',)
 
     def __call__(self, graph):  # type: (Graph) -> Graph
-        nodes = graph.nodes
         removed = []
-        for node in nodes:
-            if node.op_type != 'Reshape':
-                continue
+        for node in graph.nodes_to_visit(self.op_types):
             if not (len(node.input_tensors) == 2 or len(node.input_tensors) == 1):
                 continue
             tensor_name = node.inputs[0]
@@ -287,7 +387,6 @@ class ReshapeInitTensorFuser(object):
             if is_non_constant_parent:
                 continue
 
-            removed.append(node)
             output_name = node.outputs[0]
 
             tensor = node.input_tensors[tensor_name]
@@ -303,14 +402,13 @@ class ReshapeInitTensorFuser(object):
             if any([s == 0 for s in shape]):
                 continue
 
-            reshaped_tensor = tensor.reshape(shape.astype(int))
+            reshaped_tensor = tensor.reshape(np.asarray(shape).astype(int))
 
+            removed.append(node)
             for child in node.children:
-                child.parents.remove(node)
                 child.input_tensors[output_name] = reshaped_tensor
 
-        transformed_nodes = [node for node in nodes if node not in removed]
-        return graph.create_graph(nodes=transformed_nodes)
+        return graph.remove_nodes(removed)
 
 class OutputRenamer(object):
     '''
@@ -323,43 +421,33 @@ class OutputRenamer(object):
         self.mapping = mapping
 
     def __call__(self, graph):  # type: (Graph) -> Graph
-        mapping = self.mapping.copy()
-        nodes = graph.nodes
-        for node in nodes:
-            for i in range(len(node.outputs)):
-                output = node.outputs[i]
-                if output not in mapping:
-                    continue
-                node.outputs[i] = mapping[output]
-                for child in node.children:
-                    for j in range(len(child.inputs)):
-                        input_ = child.inputs[j]
-                        if input_ != output:
-                            continue
-                        child.inputs[j] = mapping[output]
-                del mapping[output]
-                if len(mapping) == 0:
-                    break
+        for output, new_name in self.mapping.items():
+            node = graph.producer(output)
+            if node is None:
+                continue
+            for child in graph.consumers(output):
+                for j in range(len(child.inputs)):
+                    if child.inputs[j] == output:
+                        graph.set_input(child, j, new_name)
+            graph.set_outputs(node, [new_name if output_ == output else output_ for output_ in node.outputs])
         return graph
 
 class ReshapeTransposeReshape_pattern1(NodesFuser):
     '''
     Detects certain types of patterns of "reshape-> (rank 6) -> transpose (rank 6) -> reshape (rank 4)" that can be converted
     '''
+    # shape given as a constant input: old versions of the onnx Reshape op had it as an attribute
+    pattern = Chain(
+        Op('Reshape', const_inputs=[1]),
+        Op('Transpose'),
+        Op('Reshape', const_inputs=[1]),
+    )
+
     def __init__(self):  # type: () -> None
-        super(ReshapeTransposeReshape_pattern1, self).__init__(3)
+        super(ReshapeTransposeReshape_pattern1, self).__init__()
         self.num_added = 0
 
     def is_eligible(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> bool
-        if not (nodes[0].op_type == 'Reshape' and nodes[1].op_type == 'Transpose' and nodes[2].op_type == 'Reshape'):
-            return False
-        if len(nodes[0].inputs) == 1 or len(nodes[2].inputs) == 1:
-            return False # it's an old version of onnx Reshape op that had shape as an attribute
-        if nodes[0].inputs[1] not in nodes[0].input_tensors:
-            return False
-        if nodes[2].inputs[1] not in nodes[2].input_tensors:
-            return False
-
         shape_1 = nodes[0].input_tensors[nodes[0].inputs[1]]
         shape_final = nodes[2].input_tensors[nodes[2].inputs[1]]
 
@@ -435,20 +523,17 @@ class ReshapeTransposeReshape_pattern1(NodesFuser):
         return [reshape_1, transpose_1, final_reshape]
 
 class PixelShuffleFuser(NodesFuser):
+    pattern = Chain(
+        Op('Reshape', const_inputs=[1]),
+        Op('Transpose', attrs={'perm': [0, 1, 4, 2, 5, 3]}),
+        Op('Reshape', const_inputs=[1]),
+    )
+
     def __init__(self):  # type: () -> None
-        super(PixelShuffleFuser, self).__init__(3)
+        super(PixelShuffleFuser, self).__init__()
         self.num_added = 0
 
     def is_eligible(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> bool
-        if not (nodes[0].op_type == 'Reshape' and nodes[1].op_type == 'Transpose' and nodes[2].op_type == 'Reshape'):
-            return False
-        if len(nodes[0].inputs) == 1 or len(nodes[2].inputs) == 1:
-            return False # it's an old version of onnx Reshape op that had shape as an attribute
-        if nodes[0].inputs[1] not in nodes[0].input_tensors:
-            return False
-        if nodes[2].inputs[1] not in nodes[2].input_tensors:
-            return False
-
         shape_1 = nodes[0].input_tensors[nodes[0].inputs[1]]
         shape_final = nodes[2].input_tensors[nodes[2].inputs[1]]
 
@@ -458,9 +543,6 @@ class PixelShuffleFuser(NodesFuser):
         if len(shape_1) != 6 or shape_1[0] != 1 or len(shape_final) != 4:
             return False
 
-        if nodes[1].attrs.get('perm', []) != [0, 1, 4, 2, 5, 3]:
-            return False
-
         return True
 
     def get_unique_edge_name(self, graph, name):  # type: (Graph, Text) -> Text
@@ -497,15 +579,14 @@ class PixelShuffleFuser(NodesFuser):
         reshape_1.input_tensors[reshape_1.inputs[1]] = np.asarray([x1, x2, x3, x4 * x5])
 
         # first transpose
-        transpose_1.children = []
         transpose_1.attrs['perm'] = [0, 3, 1, 2]
 
         reshape_output_name = final_reshape.name + '_pixel_shuffle_reshape'
         transpose_output_name = final_reshape.name + '_pixel_shuffle_transpose'
 
-        transpose_1.outputs = [
+        graph.set_outputs(transpose_1, [
             self.get_unique_edge_name(graph, transpose_output_name)
-        ]
+        ])
 
         shape_name_second_reshape = self.get_unique_edge_name(graph, reshape_output_name)
         output_name_second_reshape = self.get_unique_edge_name(graph, reshape_output_name)
@@ -519,7 +600,6 @@ class PixelShuffleFuser(NodesFuser):
             [output_name_second_reshape]
         )
         reshape_2.input_tensors[shape_name_second_reshape] = np.asarray([x1 * x4, x5, x2, x3])
-        transpose_1.add_child(reshape_2)
 
         # second transpose
         transpose_2 = Node(
@@ -529,23 +609,904 @@ class PixelShuffleFuser(NodesFuser):
             reshape_2.outputs,
             [self.get_unique_edge_name(graph, transpose_output_name)]
         )
-        reshape_2.add_child(transpose_2)
 
         # third reshape
-        final_reshape.inputs = [transpose_2.outputs[0], nodes[2].inputs[1]]
-        final_reshape.parents = []
-        transpose_2.add_child(final_reshape)
+        graph.set_inputs(final_reshape, [transpose_2.outputs[0], nodes[2].inputs[1]])
 
         return [reshape_1, transpose_1, reshape_2, transpose_2, final_reshape]
 
+def _is_scalar(value):  # type: (float) -> Callable[[np.ndarray], bool]
+    '''Predicate of a constant tensor holding a single value close to "value"'''
+    return lambda tensor: np.size(tensor) == 1 and bool(np.isclose(np.asarray(tensor).reshape(-1)[0], value))
+
+def _is_square(graph, node):  # type: (Graph, Node) -> bool
+    if node.op_type == 'Mul':
+        return node.inputs[0] == node.inputs[1]
+    return node.inputs[1] in node.input_tensors and _is_scalar(2.)(node.input_tensors[node.inputs[1]])
+
+class LayerNormFuser(NodesFuser):
+    '''
+    Fuses the primitives layer normalization is exported as,
+        (x - mean(x)) / sqrt(mean((x - mean(x)) ** 2) + epsilon)
+    with the means over the last axes, into a LayerNormalization node. The scale
+    and bias applied afterwards are folded in by LayerNormAffineFuser.
+    '''
+    pattern = DAG([
+        ('mean', Op('ReduceMean', inputs=[Var('x')])),
+        ('sub', Op('Sub', inputs=[Var('x'), 'mean'])),
+        ('square', Op(('Pow', 'Mul'), inputs=['sub', None], predicate=_is_square)),
+        ('variance', Op('ReduceMean', inputs=['square'])),
+        ('add_epsilon', Op('Add', inputs=['variance', None], const_inputs={1: lambda t: np.size(t) == 1})),
+        ('sqrt', Op('Sqrt', inputs=['add_epsilon'])),
+        ('div', Op('Div', inputs=['sub', 'sqrt'])),
+    ])
+
+    @staticmethod
+    def _normalized_shape(graph, nodes):  # type: (Graph, Sequence[Node]) -> Optional[Tuple[int, ...]]
+        '''Shape of the normalized axes, if they are the last ones and are static'''
+        shape = graph.shape_dict.get(nodes.inputs['x'])  # type: ignore
+        if shape is None:
+            return None
+        axes = []
+        for reduce in (nodes.nodes['mean'], nodes.nodes['variance']):  # type: ignore
+            if reduce.attrs.get('keepdims', 1) != 1 or 'axes' not in reduce.attrs:
+                return None
+            axes.append(sorted(_normalize_axes(reduce.attrs['axes'], len(shape))))
+        if axes[0] != axes[1] or axes[0] != list(range(len(shape) - len(axes[0]), len(shape))):
+            return None
+        normalized_shape = tuple(shape[len(shape) - len(axes[0]):])
+        return normalized_shape if _is_static_shape(normalized_shape) else None
+
+    def is_eligible(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> bool
+        return self._normalized_shape(graph, nodes) is not None
+
+    def merge(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> Sequence[Node]
+        normalized_shape = self._normalized_shape(graph, nodes)
+        add_epsilon, div = nodes.nodes['add_epsilon'], nodes.nodes['div']  # type: ignore
+        epsilon = float(np.asarray(add_epsilon.input_tensors[add_epsilon.inputs[1]]).reshape(-1)[0])
+        scale_name = graph.get_unique_edge_name("{}_scale".format(div.name))
+        bias_name = graph.get_unique_edge_name("{}_bias".format(div.name))
+        layer_norm = Node(div.name, 'LayerNormalization',
+                          {'axis': -len(normalized_shape), 'epsilon': epsilon},  # type: ignore
+                          [nodes.inputs['x'], scale_name, bias_name], div.outputs)  # type: ignore
+        layer_norm.input_tensors[scale_name] = np.ones(normalized_shape, dtype=np.float32)
+        layer_norm.input_tensors[bias_name] = np.zeros(normalized_shape, dtype=np.float32)
+        return [layer_norm]
+
+class LayerNormAffineFuser(NodesFuser):
+    '''
+    Folds the multiplication by a constant scale and the addition of a constant bias
+    following a LayerNormalization into its scale and bias.
+    '''
+    pattern = Chain(
+        Op('LayerNormalization', const_inputs=[1, 2]),
+        Op(('Mul', 'Add'), num_inputs=2),
+    )
+
+    @staticmethod
+    def _affine_value(nodes):  # type: (Sequence[Node]) -> Optional[np.ndarray]
+        '''The constant of the Mul or Add, broadcast to the shape of the scale'''
+        layer_norm, child = nodes[0], nodes[1]
+        i = _constant_input_index(child)
+        if i is None or 'broadcast' in child.attrs:
+            return None
+        value = np.asarray(child.input_tensors[child.inputs[i]])
+        shape = layer_norm.input_tensors.get_lazy(layer_norm.inputs[1]).shape
+        # the constant can only vary along the normalized axes
+        if any(d != 1 for d in value.shape[:max(value.ndim - len(shape), 0)]):
+            return None
+        value = value.reshape(value.shape[max(value.ndim - len(shape), 0):])
+        if _broadcast_shape(shape, value.shape) != tuple(shape):
+            return None
+        return np.broadcast_to(value, shape)
+
+    def is_eligible(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> bool
+        return self._affine_value(nodes) is not None
+
+    def merge(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> Sequence[Node]
+        layer_norm, child = nodes[0], nodes[1]
+        value = self._affine_value(nodes)
+        scale = layer_norm.input_tensors[layer_norm.inputs[1]]
+        bias = layer_norm.input_tensors[layer_norm.inputs[2]]
+        if child.op_type == 'Mul':
+            _set_constant_input(graph, layer_norm, 1, (scale * value).astype(scale.dtype))
+            _set_constant_input(graph, layer_norm, 2, (bias * value).astype(bias.dtype))
+        else:
+            _set_constant_input(graph, layer_norm, 2, (bias + value).astype(bias.dtype))
+        graph.set_outputs(layer_norm, child.outputs)
+        return [layer_norm]
+
+def _is_scaled_by_inverse_sqrt2(graph, node):  # type: (Graph, Node) -> bool
+    if node.inputs[1] not in node.input_tensors:
+        return False
+    value = node.input_tensors[node.inputs[1]]
+    return _is_scalar(np.sqrt(2.) if node.op_type == 'Div' else np.sqrt(.5))(value)
+
+def _has_scalar_input(value):  # type: (float) -> Callable[[Graph, Node], bool]
+    '''Predicate of a node with a constant input, at any index, holding a single value close to "value"'''
+    is_value = _is_scalar(value)
+    return lambda graph, node: any(input_ in node.input_tensors and is_value(node.input_tensors[input_])
+                                   for input_ in node.inputs)
+
+class GeluFuser(NodesFuser):
+    '''
+    Fuses the primitives GELU is exported as, x * (1 + erf(x / sqrt(2))) * 0.5,
+    into a Gelu node. The multiplication by 0.5 may come first, as in
+    x * 0.5 * (1 + erf(x / sqrt(2))), and the constants may be either operand
+    of the Add and Mul nodes.
+    '''
+    patterns = [
+        DAG([
+            ('scale', Op(('Div', 'Mul'), inputs=[Var('x'), None], predicate=_is_scaled_by_inverse_sqrt2)),
+            ('erf', Op('Erf', inputs=['scale'])),
+            ('add_one', Op('Add', inputs=['erf', None], predicate=_has_scalar_input(1.), commutative=True)),
+            ('mul', Op('Mul', inputs=[Var('x'), 'add_one'], commutative=True)),
+            ('half', Op('Mul', inputs=['mul', None], predicate=_has_scalar_input(.5), commutative=True)),
+        ]),
+        DAG([
+            ('scale', Op(('Div', 'Mul'), inputs=[Var('x'), None], predicate=_is_scaled_by_inverse_sqrt2)),
+            ('erf', Op('Erf', inputs=['scale'])),
+            ('add_one', Op('Add', inputs=['erf', None], predicate=_has_scalar_input(1.), commutative=True)),
+            ('half', Op('Mul', inputs=[Var('x'), None], predicate=_has_scalar_input(.5), commutative=True)),
+            ('mul', Op('Mul', inputs=['half', 'add_one'], commutative=True)),
+        ]),
+    ]
+
+    def merge(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> Sequence[Node]
+        last = nodes[-1]
+        return [Node(last.name, 'Gelu', {'approximate': 'none'}, [nodes.inputs['x']], last.outputs)]  # type: ignore
+
+def _pad_params(pad):  # type: (Node) -> Optional[Tuple[List[int], float]]
+    '''Pads and value of a constant mode Pad, None if they aren't known'''
+    mode = pad.attrs.get('mode', 'constant')
+    if (mode.decode('utf8') if isinstance(mode, bytes) else mode) != 'constant' or len(pad.inputs) > 3:
+        return None
+    inputs = [pad.input_tensors.get(input_) for input_ in pad.inputs]
+    pads = _attr_or_input(pad, inputs, 'pads', 1)
+    if pads is None:
+        return None
+    if 'value' in pad.attrs:
+        value = float(pad.attrs['value'])
+    elif len(inputs) > 2 and pad.inputs[2] != '':
+        if inputs[2] is None:
+            return None
+        value = float(np.asarray(inputs[2]).reshape(-1)[0])
+    else:
+        value = 0.
+    return pads, value
+
+class PadFuser(NodesFuser):
+    '''
+    Folds a constant Pad into the "pads" of the Conv, MaxPool or AveragePool it only
+    feeds, when the padding value is the one the consumer pads with implicitly:
+    zero for Conv and AveragePool (counting the padded area), -inf for MaxPool.
+    Only the spatial axes may be padded, by at most 2 of them.
+    '''
+    pattern = Chain(
+        Op('Pad'),
+        Op(('Conv', 'MaxPool', 'AveragePool')),
+    )
+
+    @staticmethod
+    def _merged_pads(nodes):  # type: (Sequence[Node]) -> Optional[List[int]]
+        pad, child = nodes[0], nodes[1]
+        params = _pad_params(pad)
+        if params is None:
+            return None
+        pads, value = params
+        rank = len(pads) // 2
+        if rank < 3 or rank > 4 or any(p < 0 for p in pads):
+            return None
+        # no padding of the batch and channel axes
+        if any(pads[i] != 0 for i in (0, 1, rank, rank + 1)):
+            return None
+        if child.op_type == 'MaxPool':
+            if not value <= np.finfo(np.float32).min:
+                return None
+        elif value != 0 or (child.op_type == 'AveragePool' and child.attrs.get('count_include_pad', 0) != 1):
+            return None
+        auto_pad = child.attrs.get('auto_pad', 'NOTSET')
+        if (auto_pad.decode('utf8') if isinstance(auto_pad, bytes) else auto_pad) not in ('NOTSET', 'VALID'):
+            return None
+        spatial_rank = rank - 2
+        child_pads = list(child.attrs.get('pads', [0] * 2 * spatial_rank))
+        if len(child_pads) != 2 * spatial_rank:
+            return None
+        begins = [child_pads[i] + pads[2 + i] for i in range(spatial_rank)]
+        ends = [child_pads[spatial_rank + i] + pads[rank + 2 + i] for i in range(spatial_rank)]
+        return begins + ends
+
+    def is_eligible(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> bool
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
+        return nodes[0].outputs[0] not in output_names and self._merged_pads(nodes) is not None
+
+    def merge(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> Sequence[Node]
+        pad, child = nodes[0], nodes[1]
+        child.attrs['pads'] = self._merged_pads(nodes)
+        child.attrs.pop('auto_pad', None)
+        graph.set_input(child, 0, pad.inputs[0])
+        return [child]
+
+def _digest(value):  # type: (np.ndarray) -> Tuple[Any, ...]
+    value = np.ascontiguousarray(value)
+    return (str(value.dtype), value.shape, hashlib.sha1(value.tobytes()).hexdigest())
+
+def _attr_key(value):  # type: (Any) -> Any
+    if isinstance(value, np.ndarray):
+        return _digest(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_attr_key(v) for v in value)
+    return repr(value)
+
+def _attrs_key(node):  # type: (Node) -> Tuple[Any, ...]
+    return tuple(sorted((name, _attr_key(value)) for name, value in node.attrs.items()))
+
+class SiblingFuser(object):
+    '''
+    Horizontal fusion: Conv, MatMul or Gemm nodes with constant weights applied to the
+    same input with the same attributes (e.g. the Q, K and V projections of attention,
+    the 1x1 convolutions of an inception block) are merged into a single wider node
+    with concatenated weights, followed by a Split giving back the original outputs.
+    A constant bias Add following each of the MatMul nodes is merged as well.
+
+    The Split layer of the rank-5 mapping only supports equal splits, "equal_splits_only"
+    restricts the fusion to siblings with the same number of output channels.
+    '''
+    op_types = ('Conv', 'MatMul', 'Gemm')
+
+    def __init__(self, equal_splits_only=False):  # type: (bool) -> None
+        self.equal_splits_only = equal_splits_only
+
+    def _key(self, graph, node):  # type: (Graph, Node) -> Optional[Tuple[Any, ...]]
+        '''Nodes with the same key can be fused, None if the node can't be fused'''
+        if len(node.inputs) < 2 or len(node.outputs) != 1 or node.inputs[1] not in node.input_tensors:
+            return None
+        if node.inputs[0] in node.input_tensors or not _has_constant_bias(graph, node):
+            return None
+        W = node.input_tensors.get_lazy(node.inputs[1])
+        if node.op_type == 'Conv':
+            if node.attrs.get('group', 1) != 1:
+                return None
+            weight_shape = tuple(W.shape[1:])
+        elif node.op_type == 'Gemm':
+            weight_shape = (W.shape[1],) if node.attrs.get('transB', 0) else (W.shape[0],)
+            if len(node.inputs) > 2 and node.inputs[2] != '' and \
+                    self._gemm_bias(node, 1) is None:
+                return None
+        else:
+            if len(W.shape) != 2 or self._rank(graph, node) == 0:
+                return None
+            weight_shape = (W.shape[0],)
+        return (node.inputs[0], node.op_type, _attrs_key(node), weight_shape)
+
+    @staticmethod
+    def _rank(graph, node):  # type: (Graph, Node) -> int
+        '''Rank of the output of a MatMul node with a matrix as weights, 0 if unknown'''
+        shape = graph.shape_dict.get(node.outputs[0], graph.shape_dict.get(node.inputs[0], ()))
+        return len(shape)
+
+    @staticmethod
+    def _width(node):  # type: (Node) -> int
+        W = node.input_tensors.get_lazy(node.inputs[1])
+        if node.op_type == 'Conv' or (node.op_type == 'Gemm' and node.attrs.get('transB', 0)):
+            return W.shape[0]
+        return W.shape[1]
+
+    @staticmethod
+    def _gemm_bias(node, width):  # type: (Node, int) -> Optional[np.ndarray]
+        '''C of a Gemm node as a vector, if it only varies along the output channels'''
+        C = np.asarray(node.input_tensors[node.inputs[2]])
+        if C.ndim > 2 or (C.ndim == 2 and C.shape[0] != 1):
+            return None
+        C = C.reshape(-1)
+        if C.shape[0] == 1:
+            return np.full((width,), C[0], dtype=C.dtype)
+        return C
+
+    @staticmethod
+    def _bias_add(graph, node):  # type: (Graph, Node) -> Optional[Node]
+        '''The Add node adding a constant vector to the output of the MatMul node, if any'''
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
+        children = graph.consumers(node.outputs[0])
+        if len(children) != 1 or node.outputs[0] in output_names:
+            return None
+        add = children[0]
+        if add.op_type != 'Add' or len(add.inputs) != 2 or add.inputs[0] != node.outputs[0] or \
+                add.inputs[1] not in add.input_tensors or 'broadcast' in add.attrs:
+            return None
+        bias = add.input_tensors.get_lazy(add.inputs[1])
+        width = node.input_tensors.get_lazy(node.inputs[1]).shape[1]
+        if any(d != 1 for d in bias.shape[:-1]) or len(bias.shape) == 0 or bias.shape[-1] != width:
+            return None
+        return add
+
+    def _merge(self, graph, siblings):  # type: (Graph, List[Node]) -> Tuple[List[Node], List[Node]]
+        first = siblings[0]
+        widths = [self._width(node) for node in siblings]
+        weights = [node.input_tensors[node.inputs[1]] for node in siblings]
+        name = first.name
+        axis = 1
+        if first.op_type == 'Conv':
+            weight_axis = 0
+        elif first.op_type == 'Gemm':
+            weight_axis = 0 if first.attrs.get('transB', 0) else 1
+        else:
+            weight_axis = 1
+            axis = self._rank(graph, first) - 1
+
+        weight_name = graph.get_unique_edge_name(first.inputs[1])
+        inputs = [first.inputs[0], weight_name]
+        tensors = {weight_name: np.concatenate(weights, axis=weight_axis)}
+        if any(len(node.inputs) > 2 and node.inputs[2] != '' for node in siblings):
+            biases = []
+            for node, width in zip(siblings, widths):
+                if len(node.inputs) <= 2 or node.inputs[2] == '':
+                    biases.append(np.zeros((width,), dtype=weights[0].dtype))
+                elif node.op_type == 'Gemm':
+                    biases.append(self._gemm_bias(node, width))
+                else:
+                    biases.append(node.input_tensors[node.inputs[2]])
+            bias_name = graph.get_unique_edge_name("{}_bias".format(name))
+            inputs.append(bias_name)
+            tensors[bias_name] = np.concatenate(biases)
+
+        old_nodes = list(siblings)
+        outputs = [node.outputs[0] for node in siblings]
+        fused = Node(name, first.op_type, dict(first.attrs), inputs,
+                     [graph.get_unique_edge_name("{}_fused".format(first.outputs[0]))])
+        fused.input_tensors.update(tensors)
+        new_nodes = [fused]
+
+        bias_adds = [self._bias_add(graph, node) for node in siblings] if first.op_type == 'MatMul' else []
+        if len(bias_adds) > 0 and all(add is not None for add in bias_adds):
+            bias_name = graph.get_unique_edge_name("{}_bias".format(name))
+            add = Node("{}_bias".format(name), 'Add', {}, [fused.outputs[0], bias_name],
+                       [graph.get_unique_edge_name("{}_biased".format(first.outputs[0]))])
+            add.input_tensors[bias_name] = np.concatenate(
+                [np.asarray(node.input_tensors[node.inputs[1]]).reshape(-1) for node in bias_adds])  # type: ignore
+            new_nodes.append(add)
+            old_nodes.extend(bias_adds)  # type: ignore
+            outputs = [node.outputs[0] for node in bias_adds]  # type: ignore
+
+        split = Node("{}_split".format(name), 'Split', {'axis': axis, 'split': widths},
+                     [new_nodes[-1].outputs[0]], outputs)
+        new_nodes.append(split)
+
+        shape = graph.shape_dict.get(outputs[0], graph.shape_dict.get(first.outputs[0]))
+        if shape is not None and len(shape) > axis:
+            fused_shape = tuple(shape[:axis]) + (sum(widths),) + tuple(shape[axis + 1:])
+            for node in new_nodes[:-1]:
+                graph.shape_dict[node.outputs[0]] = fused_shape
+        return old_nodes, new_nodes
+
+    def __call__(self, graph):  # type: (Graph) -> Graph
+        groups = OrderedDict()  # type: Dict[Tuple[Any, ...], List[Node]]
+        for node in graph.nodes_to_visit(self.op_types):
+            # siblings outside of the worklist can still be fused with a node in it
+            for sibling in graph.consumers(node.inputs[0]):
+                if sibling.op_type not in self.op_types:
+                    continue
+                key = self._key(graph, sibling)
+                if key is None:
+                    continue
+                group = groups.setdefault(key, [])
+                if sibling not in group:
+                    group.append(sibling)
+
+        replacements = []  # type: List[Tuple[Sequence[Node], Sequence[Node]]]
+        for siblings in groups.values():
+            if len(siblings) < 2:
+                continue
+            siblings.sort(key=graph.position)
+            if self.equal_splits_only and len(set(self._width(node) for node in siblings)) != 1:
+                continue
+            old_nodes, new_nodes = self._merge(graph, siblings)
+            graph.rewire_subgraph(old_nodes, new_nodes)
+            replacements.append((old_nodes, new_nodes))
+        return graph.apply_replacements(replacements)
+
+# elementwise ops a Transpose commutes with
+_UNARY_ELEMENTWISE_OP_TYPES = set(_UNARY_OPS.keys()) | {'Cast', 'Clip', 'Elu', 'Erf', 'HardSigmoid', 'Identity',
+                                                        'LeakyRelu', 'Selu', 'Softplus', 'Softsign'}
+_BINARY_ELEMENTWISE_OP_TYPES = {'Add', 'Sub', 'Mul', 'Div', 'Pow', 'Max', 'Min'}
+
+class TransposeOptimizer(object):
+    '''
+    Removes Transpose nodes, which are converted to memory bound permute layers:
+        - consecutive Transposes are composed, and removed if they cancel out
+        - a Transpose is moved after the elementwise ops following it when that
+          makes it meet another Transpose
+        - a Transpose of a matrix feeding a Gemm or MatMul is folded into the
+          transA/transB attributes of a Gemm
+
+    The rank-5 mapping can't convert Gemm with transA, "fold_transposed_a"
+    disables folding into it.
+    '''
+    op_types = ('Transpose',)
+
+    def __init__(self, fold_transposed_a=True):  # type: (bool) -> None
+        self.fold_transposed_a = fold_transposed_a
+
+    @staticmethod
+    def _perm(graph, node):  # type: (Graph, Node) -> Optional[List[int]]
+        perm = node.attrs.get('perm')
+        if perm:
+            return list(perm)
+        # without "perm", the axes are reversed
+        shape = graph.shape_dict.get(node.inputs[0])
+        if shape is None:
+            return None
+        return list(reversed(range(len(shape))))
+
+    @staticmethod
+    def _replace_input(graph, node, old, new, tensors):  # type: (Graph, Node, Text, Text, Dict[Text, Any]) -> None
+        for i, input_ in enumerate(node.inputs):
+            if input_ == old:
+                graph.set_input(node, i, new)
+        if new in tensors:
+            node.input_tensors[new] = tensors.get_lazy(new)  # type: ignore
+
+    def _is_transposed(self, graph, node, edge, perm):  # type: (Graph, Node, Text, List[int]) -> Optional[Node]
+        '''The Transpose by "perm" producing "edge", if it is only used by "node"'''
+        producer = graph.producer(edge)
+        if producer is None or producer.op_type != 'Transpose' or self._perm(graph, producer) != perm:
+            return None
+        if any(consumer is not node for consumer in graph.consumers(edge)) or edge in self.output_names:
+            return None
+        return producer
+
+    def _commutes(self, graph, node, edge, perm):  # type: (Graph, Node, Text, List[int]) -> bool
+        '''True if the Transpose by "perm" producing "edge" can be moved after the node'''
+        if len(node.outputs) != 1:
+            return False
+        if node.op_type in _UNARY_ELEMENTWISE_OP_TYPES:
+            return node.inputs[0] == edge and all(input_ in node.input_tensors for input_ in node.inputs[1:])
+        if node.op_type not in _BINARY_ELEMENTWISE_OP_TYPES or len(node.inputs) != 2 or 'broadcast' in node.attrs:
+            return False
+        for input_ in node.inputs:
+            if input_ == edge or self._is_transposed(graph, node, input_, perm) is not None:
+                continue
+            if input_ not in node.input_tensors or len(node.input_tensors.get_lazy(input_).shape) > len(perm):
+                return False
+        return True
+
+    def _meets_transpose(self, graph, node, edge, perm):  # type: (Graph, Node, Text, List[int]) -> bool
+        '''True if moving the Transpose producing "edge" after the node merges it with another Transpose'''
+        while self._commutes(graph, node, edge, perm):
+            if node.op_type in _BINARY_ELEMENTWISE_OP_TYPES and \
+                    any(input_ != edge and input_ not in node.input_tensors for input_ in node.inputs):
+                # both inputs are transposed, the Transposes are merged
+                return True
+            edge = node.outputs[0]
+            consumers = graph.consumers(edge)
+            if len(consumers) != 1 or edge in self.output_names:
+                return False
+            node = consumers[0]
+            if node.op_type == 'Transpose':
+                return True
+        return False
+
+    def _sink(self, graph, transpose, node, perm):  # type: (Graph, Node, Node, List[int]) -> List[Node]
+        '''Moves the Transpose after the node, returns the Transposes merged into it'''
+        inverse = list(np.argsort(perm))
+        merged = []
+        for i, input_ in enumerate(list(node.inputs)):
+            if input_ == transpose.outputs[0]:
+                self._replace_input(graph, node, input_, transpose.inputs[0], transpose.input_tensors)
+                continue
+            if node.op_type in _UNARY_ELEMENTWISE_OP_TYPES:
+                continue
+            other = self._is_transposed(graph, node, input_, perm)
+            if other is not None:
+                self._replace_input(graph, node, input_, other.inputs[0], other.input_tensors)
+                graph.set_inputs(other, [])
+                merged.append(other)
+            else:
+                value = np.asarray(node.input_tensors[input_])
+                value = value.reshape((1,) * (len(perm) - value.ndim) + value.shape)
+                _set_constant_input(graph, node, i, np.transpose(value, inverse))
+
+        output_ = node.outputs[0]
+        edge = graph.get_unique_edge_name("{}_before_transpose".format(output_))
+        graph.set_outputs(node, [edge])
+        graph.set_inputs(transpose, [edge])
+        graph.set_outputs(transpose, [output_])
+        if output_ in graph.shape_dict:
+            shape = graph.shape_dict[output_]
+            graph.shape_dict[edge] = tuple(shape[inverse[i]] for i in range(len(shape)))
+        return merged
+
+    def _fold_into_matmul(self, graph, transpose, node):  # type: (Graph, Node, Node) -> Optional[Node]
+        '''Folds the Transpose of a matrix into a Gemm or MatMul consumer, returns its replacement'''
+        edge = transpose.outputs[0]
+        if node.op_type == 'MatMul':
+            # MatMul of matrices is a Gemm without C
+            for input_ in node.inputs:
+                if input_ in node.input_tensors:
+                    rank = len(node.input_tensors.get_lazy(input_).shape)
+                elif graph.producer(input_) is not None and graph.producer(input_).op_type == 'Transpose':
+                    rank = len(self._perm(graph, graph.producer(input_)) or [])
+                else:
+                    rank = len(graph.shape_dict.get(input_, ()))
+                if rank != 2:
+                    return None
+        inputs = list(node.inputs)
+        attrs = dict(node.attrs) if node.op_type == 'Gemm' else {}
+        folded = [i for i in (0, 1) if inputs[i] == edge and (i == 1 or self.fold_transposed_a)]
+        if len(folded) == 0:
+            return None
+        for i in folded:
+            attr = 'transA' if i == 0 else 'transB'
+            attrs[attr] = 1 - attrs.get(attr, 0)
+            inputs[i] = transpose.inputs[0]
+        if node.op_type == 'Gemm':
+            gemm = node
+            gemm.attrs = attrs
+            graph.set_inputs(gemm, inputs)
+        else:
+            gemm = Node(node.name, 'Gemm', attrs, inputs, list(node.outputs))
+            gemm.input_tensors.update(node.input_tensors)
+        if transpose.inputs[0] in transpose.input_tensors:
+            gemm.input_tensors[transpose.inputs[0]] = transpose.input_tensors.get_lazy(transpose.inputs[0])
+        return gemm
+
+    def __call__(self, graph):  # type: (Graph) -> Graph
+        self.output_names = set([str(output_[0]) for output_ in graph.outputs])
+        replacements = []  # type: List[Tuple[Sequence[Node], Sequence[Node]]]
+        removed = set()  # type: Set[Node]
+
+        def relink(old_nodes, new_nodes):  # type: (List[Node], List[Node]) -> None
+            graph.rewire_subgraph(old_nodes, new_nodes)
+            replacements.append((old_nodes, new_nodes))
+            removed.update(set(old_nodes).difference(new_nodes))
+
+        def bypass(transpose):  # type: (Node) -> None
+            input_, output_ = transpose.inputs[0], transpose.outputs[0]
+            if output_ in self.output_names:
+                # the producer of the input is made to produce the graph output instead
+                producer = graph.producer(input_)
+                if producer is None or input_ in self.output_names or len(graph.consumers(input_)) != 1:
+                    return
+                graph.set_outputs(transpose, [])
+                graph.set_outputs(producer, [output_ if edge == input_ else edge for edge in producer.outputs])
+                relink([producer], [producer])
+                relink([transpose], [])
+                return
+            for consumer in graph.consumers(transpose.outputs[0]):
+                self._replace_input(graph, consumer, transpose.outputs[0], transpose.inputs[0],
+                                    transpose.input_tensors)
+                relink([consumer], [consumer])
+            relink([transpose], [])
+
+        for transpose in graph.nodes_to_visit(self.op_types):
+            while transpose not in removed:
+                perm = self._perm(graph, transpose)
+                output_ = transpose.outputs[0]
+                if perm is None:
+                    break
+                if perm == list(range(len(perm))):
+                    bypass(transpose)
+                    break
+                if output_ in self.output_names:
+                    break
+
+                consumers = graph.consumers(output_)
+                composed = []
+                for consumer in consumers:
+                    consumer_perm = self._perm(graph, consumer) if consumer.op_type == 'Transpose' else None
+                    if consumer_perm is not None:
+                        consumer.attrs['perm'] = [perm[i] for i in consumer_perm]
+                        self._replace_input(graph, consumer, output_, transpose.inputs[0], transpose.input_tensors)
+                        relink([consumer], [consumer])
+                        composed.append(consumer)
+                    elif consumer.op_type in ('Gemm', 'MatMul') and perm == [1, 0]:
+                        gemm = self._fold_into_matmul(graph, transpose, consumer)
+                        if gemm is not None:
+                            relink([consumer], [gemm])
+                if not graph.is_used(output_):
+                    relink([transpose], [])
+                    # the composed Transposes may cancel out
+                    for consumer in composed:
+                        consumer_perm = consumer.attrs['perm']
+                        if consumer_perm == list(range(len(consumer_perm))):
+                            bypass(consumer)
+                    break
+
+                if len(consumers) != 1 or not self._meets_transpose(graph, consumers[0], output_, perm):
+                    break
+                node = consumers[0]
+                merged = self._sink(graph, transpose, node, perm)
+                relink([transpose, node] + merged, [node, transpose])
+
+        replacements = [(old_nodes, [node for node in new_nodes if node not in removed])
+                        for old_nodes, new_nodes in replacements]
+        return graph.apply_replacements(replacements)
+
+_SHAPE_OP_TYPES = ('Reshape', 'Flatten', 'Squeeze', 'Unsqueeze')
+
+def _is_static_shape(shape):  # type: (Optional[Sequence[int]]) -> bool
+    # unknown dimensions are recorded as 0 in shape_dict
+    return shape is not None and len(shape) > 0 and all(d > 0 for d in shape)
+
+def _shape_op_output_shape(node, shape):  # type: (Node, Sequence[int]) -> Optional[Tuple[int, ...]]
+    '''Output shape of a Reshape, Flatten, Squeeze or Unsqueeze node, for a static input shape'''
+    inputs = [None] + [node.input_tensors.get(input_) for input_ in node.inputs[1:]]
+    if any(value is None for value in inputs[1:]):
+        return None
+    shape = list(shape)
+    if node.op_type == 'Reshape':
+        target = _attr_or_input(node, inputs, 'shape', 1)
+        if target is None:
+            return None
+        # a 0 copies the input dimension, a -1 is inferred from the remaining size
+        target = [shape[i] if d == 0 else d for i, d in enumerate(target)]
+        if -1 in target:
+            known = int(np.prod([d for d in target if d != -1]))
+            target[target.index(-1)] = int(np.prod(shape)) // known if known > 0 else 0
+        return tuple(target)
+    if node.op_type == 'Flatten':
+        axis = _normalize_axes([node.attrs.get('axis', 1)], len(shape))[0]
+        return (int(np.prod(shape[:axis])), int(np.prod(shape[axis:])))
+    axes = _attr_or_input(node, inputs, 'axes', 1)
+    if node.op_type == 'Squeeze':
+        if axes is None:
+            return tuple(d for d in shape if d != 1)
+        axes = _normalize_axes(axes, len(shape))
+        return tuple(d for i, d in enumerate(shape) if i not in axes)
+    if axes is None:
+        return None
+    for axis in sorted(_normalize_axes(axes, len(shape) + len(axes))):
+        shape.insert(axis, 1)
+    return tuple(shape)
+
+class ReshapeChainFuser(object):
+    '''
+    Collapses chains of Reshape, Flatten, Squeeze and Unsqueeze nodes with static
+    shapes into a single Reshape to the final shape, and removes those nodes when
+    the output shape is the input shape.
+
+    The rank-5 mapping tracks the axes through each of these ops, "collapse_chains"
+    can be disabled to only remove the identities.
+    '''
+    op_types = _SHAPE_OP_TYPES
+
+    def __init__(self, collapse_chains=True):  # type: (bool) -> None
+        self.collapse_chains = collapse_chains
+
+    @staticmethod
+    def _output_shape(graph, node):  # type: (Graph, Node) -> Optional[Tuple[int, ...]]
+        shape = graph.shape_dict.get(node.outputs[0])
+        if _is_static_shape(shape):
+            return tuple(shape)  # type: ignore
+        input_shape = graph.shape_dict.get(node.inputs[0])
+        if not _is_static_shape(input_shape):
+            return None
+        shape = _shape_op_output_shape(node, input_shape)  # type: ignore
+        return shape if _is_static_shape(shape) else None
+
+    def __call__(self, graph):  # type: (Graph) -> Graph
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
+        replacements = []  # type: List[Tuple[Sequence[Node], Sequence[Node]]]
+        removed = set()  # type: Set[Node]
+
+        for node in graph.nodes_to_visit(self.op_types):
+            if node in removed or len(node.outputs) != 1:
+                continue
+            shape = self._output_shape(graph, node)
+            if shape is None:
+                continue
+            graph.shape_dict[node.outputs[0]] = shape
+
+            parent = graph.producer(node.inputs[0])
+            if self.collapse_chains and parent is not None and parent.op_type in _SHAPE_OP_TYPES and \
+                    len(parent.outputs) == 1 and parent.outputs[0] not in output_names and \
+                    graph.consumers(parent.outputs[0]) == [node]:
+                shape_name = graph.get_unique_edge_name("{}_shape".format(node.name))
+                reshape = Node(node.name, 'Reshape', {}, [parent.inputs[0], shape_name], list(node.outputs))
+                reshape.input_tensors[shape_name] = np.asarray(shape, dtype=np.int64)
+                if parent.inputs[0] in parent.input_tensors:
+                    reshape.input_tensors[parent.inputs[0]] = parent.input_tensors.get_lazy(parent.inputs[0])
+                graph.rewire_subgraph([parent, node], [reshape])
+                replacements.append(([parent, node], [reshape]))
+                removed.update([parent, node])
+                node = reshape
+
+            input_ = node.inputs[0]
+            if graph.shape_dict.get(input_) == shape and node.outputs[0] not in output_names:
+                for child in graph.consumers(node.outputs[0]):
+                    for i, child_input in enumerate(child.inputs):
+                        if child_input == node.outputs[0]:
+                            graph.set_input(child, i, input_)
+                    if input_ in node.input_tensors:
+                        child.input_tensors[input_] = node.input_tensors.get_lazy(input_)
+                    graph.rewire_subgraph([child], [child])
+                    replacements.append(([child], [child]))
+                graph.rewire_subgraph([node], [])
+                replacements.append(([node], []))
+                removed.add(node)
+
+        replacements = [(old_nodes, [node for node in new_nodes if node not in removed])
+                        for old_nodes, new_nodes in replacements]
+        return graph.apply_replacements(replacements)
+
+class AlgebraicSimplifier(object):
+    '''
+    Rewrites elementwise arithmetic with constants into fewer or cheaper layers:
+        - x * 1, x + 0, x - 0, x / 1, Pow(x, 1) and Neg(Neg(x)) are removed
+        - Sub(0, x) becomes Neg(x), Div(1, x) and Pow(x, -1) become Reciprocal(x)
+        - Div(x, c) becomes Mul(x, 1 / c)
+        - Pow(x, 2) becomes Mul(x, x), Pow(x, 0.5) becomes Sqrt(x)
+        - Reciprocal(Sqrt(x)) and Pow(x, -0.5) become Rsqrt(x), if "Rsqrt" is one of
+          "supported_op_types" (None for any op)
+
+    "num_eliminated" counts the nodes removed over all runs.
+    '''
+    op_types = ('Add', 'Sub', 'Mul', 'Div', 'Pow', 'Neg', 'Reciprocal')
+
+    def __init__(self, supported_op_types=None):  # type: (Optional[Iterable[Text]]) -> None
+        self.supported_op_types = None if supported_op_types is None else set(supported_op_types)
+        self.num_eliminated = 0
+
+    @staticmethod
+    def _constant(graph, node, i):  # type: (Graph, Node, int) -> Optional[np.ndarray]
+        '''
+        The i-th input of a binary node if it is a constant, which broadcasting
+        against the other input doesn't make the output larger than that input
+        '''
+        if len(node.inputs) != 2 or node.inputs[i] not in node.input_tensors or \
+                node.inputs[1 - i] in node.input_tensors:
+            return None
+        value = np.asarray(node.input_tensors[node.inputs[i]])
+        if i == 1 and node.attrs.get('broadcast', 0):
+            # before opset 7, the second input is broadcast to the shape of the first one
+            return value
+        shape = graph.shape_dict.get(node.inputs[1 - i])
+        if value.ndim == 0 or (value.size == 1 and shape is not None and value.ndim <= len(shape)):
+            return value
+        if _is_static_shape(shape) and _broadcast_shape(shape, value.shape) == tuple(shape):  # type: ignore
+            return value
+        return None
+
+    @staticmethod
+    def _is(value, scalar):  # type: (Optional[np.ndarray], float) -> bool
+        return value is not None and value.size > 0 and bool(np.all(value == scalar))
+
+    def _rewrite(self, graph, node, output_names):  # type: (Graph, Node, Set[Text]) -> Optional[Tuple[Text, Any]]
+        '''
+        Returns ("bypass", input) if the node can be replaced by one of its inputs,
+        ("replace", (op_type, inputs, tensors)) if it can be replaced by a cheaper node,
+        or None
+        '''
+        op_type = node.op_type
+        if op_type in ('Neg', 'Reciprocal'):
+            parent = graph.producer(node.inputs[0])
+            if parent is None or graph.consumers(node.inputs[0]) != [node] or len(parent.outputs) != 1 or \
+                    parent.outputs[0] in output_names:
+                return None
+            if op_type == 'Neg' and parent.op_type == 'Neg':
+                return 'bypass_parent', parent
+            if op_type == 'Reciprocal' and parent.op_type == 'Sqrt' and self._supports('Rsqrt'):
+                return 'replace_parent', (parent, 'Rsqrt')
+            return None
+
+        x, y = node.inputs[0], node.inputs[1] if len(node.inputs) > 1 else None
+        a, b = self._constant(graph, node, 0), self._constant(graph, node, 1)
+        if op_type in ('Add', 'Mul'):
+            neutral = 0. if op_type == 'Add' else 1.
+            if self._is(b, neutral):
+                return 'bypass', x
+            if self._is(a, neutral):
+                return 'bypass', y
+        elif op_type == 'Sub':
+            if self._is(b, 0.):
+                return 'bypass', x
+            if self._is(a, 0.):
+                return 'replace', ('Neg', [y])
+        elif op_type == 'Div':
+            if self._is(b, 1.):
+                return 'bypass', x
+            if self._is(a, 1.) and np.issubdtype(a.dtype, np.floating):  # type: ignore
+                return 'replace', ('Reciprocal', [y])
+            if b is not None and np.issubdtype(b.dtype, np.floating) and np.all(b != 0):
+                return 'replace', ('Mul', [x, (y, np.reciprocal(b).astype(b.dtype))])
+        elif op_type == 'Pow' and b is not None and b.size == 1:
+            exponent = float(b.reshape(-1)[0])
+            if exponent == 1.:
+                return 'bypass', x
+            if exponent == 2.:
+                return 'replace', ('Mul', [x, x])
+            if exponent == .5:
+                return 'replace', ('Sqrt', [x])
+            if exponent == -1.:
+                return 'replace', ('Reciprocal', [x])
+            if exponent == -.5 and self._supports('Rsqrt'):
+                return 'replace', ('Rsqrt', [x])
+        return None
+
+    def _supports(self, op_type):  # type: (Text) -> bool
+        return self.supported_op_types is None or op_type in self.supported_op_types
+
+    def __call__(self, graph):  # type: (Graph) -> Graph
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
+        replacements = []  # type: List[Tuple[Sequence[Node], Sequence[Node]]]
+        removed = set()  # type: Set[Node]
+
+        def bypass(node, input_):  # type: (Node, Text) -> None
+            for child in graph.consumers(node.outputs[0]):
+                for i, child_input in enumerate(child.inputs):
+                    if child_input == node.outputs[0]:
+                        graph.set_input(child, i, input_)
+                if input_ in node.input_tensors:
+                    child.input_tensors[input_] = node.input_tensors.get_lazy(input_)
+                graph.rewire_subgraph([child], [child])
+                replacements.append(([child], [child]))
+            graph.rewire_subgraph([node], [])
+            replacements.append(([node], []))
+            removed.add(node)
+
+        for node in graph.nodes_to_visit(self.op_types):
+            if node in removed or len(node.outputs) != 1:
+                continue
+            rewrite = self._rewrite(graph, node, output_names)
+            if rewrite is None:
+                continue
+            kind, arg = rewrite
+            if kind == 'bypass':
+                if node.outputs[0] in output_names or arg in node.input_tensors:
+                    continue
+                bypass(node, arg)
+                self.num_eliminated += 1
+            elif kind == 'bypass_parent':
+                # Neg(Neg(x))
+                if node.outputs[0] in output_names or arg.inputs[0] in arg.input_tensors:
+                    continue
+                graph.rewire_subgraph([arg], [])
+                replacements.append(([arg], []))
+                removed.add(arg)
+                bypass(node, arg.inputs[0])
+                self.num_eliminated += 2
+            else:
+                if kind == 'replace_parent':
+                    # Reciprocal(Sqrt(x))
+                    parent, op_type = arg
+                    old_nodes = [parent, node]
+                    inputs = [parent.inputs[0]]  # type: List[Any]
+                    tensors = parent.input_tensors
+                    self.num_eliminated += 1
+                else:
+                    op_type, inputs = arg
+                    old_nodes = [node]
+                    tensors = node.input_tensors
+                # only Div turned into Mul keeps the (broadcasting) attributes
+                attrs = dict(node.attrs) if node.op_type == 'Div' and op_type == 'Mul' else {}
+                new_node = Node(node.name, op_type, attrs, [], list(node.outputs))
+                for input_ in inputs:
+                    if isinstance(input_, tuple):
+                        # a constant input with a new value
+                        name = graph.get_unique_edge_name("{}_{}".format(node.name, op_type.lower()))
+                        new_node.input_tensors[name] = input_[1]
+                        input_ = name
+                    elif input_ in tensors:
+                        new_node.input_tensors[input_] = tensors.get_lazy(input_)
+                    new_node.inputs.append(input_)
+                graph.rewire_subgraph(old_nodes, [new_node])
+                replacements.append((old_nodes, [new_node]))
+                removed.update(old_nodes)
+
+        replacements = [(old_nodes, [node for node in new_nodes if node not in removed])
+                        for old_nodes, new_nodes in replacements]
+        return graph.apply_replacements(replacements)
+
 class AddModelInputsOutputs(object):
     '''
     Expose hidden states of recurrent layers as model inputs and outputs
     '''
+    op_types = ('LSTM',)
+
     def __call__(self, graph):  # type: (Graph) -> Graph
         input_names = [str(input_[0]) for input_ in graph.inputs]
-        output_names = [str(output_[0]) for output_ in graph.outputs]
-        for node in graph.nodes:
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
+        for node in graph.nodes_to_visit(self.op_types):
             if str(node.op_type) == 'LSTM':
                 input_h = node.inputs[5] if len(node.inputs) > 5 else node.inputs[0] + '_h_input'
                 input_c = node.inputs[6] if len(node.inputs) > 6 else node.inputs[0] + '_c_input'
@@ -567,59 +1528,197 @@ class ConstantsToInitializers(object):
     '''
     Takes onnx Constant nodes and puts the tensor into graph initializers instead.
     '''
+    op_types = ('Constant',)
+
     def __call__(self, graph):  # type: (Graph) -> Graph
-        output_names = [str(output_[0]) for output_ in graph.outputs]
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
         nodes_to_be_removed = []
-        for node in graph.nodes:
-            if node.op_type == 'Constant' and (node.name not in output_names):
+        for node in graph.nodes_to_visit(self.op_types):
+            if node.op_type == 'Constant' and (node.outputs[0] not in output_names):
                 nodes_to_be_removed.append(node)
-                x = node.attrs["value"]
+                x = node.attrs.get_lazy("value")
                 for child in node.children:
                     child.input_tensors[node.outputs[0]] = x
-                    child.parents.remove(node)
                 graph.shape_dict[node.outputs[0]] = x.shape
 
-        transformed_nodes = []
-        for node in graph.nodes:
-            if node not in nodes_to_be_removed:
-                transformed_nodes.append(node)
-        return graph.create_graph(nodes=transformed_nodes)
+        return graph.remove_nodes(nodes_to_be_removed)
 
 class ConstantFillToInitializers(object):
     '''
     Takes onnx ConstantFill nodes and puts the tensor into graph initializers instead, for simple cases only.
+    A tensor larger than "max_folded_bytes" is replaced by a single element one when all its
+    consumers broadcast it anyway, or else the node is kept as a runtime layer if ConstantFill
+    is one of "runtime_op_types" (None for any op), as in ConstantRemover.
     '''
+    op_types = ('ConstantFill',)
+
+    def __init__(self,
+                 max_folded_bytes=_DEFAULT_MAX_FOLDED_BYTES,  # type: int
+                 runtime_op_types=None,  # type: Optional[Iterable[Text]]
+                 ):
+        # type: (...) -> None
+        self.max_folded_bytes = max_folded_bytes
+        self.runtime_op_types = None if runtime_op_types is None else set(runtime_op_types)
+
     def __call__(self, graph):  # type: (Graph) -> Graph
-        output_names = [str(output_[0]) for output_ in graph.outputs]
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
         nodes_to_be_removed = []
-        for node in graph.nodes:
-            if node.op_type == 'ConstantFill' and (node.name not in output_names) and \
+        for node in graph.nodes_to_visit(self.op_types):
+            if node.op_type == 'ConstantFill' and (node.outputs[0] not in output_names) and \
                node.attrs.get('input_as_shape', 0) and node.inputs[0] in node.input_tensors \
                and node.attrs.get('extra_shape', None) is None:
 
-                s = node.input_tensors[node.inputs[0]]
-                x = np.ones(tuple(s.astype(int))) * node.attrs.get('value', 0.0)
+                s = tuple(node.input_tensors[node.inputs[0]].astype(int))
+                value = node.attrs.get('value', 0.0)
+                nbytes = int(np.prod(s)) * np.dtype(np.float64).itemsize
+                if nbytes <= self.max_folded_bytes:
+                    x = np.ones(s) * value
+                elif _is_broadcast_by_consumers(graph, node.outputs[0], s):
+                    x = np.full((1,) * len(s), value)
+                elif self.runtime_op_types is None or node.op_type in self.runtime_op_types:
+                    continue
+                else:
+                    # the node can't be converted: folding it is the only option
+                    x = np.ones(s) * value
                 nodes_to_be_removed.append(node)
                 for child in node.children:
                     child.input_tensors[node.outputs[0]] = x
-                    child.parents.remove(node)
                 graph.shape_dict[node.outputs[0]] = x.shape
 
-        transformed_nodes = []
-        for node in graph.nodes:
-            if node not in nodes_to_be_removed:
-                transformed_nodes.append(node)
-        return graph.create_graph(nodes=transformed_nodes)
+        return graph.remove_nodes(nodes_to_be_removed)
+
+class ShapePropagation(object):
+    '''
+    Fills graph.shape_dict with the shapes ONNX shape inference didn't give, e.g. those
+    of the edges created by the other transformers, by propagating the known shapes
+    through the nodes in topological order. See _shape_inference for the supported ops.
+
+    The named dimensions of "symbolic_shapes" (see _shape_inference._symbolic_shapes)
+    are tracked through the ops, so that the dimensions that don't depend on them,
+    or that they cancel out of, are known. Only fully known shapes are recorded in
+    graph.shape_dict, and the shapes already in it are kept.
+
+    The shapes are propagated through the whole graph on the first run only. The
+    following runs start from the nodes of the worklist, and only go on through the
+    nodes whose input shapes change. The propagated shapes, symbolic dimensions
+    included, are kept as "shapes" for ShapeSubgraphFolder.
+    '''
+    def __init__(self,
+                 symbolic_shapes=None,  # type: Optional[Dict[Text, Sequence[Union[int, Text, None]]]]
+                 ):
+        # type: (...) -> None
+        self.symbolic_shapes = symbolic_shapes
+        self.shapes = None  # type: Optional[Dict[Text, Any]]
+        # def-use index of the graph "shapes" were propagated through
+        self._index = None  # type: Any
+
+    def __call__(self, graph):  # type: (Graph) -> Graph
+        if self.shapes is None or graph.worklist is None or graph.index is not self._index:
+            self.shapes = _propagate_shapes(graph, self.symbolic_shapes)
+            self._index = graph.index
+            changed = self.shapes.keys()  # type: Iterable[Text]
+        else:
+            changed = _update_shapes(graph, self.shapes, graph.nodes_to_visit())
+        for name in changed:
+            shape = self.shapes[name]
+            if name in graph.shape_dict and all(d > 0 for d in graph.shape_dict[name]):
+                continue
+            if len(shape) > 0 and all(_is_static(d) and d > 0 for d in shape):
+                graph.shape_dict[name] = shape
+        return graph
+
+class ShapeSubgraphFolder(object):
+    '''
+    Folds the shape computations starting at Shape nodes, e.g. the Shape, Gather,
+    Unsqueeze and Concat nodes PyTorch exports to compute the target shape of a
+    Reshape, using the dimensions known from shape propagation, even when the input
+    shape isn't fully known, unlike ShapeOpRemover:
+    - the nodes whose outputs don't depend on symbolic dimensions are removed, passing
+      the values of their outputs on to their children as constants
+    - the target shape of a Reshape that does depend on them is made constant when the
+      symbolic dimensions can be expressed with 0 (copied from the input) and -1
+    The nodes computing only dimensions that are truly dynamic are left in the graph.
+
+    Given the ShapePropagation pass run before it, the shapes it propagated are reused
+    instead of propagating them again.
+    '''
+    op_types = ('Shape',)
+
+    def __init__(self,
+                 symbolic_shapes=None,  # type: Optional[Dict[Text, Sequence[Union[int, Text, None]]]]
+                 shape_propagation=None,  # type: Optional[ShapePropagation]
+                 ):
+        # type: (...) -> None
+        self.symbolic_shapes = symbolic_shapes
+        self.shape_propagation = shape_propagation
+
+    def __call__(self, graph):  # type: (Graph) -> Graph
+        if len(graph.index.nodes_of_op_type('Shape')) == 0:
+            return graph
+        if self.shape_propagation is not None and self.shape_propagation.shapes is not None:
+            shapes = self.shape_propagation.shapes
+        else:
+            shapes = _propagate_shapes(graph, self.symbolic_shapes)
+        shape_values = _ShapeValues(graph, shapes)
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
+
+        # only the Shape nodes and what they feed can compute shape values
+        nodes = set()  # type: Set[Node]
+        stack = list(graph.index.nodes_of_op_type('Shape'))
+        while len(stack) > 0:
+            node = stack.pop()
+            if node not in nodes:
+                nodes.add(node)
+                stack.extend(node.children)
+        nodes_in_order = sorted(nodes, key=graph.position)
+
+        removed = set()  # type: Set[Node]
+        replacements = []  # type: List[Tuple[List[Node], List[Node]]]
+        for node in nodes_in_order:
+            if any(output_ in output_names for output_ in node.outputs):
+                continue
+            # the values are given as int64 constants: those of float edges are left to ConstantRemover
+            if any(output_ not in shape_values.integer_edges for output_ in node.outputs):
+                continue
+            values = [shape_values.static_value(output_) for output_ in node.outputs]
+            if any(value is None for value in values):
+                continue
+            removed.add(node)
+            replacements.append(([node], []))
+            for output_, value in zip(node.outputs, values):
+                graph.shape_dict[output_] = value.shape
+                for child in graph.consumers(output_):
+                    child.input_tensors[output_] = value
+
+        for node in nodes_in_order:
+            if node.op_type != 'Reshape' or node in removed or len(node.inputs) < 2 \
+                    or node.inputs[1] in node.input_tensors:
+                continue
+            target = shape_values.reshape_target(node)
+            if target is None:
+                continue
+            new_name = graph.get_unique_edge_name(node.inputs[1] + '_static')
+            graph.set_input(node, 1, new_name)
+            node.input_tensors[new_name] = target
+            graph.rewire_subgraph([node], [node])
+            replacements.append(([node], [node]))
+
+        for node in removed:
+            graph.rewire_subgraph([node], [])
+        # the nodes left computing the replaced shapes are removed by DeadCodeElimination
+        return graph.apply_replacements(replacements)
 
 class ShapeOpRemover(object):
     '''
     remove shape op, if the input shape is fully known
     '''
+    op_types = ('Shape',)
+
     def __call__(self, graph):  # type: (Graph) -> Graph
         nodes_to_be_removed = []
-        output_names = [str(output_[0]) for output_ in graph.outputs]
-        for node in graph.nodes:
-            if node.op_type == 'Shape' and (node.name not in output_names) and node.inputs[0] in graph.shape_dict:
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
+        for node in graph.nodes_to_visit(self.op_types):
+            if node.op_type == 'Shape' and (node.outputs[0] not in output_names) and node.inputs[0] in graph.shape_dict:
                 x_tuple = graph.shape_dict[node.inputs[0]] # type: Tuple[int, ...]
                 is_well_defined = True
                 for i in x_tuple:
@@ -631,184 +1730,308 @@ class ShapeOpRemover(object):
                     nodes_to_be_removed.append(node)
                     for child in node.children:
                         child.input_tensors[node.outputs[0]] = x
-                        child.parents.remove(node)
-                    for parent in node.parents:
-                        parent.children.remove(node)
                     graph.shape_dict[node.outputs[0]] = x.shape
 
-        transformed_nodes = []
-        for node in graph.nodes:
-            if node not in nodes_to_be_removed:
-                transformed_nodes.append(node)
-        return graph.create_graph(nodes=transformed_nodes)
+        return graph.remove_nodes(nodes_to_be_removed)
 
 class CastOpRemover(object):
     '''
     Remove Cast Op: onnx-coreml treats all tensor as Float and hence, Cast operator should be removed
     '''
+    op_types = ('Cast',)
+
     def __call__(self, graph):  # type: (Graph) -> Graph
-        global cast_i
         nodes_to_be_removed = []
-        output_names = [str(output_[0]) for output_ in graph.outputs]
-        for node in graph.nodes:
-            if node.op_type == 'Cast' and (node.name not in output_names) and node.inputs[0] in graph.shape_dict:
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
+        for node in graph.nodes_to_visit(self.op_types):
+            if node.op_type == 'Cast' and (node.outputs[0] not in output_names) and node.inputs[0] in graph.shape_dict:
                 nodes_to_be_removed.append(node)
-                _remove_single_input_output_node(node)
 
-        transformed_nodes = []
-        for node in graph.nodes:
-            if node not in nodes_to_be_removed:
-                transformed_nodes.append(node)
-        return graph.create_graph(nodes=transformed_nodes)
+        return graph.bypass_nodes(nodes_to_be_removed)
 
 class PaddingOpRemover(object):
     '''
     Remove Pad Op if all the pad values are 0
     '''
+    op_types = ('Pad',)
+
     def __call__(self, graph):  # type: (Graph) -> Graph
-        global cast_i
         nodes_to_be_removed = []
-        output_names = [str(output_[0]) for output_ in graph.outputs]
-        for node in graph.nodes:
-            if node.op_type == 'Pad' and (node.name not in output_names) and node.inputs[0] in graph.shape_dict:
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
+        for node in graph.nodes_to_visit(self.op_types):
+            if node.op_type == 'Pad' and (node.outputs[0] not in output_names) and node.inputs[0] in graph.shape_dict:
                 pads = node.attrs.get('pads', [])
                 if len(pads) > 0 and sum(pads) == 0:
                     nodes_to_be_removed.append(node)
-                    _remove_single_input_output_node(node)
 
-        transformed_nodes = []
-        for node in graph.nodes:
-            if node not in nodes_to_be_removed:
-                transformed_nodes.append(node)
-        return graph.create_graph(nodes=transformed_nodes)
+        return graph.bypass_nodes(nodes_to_be_removed)
 
 class ImageScalerRemover(object):
     '''
     Removes ImageScaler layer if connected to a model input and single parent child nodes
     '''
+    op_types = ('ImageScaler',)
 
     def __call__(self, graph):  # type: (Graph) -> Graph
         input_names = [str(input_[0]) for input_ in graph.inputs]
         nodes_to_be_removed = []
-        for node in graph.nodes:
+        for node in graph.nodes_to_visit(self.op_types):
             if (node.op_type != 'ImageScaler') or (len(node.parents) != 0) or (node.inputs[0] not in input_names):
                 continue
-            nodes_to_be_removed.append(node.name)
-            for child in node.children:
-                for i, child_input in enumerate(child.inputs):
-                    if child_input == node.outputs[0]:
-                        child.inputs[i] = node.inputs[0]
-                        child.parents.remove(node)
-                        break
+            nodes_to_be_removed.append(node)
 
-        transformed_nodes = []
-        for node in graph.nodes:
-            if node.name not in nodes_to_be_removed:
-                transformed_nodes.append(node)
-        return graph.create_graph(nodes=transformed_nodes)
+        return graph.bypass_nodes(nodes_to_be_removed)
+
+class ImagePreprocessingFuser(object):
+    '''
+    Removes the per-channel affine ops (Add, Sub, Mul, Div by a constant) a model
+    normalizes its image inputs with, and records them in "preprocessing_args" instead,
+    for CoreML to apply while decoding the images. The format of "preprocessing_args"
+    is the one of the converter's argument, with a value per input name.
+
+    CoreML only has a per-channel bias: a per-channel scale is folded into the weights
+    of the Conv the normalized input feeds, if there is one, and the ops are kept otherwise.
+    '''
+    op_types = ('Add', 'Sub', 'Mul', 'Div')
+
+    def __init__(self,
+                 image_input_names,  # type: Sequence[Text]
+                 ):
+        # type: (...) -> None
+        self.image_input_names = list(image_input_names)
+        self.preprocessing_args = {}  # type: Dict[Text, Dict[Text, float]]
+
+    @staticmethod
+    def _channel_vector(node, edge, shape):  # type: (Node, Text, Sequence[int]) -> Optional[np.ndarray]
+        '''The constant "edge" is combined with by the node, as one value per channel'''
+        if node.op_type not in ImagePreprocessingFuser.op_types or len(node.inputs) != 2:
+            return None
+        i = _constant_input_index(node)
+        if i is None or node.inputs[1 - i] != edge or (i == 0 and node.op_type in ('Sub', 'Div')):
+            return None
+        value = np.asarray(node.input_tensors[node.inputs[i]], dtype=np.float64)
+        if node.attrs.get('broadcast', 0) and 'axis' in node.attrs and value.ndim > 0:
+            axis = _normalize_axes([node.attrs['axis']], len(shape))[0]
+            value = value.reshape(value.shape + (1,) * (len(shape) - axis - value.ndim))
+        if value.ndim > len(shape):
+            return None
+        value = value.reshape((1,) * (len(shape) - value.ndim) + value.shape)
+        channel_axis = len(shape) - 3
+        if any(d != 1 for axis, d in enumerate(value.shape) if axis != channel_axis) or \
+                value.shape[channel_axis] not in (1, shape[channel_axis]):
+            return None
+        return np.broadcast_to(value.reshape(-1), (shape[channel_axis],))
+
+    @staticmethod
+    def _first_conv(graph, edge, output_names):  # type: (Graph, Text, Set[Text]) -> Optional[Node]
+        '''The Conv only consuming "edge", if its input channels can absorb a scale'''
+        consumers = graph.consumers(edge)
+        if len(consumers) != 1 or edge in output_names:
+            return None
+        conv = consumers[0]
+        if conv.op_type != 'Conv' or conv.inputs[0] != edge or conv.attrs.get('group', 1) != 1 \
+                or len(conv.inputs) < 2 or conv.inputs[1] not in conv.input_tensors:
+            return None
+        return conv
+
+    def _set_args(self, input_name, scale, bias):  # type: (Text, float, np.ndarray) -> None
+        self.preprocessing_args.setdefault('image_scale', {})[input_name] = scale
+        colors = ['gray'] if len(bias) == 1 else ['red', 'green', 'blue']
+        for color, value in zip(colors, bias):
+            self.preprocessing_args.setdefault(color + '_bias', {})[input_name] = float(value)
+
+    def __call__(self, graph):  # type: (Graph) -> Graph
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
+        nodes_to_be_removed = []  # type: List[Node]
+        for input_name in self.image_input_names:
+            shape = graph.shape_dict.get(input_name)
+            if shape is None or len(shape) not in (3, 4) or shape[-3] not in (1, 3):
+                continue
+            # the normalized input is scale * x + bias
+            scale = np.ones((shape[-3],))
+            bias = np.zeros((shape[-3],))
+            chain = []  # type: List[Node]
+            edge = input_name
+            while True:
+                consumers = graph.consumers(edge)
+                if len(consumers) != 1 or consumers[0].outputs[0] in output_names:
+                    break
+                node = consumers[0]
+                value = self._channel_vector(node, edge, shape)
+                if value is None:
+                    break
+                if node.op_type == 'Add':
+                    bias = bias + value
+                elif node.op_type == 'Sub':
+                    bias = bias - value
+                elif np.any(value == 0):
+                    break
+                elif node.op_type == 'Mul':
+                    scale, bias = scale * value, bias * value
+                else:
+                    scale, bias = scale / value, bias / value
+                chain.append(node)
+                edge = node.outputs[0]
+            if len(chain) == 0:
+                continue
+
+            if np.allclose(scale, scale[0]):
+                self._set_args(input_name, float(scale[0]), bias)
+            else:
+                conv = self._first_conv(graph, edge, output_names)
+                if conv is None:
+                    continue
+                # conv(W, scale * x + bias) == conv(W * scale, x + bias / scale)
+                W = conv.input_tensors[conv.inputs[1]]
+                scaled_W = W * scale.reshape((1, -1) + (1,) * (W.ndim - 2))
+                _set_constant_input(graph, conv, 1, scaled_W.astype(W.dtype))
+                self._set_args(input_name, 1.0, bias / scale)
+
+            for node in chain:
+                if node.inputs[0] not in node.input_tensors:
+                    continue
+                # make the normalized value the first input, the one bypass_nodes passes on
+                graph.set_inputs(node, [node.inputs[1], node.inputs[0]])
+            nodes_to_be_removed.extend(chain)
+
+        return graph.bypass_nodes(nodes_to_be_removed)
+
+class DeprocessingFuser(object):
+    '''
+    Folds the per-channel scale and bias of image output deprocessing into the Conv,
+    ConvTranspose or BatchNormalization node producing the output, when nothing else
+    uses its value. "deprocessing" maps output names to their (scale, bias) vectors.
+    The outputs folded are listed in "fused_output_names", the others still need a
+    deprocessing layer.
+    '''
+    op_types = ('Conv', 'ConvTranspose', 'BatchNormalization')
+
+    def __init__(self,
+                 deprocessing,  # type: Dict[Text, Tuple[np.ndarray, np.ndarray]]
+                 ):
+        # type: (...) -> None
+        self.deprocessing = deprocessing
+        self.fused_output_names = []  # type: List[Text]
+
+    def _is_eligible(self, graph, node, channels):  # type: (Graph, Node, int) -> bool
+        if len(graph.consumers(node.outputs[0])) > 0:
+            return False
+        if node.op_type == 'BatchNormalization':
+            return _is_inference_batchnorm(graph, node) and \
+                all(input_ in node.input_tensors and node.input_tensors.get_lazy(input_).shape == (channels,)
+                    for input_ in node.inputs[1:5])
+        return node.op_type in ('Conv', 'ConvTranspose') and node.inputs[1] in node.input_tensors and \
+            _has_constant_bias(graph, node) and _output_channels(node) == channels
+
+    def __call__(self, graph):  # type: (Graph) -> Graph
+        for output_name, (scale, bias) in self.deprocessing.items():
+            node = graph.producer(output_name)
+            if node is None or not self._is_eligible(graph, node, len(scale)):
+                continue
+            scale = np.asarray(scale, dtype=np.float64)
+            bias = np.asarray(bias, dtype=np.float64)
+            if node.op_type == 'BatchNormalization':
+                gamma, beta = [node.input_tensors[input_] for input_ in node.inputs[1:3]]
+                _set_constant_input(graph, node, 1, (gamma * scale).astype(gamma.dtype))
+                _set_constant_input(graph, node, 2, (beta * scale + bias).astype(beta.dtype))
+            else:
+                _scale_output_channels(graph, node, scale)
+                _shift_output_channels(graph, node, bias)
+            self.fused_output_names.append(output_name)
+        return graph
 
 class ConstantRemover(object):
     '''
-    Removes Op if its input is constant
-    Currently, Supports: Gather, Floor, Div, Mul, Slice, Transpose, Concat, Unsqueeze, Squeeze
+    Removes Op if its inputs are constant, passing its outputs on to its children as constants.
+    Supports the ops of the constant folding table, see _folding.
+    A whole constant subgraph is folded in a single sweep over the nodes, in topological order.
+
+    Folding a node whose output is larger than its inputs and than "max_folded_bytes" would
+    bloat the model. The output is then given to its consumers as a small value they broadcast
+    if possible, or else the node is kept as a runtime layer if it is one of "runtime_op_types"
+    (None for any op).
     '''
+    op_types = tuple(sorted(_CONSTANT_FOLDING_REGISTRY.keys()))
+
+    def __init__(self,
+                 max_folded_bytes=_DEFAULT_MAX_FOLDED_BYTES,  # type: int
+                 runtime_op_types=None,  # type: Optional[Iterable[Text]]
+                 ):
+        # type: (...) -> None
+        self.max_folded_bytes = max_folded_bytes
+        self.runtime_op_types = None if runtime_op_types is None else set(runtime_op_types)
+
+    def _fold(self, graph, node, inputs):
+        # type: (Graph, Node, List[Optional[np.ndarray]]) -> Optional[List[np.ndarray]]
+        '''Values to give to the consumers of the node outputs, None to keep the node'''
+        input_nbytes = sum([x.nbytes for x in inputs if x is not None])
+        budget = max(input_nbytes, self.max_folded_bytes)
+        output_nbytes = _estimate_output_nbytes(node, inputs)
+        outputs = None  # type: Optional[List[np.ndarray]]
+        if output_nbytes is None:
+            outputs = _fold_node(node, inputs)
+            if outputs is None:
+                return None
+            output_nbytes = sum([x.nbytes for x in outputs])
+        if output_nbytes <= budget:
+            return outputs if outputs is not None else _fold_node(node, inputs)
+
+        source = _broadcast_source(node, inputs)
+        if source is not None and _is_broadcast_by_consumers(graph, node.outputs[0], source[1]):
+            return [source[0]]
+        if self.runtime_op_types is None or node.op_type in self.runtime_op_types:
+            return None
+        # the node can't be converted: folding it is the only option
+        return outputs if outputs is not None else _fold_node(node, inputs)
+
     def __call__(self, graph):  # type: (Graph) -> Graph
-        nodes_to_be_removed = []
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
+        worklist = graph.worklist
+        nodes_to_be_removed = set()  # type: Set[Node]
         for node in graph.nodes:
+            if node.op_type not in _CONSTANT_FOLDING_REGISTRY:
+                continue
+            # folding a node makes its children foldable, whether they are in the worklist or not
+            is_parent_folded = False
+            are_parents_folded = True
+            for parent in node.parents:
+                if parent in nodes_to_be_removed:
+                    is_parent_folded = True
+                else:
+                    are_parents_folded = False
+                    break
+            if not are_parents_folded:
+                continue
+            if worklist is not None and node not in worklist and not is_parent_folded:
+                continue
+
             are_all_inputs_constant = True
+            inputs = []  # type: List[Optional[np.ndarray]]
             for input_ in node.inputs:
-                if input_ not in node.input_tensors:
+                if input_ == '':
+                    # omitted optional input
+                    inputs.append(None)
+                elif input_ in node.input_tensors:
+                    inputs.append(node.input_tensors[input_])
+                else:
                     are_all_inputs_constant = False
                     break
+            if not are_all_inputs_constant:
+                continue
+            if any(output_ in output_names for output_ in node.outputs):
+                continue
 
-            transformation_performed = False
-            if len(node.parents) != 0 or are_all_inputs_constant == False:
-                continue
-            # TODO: Replace If -> ElIf with more general transformation block
-            if node.op_type == 'Gather':
-                data = node.input_tensors[node.inputs[0]]
-                idx = node.input_tensors[node.inputs[1]]
-                axis = node.attrs.get('axis', 0)
-                output = np.take(data, idx, axis=axis)
-                transformation_performed = True
-            elif node.op_type == 'Floor':
-                input = node.input_tensors[node.inputs[0]]
-                output = np.floor(input)
-                transformation_performed = True
-            elif node.op_type == 'Div' or node.op_type == 'Mul':
-                x = node.input_tensors[node.inputs[0]]
-                y = node.input_tensors[node.inputs[1]]
-                for child_node in node.children:
-                    # child_node.parents.remove(node)
-                    if node.op_type == 'Div':
-                        output = x / y
-                    else:
-                        output = x * y
-                transformation_performed = True
-            elif node.op_type == 'Slice':
-                x = node.input_tensors[node.inputs[0]]
-                ends = node.attrs['ends']
-                starts = node.attrs['starts']
-                axes = node.attrs.get('axes', range(len(starts)))
-                output = x
-                for i, a in enumerate(axes):
-                    s = starts[i]
-                    e = ends[i]
-                    n = x.shape[a]
-                    if s < 0: s += n
-                    if e < 0: e += n
-                    output = np.take(x, range(s, e), axis=a) # type: ignore
-                transformation_performed = True
-            elif node.op_type == 'Transpose':
-                x = node.input_tensors[node.inputs[0]]
-                perm = node.attrs.get('perm', None)
-                output = np.transpose(x, axes = perm)  # type: ignore
-                transformation_performed = True
-            elif node.op_type == 'Concat':
-                x_arr = []
-                for input_ in node.inputs:
-                    x_arr.append(node.input_tensors[input_])
-                axis = node.attrs.get('axis', 0)
-                output = np.concatenate(x_arr, axis=axis) # type: ignore
-                transformation_performed = True
-            elif node.op_type == 'Unsqueeze' or node.op_type == 'Squeeze':
-                x = node.input_tensors[node.inputs[0]]
-                if node.op_type == 'Unsqueeze':
-                    axes = node.attrs['axes']
-                    axes.sort()
-                    for axis in axes:
-                        output = np.expand_dims(x, axis=axis) # type: ignore
-                else:
-                    axes = node.attrs.get('axes', None)
-                    output = np.squeeze(x, axis = tuple(axes)) 
-                transformation_performed = True
-            elif node.op_type == 'Gemm':
-                alpha = node.attrs.get('alpha', 1.0)
-                beta = node.attrs.get('beta', 1.0)
-                transA = node.attrs.get('transA', False)
-                transB = node.attrs.get('transB', False)
-
-                A_tensor = node.input_tensors[node.inputs[0]]
-                B_tensor = node.input_tensors[node.inputs[1]]
-                C_tensor = node.input_tensors[node.inputs[2]]
-
-                A_tensor = np.transpose(A_tensor) if transA else A_tensor
-                B_tensor = np.transpose(B_tensor) if transB else B_tensor
-
-                output = alpha * np.dot(A_tensor, B_tensor) + beta * C_tensor
-                transformation_performed = True
-
-            if transformation_performed:
-                nodes_to_be_removed.append(node)
-                graph.shape_dict[node.outputs[0]] = output.shape
-                for child_node in node.children:
-                    child_node.parents.remove(node)
-                    child_node.input_tensors[node.outputs[0]] = output
-        transformed_nodes = []
-        for node in graph.nodes:
-            if node not in nodes_to_be_removed:
-                transformed_nodes.append(node)
-        return graph.create_graph(nodes=transformed_nodes)
+            outputs = self._fold(graph, node, inputs)
+            if outputs is None:
+                continue
+            nodes_to_be_removed.add(node)
+            for output_, value in zip(node.outputs, outputs):
+                if output_ == '':
+                    continue
+                graph.shape_dict[output_] = value.shape
+                for child_node in graph.consumers(output_):
+                    child_node.input_tensors[output_] = value
+        return graph.remove_nodes(nodes_to_be_removed)
 
 class DeadCodeElimination(object):
     '''
@@ -817,44 +2040,156 @@ class DeadCodeElimination(object):
     def __call__(self, graph):  # type: (Graph) -> Graph
         input_names = [str(input_[0]) for input_ in graph.inputs]
         output_names = set([str(output_[0]) for output_ in graph.outputs])
-        
-        nodes_to_be_removed = []
-        uses = {}
 
-        for _output in output_names:
-            uses[_output] = uses.get(_output, 0) + 1    
+        def is_used(edge):  # type: (Text) -> bool
+            if edge in output_names:
+                return True
+            for consumer in graph.consumers(edge):
+                if consumer not in nodes_to_be_removed:
+                    return True
+            return False
+
+        nodes_to_be_removed = set()
 
-        for node in graph.nodes:
-            for _input in node.inputs:
-                uses[_input] = uses.get(_input, 0) + 1
-        
         for node in reversed(graph.nodes):
             output_used = False
             for _output in node.outputs:
-                if _output in uses:
+                if is_used(_output):
                     output_used = True
                     break
 
             if not output_used:
                 # Remove current node
-                for _input in node.inputs:
-                    uses[_input] -= 1
-                    if uses[_input] == 0:
-                        del uses[_input]
-                nodes_to_be_removed.append(node.name)
-                for parent in node.parents:
-                    parent.children.remove(node)
+                nodes_to_be_removed.add(node)
 
-        transformed_nodes = []
-        for node in graph.nodes:
-            if node.name not in nodes_to_be_removed:
-                transformed_nodes.append(node)
-        
         for _input in input_names:
-            if _input not in uses:
+            if not is_used(_input):
                 for i in range(len(graph.inputs)):
                     if graph.inputs[i][0] is _input:
                         graph.inputs.remove(graph.inputs[i])
                         break
-        
-        return graph.create_graph(nodes=transformed_nodes)
\ No newline at end of file
+
+        return graph.remove_nodes(nodes_to_be_removed)
+
+# ops whose outputs differ between two runs with the same inputs
+_NONDETERMINISTIC_OP_TYPES = {'RandomNormal', 'RandomNormalLike', 'RandomUniform', 'RandomUniformLike', 'Multinomial'}
+
+def _prefix_key(value, nbytes=64):  # type: (Any, int) -> bytes
+    '''First bytes of a tensor value, read without decoding the whole tensor if possible'''
+    if isinstance(value, LazyTensor):
+        if not value.is_external and len(value.proto.raw_data) > 0:
+            return bytes(value.proto.raw_data[:nbytes])
+        value = value.numpy()
+    value = np.asarray(value).reshape(-1)
+    return value[:max(1, nbytes // max(1, value.itemsize))].tobytes()
+
+class CommonSubexpressionElimination(object):
+    '''
+    Merges the initializers with the same value, and then the nodes with the same
+    op type, attributes and inputs, e.g. the Shape/Gather/Unsqueeze chain
+    computed once per attention head. The consumers of a duplicate node use the
+    outputs of the first one instead.
+
+    The initializers are only merged on the first run: the following ones are
+    triggered by changes elsewhere in the graph, which don't add any. The keys of
+    the nodes are kept between runs: a node can only become a duplicate once its
+    inputs changed, so the following runs only key the nodes of the worklist.
+    '''
+    def __init__(self):  # type: () -> None
+        self.initializers_merged = False
+        # key to the first node with that key, and node to its key, None before the first run
+        self.first_nodes = None  # type: Optional[Dict[Tuple[Any, ...], Node]]
+        self.node_keys = {}  # type: Dict[Node, Tuple[Any, ...]]
+
+    @staticmethod
+    def _key(node):  # type: (Node) -> Tuple[Any, ...]
+        return (node.op_type, _attrs_key(node), tuple(node.inputs), len(node.outputs))
+
+    @staticmethod
+    def _merge_initializers(graph):  # type: (Graph) -> None
+        users = OrderedDict()  # type: Dict[Text, Node]
+        for node in graph.nodes:
+            for input_ in node.inputs:
+                if input_ in node.input_tensors and input_ not in users and graph.producer(input_) is None:
+                    users[input_] = node
+
+        # only initializers of the same type and shape are compared, first on their
+        # first bytes, and only those still alike are read and hashed in full
+        candidates = OrderedDict()  # type: Dict[Tuple[Any, ...], List[Text]]
+        for name, node in users.items():
+            value = node.input_tensors.get_lazy(name)
+            if not hasattr(value, 'shape'):
+                continue
+            candidates.setdefault((str(value.dtype), tuple(value.shape)), []).append(name)
+        prefix_candidates = OrderedDict()  # type: Dict[Tuple[Any, ...], List[Text]]
+        for key, names in candidates.items():
+            if len(names) < 2:
+                continue
+            for name in names:
+                prefix = _prefix_key(users[name].input_tensors.get_lazy(name))
+                prefix_candidates.setdefault(key + (prefix,), []).append(name)
+        canonical_names = {}  # type: Dict[Text, Text]
+        for names in prefix_candidates.values():
+            if len(names) < 2:
+                continue
+            first_names = {}  # type: Dict[Tuple[Any, ...], Text]
+            for name in names:
+                canonical_name = first_names.setdefault(_digest(users[name].input_tensors[name]), name)
+                if canonical_name != name:
+                    canonical_names[name] = canonical_name
+
+        if len(canonical_names) == 0:
+            return
+        for node in graph.nodes:
+            for i, input_ in enumerate(node.inputs):
+                canonical_name = canonical_names.get(input_)
+                if canonical_name is None:
+                    continue
+                value = node.input_tensors.get_lazy(input_)
+                graph.set_input(node, i, canonical_name)
+                if input_ not in node.inputs:
+                    del node.input_tensors[input_]
+                node.input_tensors[canonical_name] = value
+
+    def __call__(self, graph):  # type: (Graph) -> Graph
+        output_names = set([str(output_[0]) for output_ in graph.outputs])
+        if not self.initializers_merged:
+            self._merge_initializers(graph)
+            self.initializers_merged = True
+
+        if self.first_nodes is None or graph.worklist is None:
+            self.first_nodes = {}
+            self.node_keys = {}
+            nodes = graph.nodes
+        else:
+            nodes = graph.nodes_to_visit()
+            # the keys of the nodes of the worklist may be stale
+            for node in nodes:
+                old_key = self.node_keys.pop(node, None)
+                if old_key is not None and self.first_nodes.get(old_key) is node:
+                    del self.first_nodes[old_key]
+        first_nodes = self.first_nodes
+        replacements = []  # type: List[Tuple[Sequence[Node], Sequence[Node]]]
+        for node in nodes:
+            if node.op_type in _NONDETERMINISTIC_OP_TYPES:
+                continue
+            key = self._key(node)
+            first_node = first_nodes.get(key)
+            if first_node is None or not graph.index.has_node(first_node):
+                first_nodes[key] = first_node = node
+            if first_node is node:
+                self.node_keys[node] = key
+                continue
+            if any(output_ in output_names for output_ in node.outputs):
+                continue
+            for output_, first_output in zip(node.outputs, first_node.outputs):
+                for child in graph.consumers(output_):
+                    for i, child_input in enumerate(child.inputs):
+                        if child_input == output_:
+                            graph.set_input(child, i, first_output)
+                    graph.rewire_subgraph([child], [child])
+                    replacements.append(([child], [child]))
+            graph.rewire_subgraph([node], [])
+            replacements.append(([node], []))
+
+        return graph.apply_replacements(replacements)
@@ -4,9 +4,8 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import click
-from onnx import onnx_pb
 from onnx_coreml import convert
-from typing import Text, IO
+from typing import Text
 
 
 @click.command(
@@ -15,14 +14,13 @@ from typing import Text, IO
         'help_option_names': ['-h', '--help']
     }
 )
-@click.argument('onnx_model', type=click.File('rb'))
+@click.argument('onnx_model', type=click.Path(exists=True, dir_okay=False))
 @click.option('-o', '--output', required=True,
               type=str,
               help='Output path for the CoreML *.mlmodel file')
-def onnx_to_coreml(onnx_model, output):  # type: (IO[str], str) -> None
-    onnx_model_proto = onnx_pb.ModelProto()
-    onnx_model_proto.ParseFromString(onnx_model.read())
-    coreml_model = convert(onnx_model_proto)
+def onnx_to_coreml(onnx_model, output):  # type: (Text, str) -> None
+    # converting from the path lets weights stored as external data be memory-mapped
+    coreml_model = convert(onnx_model)
     coreml_model.save(output)
 
 
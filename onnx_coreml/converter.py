@@ -6,6 +6,9 @@ from typing import Text, Union, Optional, Dict, Any, Iterable, Sequence, Callabl
 
 import onnx
 import numpy as np
+import os
+import shutil
+import tempfile
 
 from onnx import shape_inference
 from onnx import TensorProto
@@ -22,14 +25,20 @@ from typing import Tuple
 from ._operators import _convert_node, _SEQUENCE_LAYERS_REGISTRY, _ONNX_NODE_REGISTRY, _add_const_inputs_if_required
 from ._operators_nd import _ONNX_NODE_REGISTRY_ND, _convert_node_nd
 
-from ._graph import Graph, EdgeInfo, Transformer
+from ._graph import Graph, EdgeInfo, Transformer, PassManager
+from ._shape_mapping import _RANK3_MAPPINGS, _choose_mapping
+from ._shape_inference import _symbolic_shapes
 
 from ._transformers import ConvAddFuser, DropoutRemover, \
     ReshapeInitTensorFuser, BNBroadcastedMulFuser, BNBroadcastedAddFuser, \
     PixelShuffleFuser, OutputRenamer, AddModelInputsOutputs, \
     ConstantsToInitializers, ImageScalerRemover, ShapeOpRemover, ConstantRemover, \
     ConstantFillToInitializers, ReshapeTransposeReshape_pattern1, CastOpRemover, \
-    DeadCodeElimination, PaddingOpRemover
+    DeadCodeElimination, PaddingOpRemover, FuserGroup, ConvBNFuser, ConvMulFuser, \
+    SiblingFuser, TransposeOptimizer, ReshapeChainFuser, AlgebraicSimplifier, \
+    CommonSubexpressionElimination, LayerNormFuser, LayerNormAffineFuser, GeluFuser, \
+    PadFuser, ImagePreprocessingFuser, DeprocessingFuser, ShapePropagation, \
+    ShapeSubgraphFolder
 
 # ML model passes
 from coremltools.converters.nnssa.coreml.graph_pass.mlmodel_passes import remove_disconnected_layers, transform_conv_crop
@@ -129,25 +138,24 @@ def _make_coreml_input_features(graph, onnx_coreml_input_shape_map, disable_core
                     graph.onnx_coreml_shape_mapping[input_[0]] = [1,2]
             elif len(shape) == 3:
                 # assume [C,H,W] unless its connected an op that bestows another mapping
+                mapp = [2, 3, 4]
                 if input_[0] in op_types and len(op_types[input_[0]]) == 1:
                     if str(op_types[input_[0]][0]) in _SEQUENCE_LAYERS_REGISTRY:
                         # (Seq,B,C)
-                        shape = [shape[2]]
-                        if USE_SHAPE_MAPPING:
-                            graph.onnx_coreml_shape_mapping[input_[0]] = [0, 1, 2]
+                        mapp = [0, 1, 2]
                     elif str(op_types[input_[0]][0]) in ['MaxPool','AveragePool','BatchNormalization',
                                                          'GlobalAveragePool','GlobalLpPool','GlobalMaxPool',
                                                          'InstanceNormalization','LRN','LpPool','Conv','ConvTranspose']:
                         # (B,C,W)
-                        shape = [shape[1],1,shape[2]]
-                        if USE_SHAPE_MAPPING:
-                            graph.onnx_coreml_shape_mapping[input_[0]] = [1, 2, 4]
-                    else:
-                        if USE_SHAPE_MAPPING:
-                            graph.onnx_coreml_shape_mapping[input_[0]] = [2, 3, 4]
-                else:
-                    if USE_SHAPE_MAPPING:
-                        graph.onnx_coreml_shape_mapping[input_[0]] = [2, 3, 4]
+                        mapp = [1, 2, 4]
+                # the mapping needing the fewest permute layers in the whole graph, on a tie the one guessed above
+                mapp = _choose_mapping(graph, input_[0], [mapp] + [m for m in _RANK3_MAPPINGS if m != mapp])
+                if mapp == [0, 1, 2]:
+                    shape = [shape[2]]
+                elif mapp == [1, 2, 4]:
+                    shape = [shape[1],1,shape[2]]
+                if USE_SHAPE_MAPPING:
+                    graph.onnx_coreml_shape_mapping[input_[0]] = mapp
             elif len(shape) == 4:  # (B,C,H,W) --> (C,H,W)
                 shape = shape[1:]
                 if USE_SHAPE_MAPPING:
@@ -320,13 +328,10 @@ def _convert_multiarray_output_to_image(spec,  # type: Any
         output.type.imageType.height = height
 
 
-def _set_deprocessing(is_grayscale,  # type: bool
-                      builder,  # type: NeuralNetworkBuilder
-                      deprocessing_args,  # type: Dict[Text, Any]
-                      input_name,  # type: Text
-                      output_name,  # type: Text
-                      ):
-    # type: (...) -> None
+def _deprocessing_scale_and_bias(is_grayscale,  # type: bool
+                                 deprocessing_args,  # type: Dict[Text, Any]
+                                 ):
+    # type: (...) -> Tuple[np.ndarray, np.ndarray]
     is_bgr = deprocessing_args.get('is_bgr', False)
 
     image_scale = deprocessing_args.get('image_scale', 1.0)
@@ -354,6 +359,17 @@ def _set_deprocessing(is_grayscale,  # type: bool
                 green_bias,
                 red_bias,
             ])
+    return W, b
+
+
+def _set_deprocessing(is_grayscale,  # type: bool
+                      builder,  # type: NeuralNetworkBuilder
+                      deprocessing_args,  # type: Dict[Text, Any]
+                      input_name,  # type: Text
+                      output_name,  # type: Text
+                      ):
+    # type: (...) -> None
+    W, b = _deprocessing_scale_and_bias(is_grayscale, deprocessing_args)
     builder.add_scale(
         name=input_name,
         W=W,
@@ -366,12 +382,42 @@ def _set_deprocessing(is_grayscale,  # type: bool
     )
 
 
-def _prepare_onnx_graph(graph, transformers, onnx_ir_version):  # type: (Graph, Iterable[Transformer]) -> Graph
-    graph_ = Graph.from_onnx(graph, onnx_ir_version)
+def _load_onnx_model(path):  # type: (Text) -> onnx.ModelProto
+    '''
+    Load an ONNX model file with inferred shapes. Tensors stored as external data
+    are left in their files, to be memory-mapped once they are read, and shape
+    inference runs on the file so that the model never gets serialized in memory.
+    '''
+    if not hasattr(shape_inference, 'infer_shapes_path'):
+        return shape_inference.infer_shapes(onnx.load(path, load_external_data=False))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        inferred_path = os.path.join(tmp_dir, os.path.basename(path))
+        shape_inference.infer_shapes_path(path, inferred_path)
+        return onnx.load(inferred_path, load_external_data=False)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def _pin_dims(graph, dim_values):  # type: (onnx.GraphProto, Dict[Text, int]) -> None
+    '''
+    Gives the named dimensions (dim_param) of the shapes of the inputs, outputs
+    and value infos of the graph the values in "dim_values"
+    '''
+    for value_info in list(graph.input) + list(graph.value_info) + list(graph.output):
+        for dim in value_info.type.tensor_type.shape.dim:
+            if dim.HasField('dim_param') and dim.dim_param in dim_values:
+                dim.dim_value = int(dim_values[dim.dim_param])
+
+def _prepare_onnx_graph(graph, transformers, onnx_ir_version, base_dir=None):
+    # type: (Graph, Iterable[Transformer], int, Optional[Text]) -> Graph
+    graph_ = Graph.from_onnx(graph, onnx_ir_version, base_dir)
     if DEBUG:
         plot_graph(graph_, graph_img_path='/tmp/graph_raw.pdf')
-    graph_ = graph_.transformed(transformers)
+    pass_manager = PassManager(transformers)
+    graph_ = pass_manager(graph_)
     if DEBUG:
+        for name, iterations in pass_manager.iterations.items():
+            print("Graph transformation %s ran %d time(s)" % (name, iterations))
         plot_graph(graph_, graph_img_path='/tmp/graph_opt.pdf')
     return graph_
 
@@ -386,7 +432,9 @@ def convert(model,  # type: Union[onnx.ModelProto, Text]
             add_custom_layers = False,  # type: bool
             custom_conversion_functions = {}, #type: Dict[Text, Any]
             onnx_coreml_input_shape_map = {}, # type: Dict[Text, List[int,...]]
-            minimum_ios_deployment_target = '12'):
+            minimum_ios_deployment_target = '12',  # type: Text
+            dim_values = {}, # type: Dict[Text, int]
+            ):
     # type: (...) -> MLModel
     """
     Convert ONNX model to CoreML.
@@ -394,7 +442,8 @@ def convert(model,  # type: Union[onnx.ModelProto, Text]
     ----------
     model:
         An ONNX model with parameters loaded in onnx package or path to file
-        with models.
+        with models. Weights of a model file saved with external data are
+        memory-mapped from their files instead of being loaded in memory.
     mode: 'classifier', 'regressor' or None
         Mode of the converted coreml model:
         'classifier', a NeuralNetworkClassifier spec will be constructed.
@@ -440,20 +489,32 @@ def convert(model,  # type: Union[onnx.ModelProto, Text]
          - (Supported features: https://github.com/apple/coremltools/releases/tag/v2.0)
         iSO 13 (CoreML 3.0)
          - (Supported features: https://github.com/apple/coremltools/releases/tag/3.0-beta6)
+    dim_values: dict()
+        (Optional) A dictionary with keys corresponding to the names of the dynamic dimensions of the model
+        (the "dim_param" of its input shapes, e.g. the batch size or the sequence length) and values the sizes
+        to convert the model for. The shapes computed from these dimensions then become static, which lets the
+        converter remove the Shape, Cast and Pad ops depending on them and use static CoreML layers.
+        e.g. {'batch': 1, 'sequence': 128}. The dimensions not given are tracked symbolically.
 
     Returns
     -------
     model: A coreml model.
     """
     if isinstance(model, Text):
-        onnx_model = onnx.load(model)
+        onnx_model = _load_onnx_model(model)
+        base_dir = os.path.dirname(os.path.abspath(model))  # type: Optional[Text]
     elif isinstance(model, onnx.ModelProto):
-        onnx_model = model
+        onnx_model = onnx.shape_inference.infer_shapes(model)
+        base_dir = None
     else:
         raise TypeError(
             "Model must be file path to .onnx file or onnx loaded model"
         )
 
+    if len(dim_values) > 0:
+        _pin_dims(onnx_model.graph, dim_values)
+    symbolic_shapes = _symbolic_shapes(onnx_model.graph)
+
     if not SupportedVersion.ios_support_check(minimum_ios_deployment_target):
         raise TypeError('{} not supported. Please provide one of target iOS: {}', minimum_ios_deployment_target, SupportedVersion.get_supported_ios())
         
@@ -478,27 +539,55 @@ def convert(model,  # type: Union[onnx.ModelProto, Text]
         def __call__(self, graph):
             return graph
 
+    # ops that can stay in the graph as runtime layers instead of being folded into large constants
+    runtime_op_types = set(custom_conversion_functions.keys())
+    runtime_op_types.update(_ONNX_NODE_REGISTRY_ND.keys() if disable_coreml_rank5_mapping else _ONNX_NODE_REGISTRY.keys())
+
+    algebraic_simplifier = AlgebraicSimplifier(supported_op_types=runtime_op_types)
+    shape_propagation = ShapePropagation(symbolic_shapes)
     transformers = [
         ConstantsToInitializers(),
+        # keeps graph.shape_dict up to date as the other transformers add edges,
+        # for the optimizers to apply and the converters to pick static layers
+        shape_propagation,
         ShapeOpRemover(),
-        ConstantRemover(),
+        ShapeSubgraphFolder(symbolic_shapes, shape_propagation),
+        ConstantRemover(runtime_op_types=runtime_op_types),
+        algebraic_simplifier,
+        CommonSubexpressionElimination(),
         CastOpRemover(),
         PaddingOpRemover(),
         ReshapeInitTensorFuser(),
-        DropoutRemover(),
+        # the fusers' patterns are all matched in a single traversal
+        FuserGroup([
+            DropoutRemover(),
+            ConvBNFuser(),
+            ConvMulFuser(),
+            ConvAddFuser(),
+            BNBroadcastedMulFuser(),
+            BNBroadcastedAddFuser(),
+            ReshapeTransposeReshape_pattern1(),
+            PixelShuffleFuser(),
+            PadFuser(),
+        ]),
+        # LayerNorm and GELU layers only exist in the ND (iOS 13) spec
+        FuserGroup([
+            LayerNormFuser(),
+            LayerNormAffineFuser(),
+            GeluFuser(),
+        ]) if disable_coreml_rank5_mapping else DummyTransformation(),
+        TransposeOptimizer(fold_transposed_a=disable_coreml_rank5_mapping),
+        ReshapeChainFuser(collapse_chains=disable_coreml_rank5_mapping),
+        SiblingFuser(equal_splits_only=not disable_coreml_rank5_mapping),
         DeadCodeElimination(),
-        ConvAddFuser(),
-        BNBroadcastedMulFuser(),
-        BNBroadcastedAddFuser(),
-        ReshapeTransposeReshape_pattern1(),
-        PixelShuffleFuser(),
         AddModelInputsOutputs() if not disable_coreml_rank5_mapping else DummyTransformation(),
-        ConstantFillToInitializers(),
+        ConstantFillToInitializers(runtime_op_types=runtime_op_types),
     ]  # type: Iterable[Transformer]
 
 
-    onnx_model = onnx.shape_inference.infer_shapes(onnx_model)
-    graph = _prepare_onnx_graph(onnx_model.graph, transformers, onnx_model.ir_version)
+    graph = _prepare_onnx_graph(onnx_model.graph, transformers, onnx_model.ir_version, base_dir)
+    if DEBUG and algebraic_simplifier.num_eliminated > 0:
+        print("Algebraic simplification eliminated %d layer(s)" % algebraic_simplifier.num_eliminated)
 
     '''
     Check for ImageScalar nodes in ONNX, this will indicate whether input image preprocessing needs
@@ -507,6 +596,7 @@ def convert(model,  # type: Union[onnx.ModelProto, Text]
     # are there ImageScaler nodes in the Graph?
     # If yes then add the info from it to the "preprocessing_args" dictionary, if the dictionary is not
     # already provided by the user
+    fold_image_preprocessing = not bool(preprocessing_args)
     if not bool(preprocessing_args):
         for node in graph.nodes:
             if node.op_type == 'ImageScaler':
@@ -536,6 +626,19 @@ def convert(model,  # type: Union[onnx.ModelProto, Text]
     # remove all ImageScaler ops
     graph = graph.transformed([ImageScalerRemover()])
 
+    # fold the normalization of the other image inputs into "preprocessing_args" as well
+    if fold_image_preprocessing:
+        scaled_input_names = preprocessing_args.get('image_scale', {}).keys()
+        image_preprocessing_fuser = ImagePreprocessingFuser(
+            [name for name in image_input_names if name not in scaled_input_names])
+        graph = graph.transformed([image_preprocessing_fuser])
+        for key, values in image_preprocessing_fuser.preprocessing_args.items():
+            preprocessing_args.setdefault(key, {}).update(values)  # type: ignore
+        # the per input values must be given for every image input
+        for key, values in preprocessing_args.items():
+            for name in image_input_names:
+                values.setdefault(name, 1.0 if key == 'image_scale' else 0.0)
+
     '''
     Gather information (name, shape) for model inputs and outputs
     This information is then used to initialize the neural network builder object of coremltools. 
@@ -571,10 +674,29 @@ def convert(model,  # type: Union[onnx.ModelProto, Text]
                     (not is_deprocess_bgr_only)
 
     if add_deprocess:
-        mapping = {}
+        is_grayscale_output = {}
         for f in output_features:
             output_name = f[0]
-            mapping[output_name] = graph.get_unique_edge_name(output_name)
+            if output_name not in image_output_names:
+                continue
+            output_shape = f[1].dimensions
+            if len(output_shape) == 2 or output_shape[0] == 1:
+                is_grayscale_output[output_name] = True
+            elif output_shape[0] == 3:
+                is_grayscale_output[output_name] = False
+            else:
+                raise ValueError('Output must be RGB image or Grayscale')
+
+        # fold the deprocessing into the layers producing the outputs when possible,
+        # the other outputs are renamed to get a deprocessing layer after conversion
+        deprocessing_fuser = DeprocessingFuser({
+            output_name: _deprocessing_scale_and_bias(is_grayscale, deprocessing_args)
+            for output_name, is_grayscale in is_grayscale_output.items()})
+        graph = graph.transformed([deprocessing_fuser])
+        mapping = {}
+        for output_name in is_grayscale_output:
+            if output_name not in deprocessing_fuser.fused_output_names:
+                mapping[output_name] = graph.get_unique_edge_name(output_name)
         graph = OutputRenamer(mapping)(graph)
 
 
@@ -621,6 +743,9 @@ def convert(model,  # type: Union[onnx.ModelProto, Text]
     err = ErrorHandling(add_custom_layers,
                         custom_conversion_functions)
 
+    # shapes of the edges added by the image pre and deprocessing transformers
+    graph = graph.transformed([ShapePropagation(symbolic_shapes)])
+
     for i, node in enumerate(graph.nodes):
         print("%d/%d: Converting Node Type %s" %(i+1, len(graph.nodes), node.op_type))
         if disable_coreml_rank5_mapping:
@@ -633,19 +758,9 @@ def convert(model,  # type: Union[onnx.ModelProto, Text]
         plot_graph(graph, graph_img_path='/tmp/after_conversion.pdf', show_coreml_mapped_shapes=not disable_coreml_rank5_mapping) 
 
     if add_deprocess:
-        for f in output_features:
-            output_name = f[0]
-            if output_name not in image_output_names:
-                continue
-            output_shape = f[1].dimensions
-            if len(output_shape) == 2 or output_shape[0] == 1:
-                is_grayscale = True
-            elif output_shape[0] == 3:
-                is_grayscale = False
-            else:
-                raise ValueError('Output must be RGB image or Grayscale')
+        for output_name in mapping:
             _set_deprocessing(
-                is_grayscale,
+                is_grayscale_output[output_name],
                 builder,
                 deprocessing_args,
                 mapping[output_name],
@@ -3,14 +3,21 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import os
+import shutil
+import tempfile
 import unittest
+import numpy as np
+import onnx
 
 from onnx import helper, numpy_helper, TensorProto
 
 from tests._test_utils import _onnx_create_single_node_model, \
     _onnx_create_model, _conv_pool_output_size, _random_array
 
-from onnx_coreml._graph import Node, Graph
+from onnx_coreml._graph import Node, Graph, PassManager, LazyTensor
+from onnx_coreml._transformers import DropoutRemover, ConstantsToInitializers, CastOpRemover
+from onnx_coreml._shape_mapping import _RANK3_MAPPINGS, _choose_mapping, _mapping_cost
 
 
 class NodeTest(unittest.TestCase):
@@ -29,6 +36,33 @@ class NodeTest(unittest.TestCase):
         self.assertTrue(len(node_.attrs) == 1)
         self.assertTrue(node_.attrs["alpha"] == 0.5)
 
+    def test_node_ids_and_adjacency(self):  # type: () -> None
+        a = Node("a", "Relu", {}, ["x"], ["y"])
+        b = Node("b", "Relu", {}, ["y"], ["z"])
+        self.assertNotEqual(a.id, b.id)
+        b.add_parent(a)
+        self.assertIn(b, a.children)
+        self.assertIs(b.get_only_parent(), a)
+        a.children.remove(b)
+        self.assertEqual(len(a.children), 0)
+        b.parents = []
+        self.assertEqual(len(b.parents), 0)
+        with self.assertRaises(AttributeError):
+            a.unknown_attribute = 1  # type: ignore
+
+    def test_colliding_node_names(self):  # type: () -> None
+        inputs = [('input', (1, 3))]
+        outputs = [('out', (1, 3), TensorProto.FLOAT)]
+        relu = helper.make_node("Relu", inputs=["input"], outputs=["y"], name="op")
+        exp = helper.make_node("Exp", inputs=["y"], outputs=["z"], name="op")
+        neg = helper.make_node("Neg", inputs=["z"], outputs=["out"], name="op_1")
+        model = _onnx_create_model([relu, exp, neg], inputs, outputs)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+        names = [node.name for node in graph.nodes]
+        self.assertEqual(len(set(names)), 3)
+        # the names don't depend on the nodes created before
+        self.assertEqual([node.name for node in Graph.from_onnx(model.graph, onnx_ir_version=5).nodes], names)
+
 
 class GraphTest(unittest.TestCase):
     def test_create_graph(self):  # type: () -> None
@@ -79,6 +113,176 @@ class GraphTest(unittest.TestCase):
         self.assertEqual(len(graph_.nodes[0].children), 1)
         self.assertEqual(len(graph_.nodes[1].children), 0)
 
+    def test_def_use_index(self):  # type: () -> None
+        inputs = [('input', (1, 3, 50, 50))]
+        outputs = [('out', (1, 3, 50, 50), TensorProto.FLOAT)]
+        relu = helper.make_node("Relu", inputs=["input"], outputs=["relu_output"])
+        drop = helper.make_node("Dropout", inputs=["relu_output"], outputs=["drop_output"])
+        add = helper.make_node("Add", inputs=["drop_output", "drop_output"], outputs=["out"])
+        model = _onnx_create_model([relu, drop, add], inputs, outputs)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+        self.assertIs(graph.producer("relu_output"), graph.nodes[0])
+        self.assertEqual(graph.consumers("drop_output"), [graph.nodes[2]])
+        self.assertEqual(graph.blob_to_op_type["drop_output"], ["Add", "Add"])
+        self.assertIsNone(graph.producer("input"))
+
+        new_graph = graph.transformed([DropoutRemover()])
+        relu_node, add_node = new_graph.nodes
+        self.assertIs(new_graph.producer("drop_output"), relu_node)
+        self.assertEqual(new_graph.consumers("drop_output"), [add_node])
+        self.assertFalse(new_graph.is_used("relu_output"))
+        self.assertEqual(new_graph.blob_from_op_type["drop_output"], "Relu")
+
+        self.assertTrue(new_graph.has_edge_name("out"))
+        names = [new_graph.get_unique_edge_name("out") for _ in range(3)]
+        self.assertEqual(names, ["out_0", "out_1", "out_2"])
+        self.assertEqual(new_graph.get_unique_edge_name("fresh"), "fresh")
+        self.assertEqual(new_graph.get_unique_edge_name("fresh"), "fresh_0")
+
+    def test_lazy_initializers(self):  # type: () -> None
+        weight = np.arange(6, dtype=np.float32).reshape(2, 3)
+        inputs = [('input', (2, 3))]
+        outputs = [('out', (2, 3), TensorProto.FLOAT)]
+        add = helper.make_node("Add", inputs=["input", "weight"], outputs=["out"])
+        model = _onnx_create_model([add], inputs, outputs,
+                                   initializer=[numpy_helper.from_array(weight, "weight")])
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+        input_tensors = graph.nodes[0].input_tensors
+        lazy = input_tensors.get_lazy("weight")
+        self.assertIsInstance(lazy, LazyTensor)
+        self.assertFalse(lazy.is_loaded)
+        self.assertEqual(lazy.shape, (2, 3))
+        self.assertEqual(lazy.nbytes, weight.nbytes)
+
+        np.testing.assert_array_equal(input_tensors["weight"], weight)
+        self.assertTrue(lazy.is_loaded)
+        self.assertIs(input_tensors["weight"], lazy.numpy())
+
+    def test_external_data_initializers(self):  # type: () -> None
+        weight = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+        inputs = [('input', (2, 3, 4))]
+        outputs = [('out', (2, 3, 4), TensorProto.FLOAT)]
+        add = helper.make_node("Add", inputs=["input", "weight"], outputs=["out"])
+        model = _onnx_create_model([add], inputs, outputs,
+                                   initializer=[numpy_helper.from_array(weight, "weight")])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            model_path = os.path.join(tmp_dir, "model.onnx")
+            onnx.save_model(model, model_path, save_as_external_data=True,
+                            location="weights.bin", size_threshold=0)
+            model = onnx.load(model_path, load_external_data=False)
+            graph = Graph.from_onnx(model.graph, onnx_ir_version=5, base_dir=tmp_dir)
+            lazy = graph.nodes[0].input_tensors.get_lazy("weight")
+            self.assertTrue(lazy.is_external)
+            self.assertEqual(lazy.shape, (2, 3, 4))
+            value = graph.nodes[0].input_tensors["weight"]
+            self.assertIsInstance(value, np.memmap)
+            np.testing.assert_array_equal(value, weight)
+            del value, lazy, graph
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_remove_and_replace_nodes(self):  # type: () -> None
+        inputs = [('input', (1, 3))]
+        outputs = [('out', (1, 3), TensorProto.FLOAT)]
+        relu = helper.make_node("Relu", inputs=["input"], outputs=["relu_output"])
+        cast = helper.make_node("Cast", inputs=["relu_output"], outputs=["cast_output"], to=1)
+        exp = helper.make_node("Exp", inputs=["cast_output"], outputs=["exp_output"])
+        log = helper.make_node("Log", inputs=["exp_output"], outputs=["out"])
+        model = _onnx_create_model([relu, cast, exp, log], inputs, outputs)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+        relu_node, cast_node, exp_node, log_node = graph.nodes
+
+        graph = graph.bypass_nodes([cast_node])
+        self.assertEqual(graph.nodes, [relu_node, exp_node, log_node])
+        self.assertEqual(exp_node.inputs, ["relu_output"])
+        self.assertEqual(list(exp_node.parents), [relu_node])
+        self.assertEqual(list(relu_node.children), [exp_node])
+
+        abs_node = Node("abs", "Abs", {}, ["relu_output"], ["out"])
+        graph = graph.replace_subgraph([exp_node, log_node], [abs_node])
+        self.assertEqual(graph.nodes, [relu_node, abs_node])
+        self.assertEqual(list(relu_node.children), [abs_node])
+        self.assertIs(graph.producer("out"), abs_node)
+        self.assertFalse(graph.is_used("exp_output"))
+
+        graph = graph.remove_nodes([abs_node])
+        self.assertEqual(graph.nodes, [relu_node])
+        self.assertEqual(len(relu_node.children), 0)
+        self.assertIsNone(graph.producer("out"))
+
+
+class ShapeMappingTest(unittest.TestCase):
+    def test_choose_rank3_input_mapping(self):  # type: () -> None
+        inputs = [('input', (2, 3, 8))]
+        outputs = [('out', (2, 3, 8), TensorProto.FLOAT)]
+        # the first consumer alone suggests [C,H,W], the softmax needs the ONNX axis 1 on channels
+        nodes = [helper.make_node("Relu", inputs=["input"], outputs=["relu"]),
+                 helper.make_node("Split", inputs=["relu"], outputs=["a", "b"], axis=1),
+                 helper.make_node("Concat", inputs=["a", "b"], outputs=["concat"], axis=1),
+                 helper.make_node("Softmax", inputs=["concat"], outputs=["out"], axis=1)]
+        model = _onnx_create_model(nodes, inputs, outputs)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+
+        self.assertIsNone(_mapping_cost(graph, 'input', [2, 3, 4]))
+        self.assertEqual(_mapping_cost(graph, 'input', [1, 2, 4]), 0)
+        self.assertEqual(_choose_mapping(graph, 'input', _RANK3_MAPPINGS), [1, 2, 4])
+
+    def test_fewest_permutes(self):  # type: () -> None
+        inputs = [('input', (3, 4, 8))]
+        outputs = [('out', (3, 4, 8), TensorProto.FLOAT)]
+        nodes = [helper.make_node("Split", inputs=["input"], outputs=["a", "b"], axis=2),
+                 helper.make_node("Concat", inputs=["a", "b"], outputs=["out"], axis=0)]
+        model = _onnx_create_model(nodes, inputs, outputs)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+
+        # split along W and concat along C as [C,H,W], a channel split and a sequence concat as [S,B,C]
+        self.assertEqual(_mapping_cost(graph, 'input', [2, 3, 4]), 3)
+        self.assertEqual(_mapping_cost(graph, 'input', [0, 1, 2]), 0)
+        self.assertEqual(_choose_mapping(graph, 'input', _RANK3_MAPPINGS), [0, 1, 2])
+
+
+class PassManagerTest(unittest.TestCase):
+    def test_skips_passes_and_counts_iterations(self):  # type: () -> None
+        inputs = [('input', (1, 3, 50, 50))]
+        outputs = [('out', (1, 3, 50, 50), TensorProto.FLOAT)]
+        relu = helper.make_node("Relu", inputs=["input"], outputs=["relu_output"])
+        drop = helper.make_node("Dropout", inputs=["relu_output"], outputs=["drop_output"])
+        exp = helper.make_node("Exp", inputs=["drop_output"], outputs=["out"])
+        model = _onnx_create_model([relu, drop, exp], inputs, outputs)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+
+        pass_manager = PassManager([ConstantsToInitializers(), DropoutRemover()])
+        new_graph = pass_manager(graph)
+
+        self.assertEqual(len(new_graph.nodes), 2)
+        self.assertEqual(new_graph.nodes[1].inputs[0], new_graph.nodes[0].outputs[0])
+        # no Constant op in the graph: the pass is never run
+        self.assertEqual(pass_manager.iterations['ConstantsToInitializers'], 0)
+        # the nodes touched by the fusion are not Dropouts: no second run is needed
+        self.assertEqual(pass_manager.iterations['DropoutRemover'], 1)
+
+    def test_revisits_consumers_of_new_shapes(self):  # type: () -> None
+        inputs = [('input', (1, 3, 50, 50))]
+        outputs = [('out', (1, 3, 50, 50), TensorProto.FLOAT)]
+        relu = helper.make_node("Relu", inputs=["input"], outputs=["relu_output"])
+        cast = helper.make_node("Cast", inputs=["relu_output"], outputs=["cast_output"], to=TensorProto.FLOAT)
+        exp = helper.make_node("Exp", inputs=["cast_output"], outputs=["out"])
+        model = _onnx_create_model([relu, cast, exp], inputs, outputs)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+
+        class SetShape(object):
+            def __call__(self, graph):  # type: (Graph) -> Graph
+                graph.shape_dict['relu_output'] = (1, 3, 50, 50)
+                return graph
+
+        # the Cast can only be removed once the shape of its input is known
+        pass_manager = PassManager([CastOpRemover(), SetShape()])
+        new_graph = pass_manager(graph)
+
+        self.assertEqual([node.op_type for node in new_graph.nodes], ['Relu', 'Exp'])
+        self.assertEqual(pass_manager.iterations['CastOpRemover'], 2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -13,7 +13,7 @@ from typing import Text
 
 from tests._test_utils import _test_single_node, \
     _random_array, _conv_pool_output_size, \
-    _onnx_create_single_node_model, _assert_outputs
+    _onnx_create_single_node_model, _onnx_create_model, _assert_outputs
 
 from coremltools.models.utils import macos_version
 
@@ -369,6 +369,24 @@ class SingleOperatorTest(unittest.TestCase):
         )
 
 
+    def test_conv_1d_stack_ios13(self):  # type: () -> None
+        W = from_array(_random_array((4, 4, 3)), name="W")
+        scale = from_array(_random_array((4,)), name="scale")
+        bias = from_array(_random_array((4,), random_seed=3), name="bias")
+        mean = from_array(np.zeros((4,), dtype=np.float32), name="mean")
+        var = from_array(np.ones((4,), dtype=np.float32), name="var")
+        nodes = [onnx.helper.make_node("Conv", inputs=["input", "W"], outputs=["conv1"], kernel_shape=[3], pads=[1, 1]),
+                 onnx.helper.make_node("BatchNormalization", inputs=["conv1", "scale", "bias", "mean", "var"], outputs=["bn"]),
+                 onnx.helper.make_node("Relu", inputs=["bn"], outputs=["relu"]),
+                 onnx.helper.make_node("Conv", inputs=["relu", "W"], outputs=["out"], kernel_shape=[3], pads=[1, 1])]
+        onnx_model = _onnx_create_model(nodes, [("input", (1, 4, 8))], [("out", (1, 4, 8), onnx.TensorProto.FLOAT)],
+                                        [W, scale, bias, mean, var])
+        spec = convert(onnx_model, minimum_ios_deployment_target='13').get_spec()
+        # the rank 3 tensor is expanded once for the whole run of 1-D layers
+        layer_types = [layer.WhichOneof('layer') for layer in spec.neuralNetwork.layers]
+        self.assertEqual(layer_types.count('expandDims'), 1)
+        self.assertEqual(layer_types.count('squeeze'), 1)
+
     # @unittest.skip("Error while preparing Caffe2 backend. Maybe something is incorrect in ONNX model definition")
     # def skip_test_lstm(self):  # type: () -> None
     #     x = 4
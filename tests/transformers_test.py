@@ -5,13 +5,21 @@ from __future__ import unicode_literals
 
 import unittest
 import numpy as np
+from typing import Any, List, Sequence, Text
 import numpy.testing as npt  # type: ignore
 
 from onnx import helper, numpy_helper, TensorProto
 
 from onnx_coreml import convert
-from onnx_coreml._graph import Graph
-from onnx_coreml._transformers import ConvAddFuser, DropoutRemover, ImageScalerRemover
+from onnx_coreml._graph import Graph, Node, PassManager
+from onnx_coreml._transformers import ConvAddFuser, DropoutRemover, ImageScalerRemover, \
+    BNBroadcastedMulFuser, FuserGroup, NodesFuser, ConstantRemover, ConvBNFuser, ConvMulFuser, \
+    SiblingFuser, TransposeOptimizer, ReshapeChainFuser, \
+    AlgebraicSimplifier, CommonSubexpressionElimination, LayerNormFuser, LayerNormAffineFuser, GeluFuser, \
+    PadFuser, ImagePreprocessingFuser, DeprocessingFuser, ShapePropagation, ShapeSubgraphFolder, \
+    DeadCodeElimination, ConstantsToInitializers, ConstantFillToInitializers
+from onnx_coreml._patterns import Op, Var, Chain, DAG, PatternMatcher
+from onnx_coreml._shape_inference import _propagate_shapes, _symbolic_shapes
 from tests._test_utils import _onnx_create_model, _test_onnx_model, \
     _conv_pool_output_size, _random_array
 
@@ -127,6 +135,929 @@ class ConvAddFuserTest(unittest.TestCase):
         self.assertEqual(fused_graph.nodes[0].outputs[0], outputs[0][0])
 
 
+class ConvBNFuserTest(unittest.TestCase):
+    def test_fold_batchnorm_into_conv(self):  # type: () -> None
+        inputs = [('input', (1, 3, 8, 8))]
+        outputs = [('out', (1, 4, 8, 8), TensorProto.FLOAT)]
+        w = _random_array((4, 3, 1, 1))
+        gamma, beta, mean = _random_array((4,)), _random_array((4,)), _random_array((4,))
+        var = np.abs(_random_array((4,))) + 0.5
+        initializer = [numpy_helper.from_array(w, name="weight")] + \
+            [numpy_helper.from_array(t, name=name) for t, name in
+             zip([gamma, beta, mean, var], ["gamma", "beta", "mean", "var"])]
+        conv = helper.make_node("Conv", inputs=["input", "weight"], outputs=["conv_output"], kernel_shape=(1, 1))
+        bn = helper.make_node("BatchNormalization", inputs=["conv_output", "gamma", "beta", "mean", "var"],
+                              outputs=["bn_output"], epsilon=1e-3)
+        relu = helper.make_node("Relu", inputs=["bn_output"], outputs=["out"])
+        model = _onnx_create_model([conv, bn, relu], inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+
+        fused_graph = ConvBNFuser()(graph)
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Conv', 'Relu'])
+        conv_node = fused_graph.nodes[0]
+        self.assertEqual(conv_node.outputs, ['bn_output'])
+
+        x = _random_array((3,))
+        scale = gamma / np.sqrt(var + 1e-3)
+        expected = (w[:, :, 0, 0].dot(x) - mean) * scale + beta
+        fused_w = conv_node.input_tensors[conv_node.inputs[1]]
+        fused_b = conv_node.input_tensors[conv_node.inputs[2]]
+        npt.assert_allclose(fused_w[:, :, 0, 0].dot(x) + fused_b, expected, rtol=1e-4, atol=1e-5)
+
+    def test_graph_output_is_kept(self):  # type: () -> None
+        inputs = [('input', (1, 3, 8, 8))]
+        outputs = [('conv_output', (1, 4, 8, 8), TensorProto.FLOAT), ('out', (1, 4, 8, 8), TensorProto.FLOAT)]
+        initializer = [numpy_helper.from_array(_random_array((4, 3, 1, 1)), name="weight")] + \
+            [numpy_helper.from_array(np.ones((4,), dtype=np.float32), name=name)
+             for name in ["gamma", "beta", "mean", "var"]]
+        conv = helper.make_node("Conv", inputs=["input", "weight"], outputs=["conv_output"], kernel_shape=(1, 1))
+        bn = helper.make_node("BatchNormalization", inputs=["conv_output", "gamma", "beta", "mean", "var"],
+                              outputs=["out"])
+        model = _onnx_create_model([conv, bn], inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+
+        # the Conv output is a model output: fusing would make it disappear
+        fused_graph = ConvBNFuser()(graph)
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Conv', 'BatchNormalization'])
+
+    def test_fold_mul_and_add_into_gemm(self):  # type: () -> None
+        inputs = [('input', (2, 3))]
+        outputs = [('out', (2, 4), TensorProto.FLOAT), ('other', (2, 4), TensorProto.FLOAT)]
+        b, c = _random_array((4, 3)), _random_array((4,))
+        scale, shift = _random_array((1, 4)), _random_array((4,))
+        initializer = [numpy_helper.from_array(t, name=name) for t, name in
+                       zip([b, c, scale, shift], ["b", "c", "scale", "shift"])]
+        gemm = helper.make_node("Gemm", inputs=["input", "b", "c"], outputs=["gemm_output"],
+                                transB=1, beta=0.5)
+        mul = helper.make_node("Mul", inputs=["scale", "gemm_output"], outputs=["mul_output"])
+        add = helper.make_node("Add", inputs=["mul_output", "shift"], outputs=["out"])
+        # "b" is also used by another node, whose weights must not change
+        other = helper.make_node("Gemm", inputs=["input", "b"], outputs=["other"], transB=1)
+        model = _onnx_create_model([gemm, mul, add, other], inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+        fused_graph = FuserGroup([ConvMulFuser(), ConvAddFuser()])(graph)
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Gemm', 'Gemm'])
+        gemm_node = [node for node in fused_graph.nodes if node.outputs == ['out']][0]
+        other_node = [node for node in fused_graph.nodes if node.outputs == ['other']][0]
+        npt.assert_equal(other_node.input_tensors["b"], b)
+
+        x = _random_array((2, 3))
+        expected = (x.dot(b.T) + 0.5 * c) * scale + shift
+        fused_b = gemm_node.input_tensors[gemm_node.inputs[1]]
+        fused_c = gemm_node.input_tensors[gemm_node.inputs[2]]
+        self.assertEqual(gemm_node.attrs['beta'], 1.0)
+        npt.assert_allclose(x.dot(fused_b.T) + fused_c, expected, rtol=1e-4, atol=1e-5)
+
+
+class SiblingFuserTest(unittest.TestCase):
+    def test_fuse_matmul_projections(self):  # type: () -> None
+        inputs = [('input', (2, 5, 4))]
+        outputs = [(name, (2, 5, 3), TensorProto.FLOAT) for name in ['q', 'k', 'v']]
+        nodes, initializer, weights = [], [], []
+        for name in ['q', 'k', 'v']:
+            w, b = _random_array((4, 3)), _random_array((3,))
+            weights.append((w, b))
+            initializer += [numpy_helper.from_array(w, name=name + '_w'), numpy_helper.from_array(b, name=name + '_b')]
+            nodes.append(helper.make_node("MatMul", inputs=["input", name + '_w'], outputs=[name + '_mm']))
+            nodes.append(helper.make_node("Add", inputs=[name + '_mm', name + '_b'], outputs=[name]))
+        model = _onnx_create_model(nodes, inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+        fused_graph = SiblingFuser()(graph)
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['MatMul', 'Add', 'Split'])
+        matmul, add, split = fused_graph.nodes
+        self.assertEqual(split.outputs, ['q', 'k', 'v'])
+        self.assertEqual(split.attrs, {'axis': 2, 'split': [3, 3, 3]})
+        self.assertEqual(fused_graph.shape_dict[add.outputs[0]], (2, 5, 9))
+
+        x = _random_array((2, 5, 4))
+        y = x.dot(matmul.input_tensors[matmul.inputs[1]]) + add.input_tensors[add.inputs[1]]
+        for (w, b), y_i in zip(weights, np.split(y, 3, axis=2)):
+            npt.assert_allclose(y_i, x.dot(w) + b, rtol=1e-5, atol=1e-6)
+
+    def test_fuse_convs_of_different_widths(self):  # type: () -> None
+        inputs = [('input', (1, 3, 8, 8))]
+        outputs = [('out', (1, 7, 8, 8), TensorProto.FLOAT)]
+        w1, w2, b2 = _random_array((4, 3, 1, 1)), _random_array((3, 3, 1, 1)), _random_array((3,))
+        initializer = [numpy_helper.from_array(w1, name="w1"), numpy_helper.from_array(w2, name="w2"),
+                       numpy_helper.from_array(b2, name="b2")]
+        conv1 = helper.make_node("Conv", inputs=["input", "w1"], outputs=["c1"], kernel_shape=(1, 1))
+        conv2 = helper.make_node("Conv", inputs=["input", "w2", "b2"], outputs=["c2"], kernel_shape=(1, 1))
+        concat = helper.make_node("Concat", inputs=["c1", "c2"], outputs=["out"], axis=1)
+        model = _onnx_create_model([conv1, conv2, concat], inputs, outputs, initializer)
+
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+        unfused_graph = SiblingFuser(equal_splits_only=True)(graph)
+        self.assertEqual([node.op_type for node in unfused_graph.nodes], ['Conv', 'Conv', 'Concat'])
+
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+        fused_graph = SiblingFuser()(graph)
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Conv', 'Split', 'Concat'])
+        conv, split = fused_graph.nodes[:2]
+        self.assertEqual(split.attrs['split'], [4, 3])
+        self.assertEqual(conv.input_tensors[conv.inputs[1]].shape, (7, 3, 1, 1))
+        npt.assert_equal(conv.input_tensors[conv.inputs[2]], np.concatenate([np.zeros((4,)), b2]))
+        self.assertEqual(fused_graph.nodes[2].parents[0], split)
+
+
+class TransposeOptimizerTest(unittest.TestCase):
+    def test_sink_and_cancel_transposes(self):  # type: () -> None
+        inputs = [('input', (1, 3, 4, 5)), ('other', (1, 3, 4, 5))]
+        outputs = [('out', (1, 3, 4, 5), TensorProto.FLOAT)]
+        c = _random_array((3,))
+        to_nhwc = helper.make_node("Transpose", inputs=["input"], outputs=["nhwc"], perm=[0, 2, 3, 1])
+        other_to_nhwc = helper.make_node("Transpose", inputs=["other"], outputs=["other_nhwc"], perm=[0, 2, 3, 1])
+        relu = helper.make_node("Relu", inputs=["nhwc"], outputs=["relu"])
+        add = helper.make_node("Add", inputs=["relu", "c"], outputs=["add"])
+        mul = helper.make_node("Mul", inputs=["add", "other_nhwc"], outputs=["mul"])
+        to_nchw = helper.make_node("Transpose", inputs=["mul"], outputs=["out"], perm=[0, 3, 1, 2])
+        model = _onnx_create_model([to_nhwc, other_to_nhwc, relu, add, mul, to_nchw], inputs, outputs,
+                                   [numpy_helper.from_array(c, name="c")])
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+        optimized_graph = TransposeOptimizer()(graph)
+        self.assertEqual([node.op_type for node in optimized_graph.nodes], ['Relu', 'Add', 'Mul'])
+        relu_node, add_node, mul_node = optimized_graph.nodes
+        self.assertEqual(relu_node.inputs, ['input'])
+        self.assertEqual(mul_node.inputs[1], 'other')
+        self.assertEqual(mul_node.outputs, ['out'])
+
+        x = _random_array((1, 3, 4, 5))
+        other = _random_array((1, 3, 4, 5))
+        expected = np.transpose((np.maximum(np.transpose(x, [0, 2, 3, 1]), 0) + c) *
+                                np.transpose(other, [0, 2, 3, 1]), [0, 3, 1, 2])
+        result = (np.maximum(x, 0) + add_node.input_tensors[add_node.inputs[1]]) * other
+        npt.assert_allclose(result, expected, rtol=1e-6)
+
+    def test_fold_transposes_into_gemm(self):  # type: () -> None
+        inputs = [('a', (3, 2)), ('b', (4, 3))]
+        outputs = [('out', (2, 4), TensorProto.FLOAT)]
+        transpose_a = helper.make_node("Transpose", inputs=["a"], outputs=["a_t"], perm=[1, 0])
+        transpose_b = helper.make_node("Transpose", inputs=["b"], outputs=["b_t"], perm=[1, 0])
+        matmul = helper.make_node("MatMul", inputs=["a_t", "b_t"], outputs=["out"])
+        model = _onnx_create_model([transpose_a, transpose_b, matmul], inputs, outputs)
+
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+        optimized_graph = TransposeOptimizer()(graph)
+        self.assertEqual([node.op_type for node in optimized_graph.nodes], ['Gemm'])
+        gemm = optimized_graph.nodes[0]
+        self.assertEqual(gemm.inputs, ['a', 'b'])
+        self.assertEqual(gemm.attrs, {'transA': 1, 'transB': 1})
+
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+        optimized_graph = TransposeOptimizer(fold_transposed_a=False)(graph)
+        self.assertEqual([node.op_type for node in optimized_graph.nodes], ['Transpose', 'Gemm'])
+        self.assertEqual(optimized_graph.nodes[1].inputs, ['a_t', 'b'])
+        self.assertEqual(optimized_graph.nodes[1].attrs, {'transB': 1})
+
+
+class ReshapeChainFuserTest(unittest.TestCase):
+    def test_collapse_chain(self):  # type: () -> None
+        inputs = [('input', (2, 3, 4))]
+        outputs = [('out', (6, 4), TensorProto.FLOAT)]
+        shape = numpy_helper.from_array(np.asarray([0, 0, 0, 4, 1], dtype=np.int64), name="shape")
+        unsqueeze = helper.make_node("Unsqueeze", inputs=["input"], outputs=["u"], axes=[0])
+        reshape = helper.make_node("Reshape", inputs=["u", "shape"], outputs=["r"])
+        flatten = helper.make_node("Flatten", inputs=["r"], outputs=["f"], axis=3)
+        squeeze = helper.make_node("Squeeze", inputs=["f"], outputs=["s"])
+        relu = helper.make_node("Relu", inputs=["s"], outputs=["out"])
+        model = _onnx_create_model([unsqueeze, reshape, flatten, squeeze, relu], inputs, outputs, [shape])
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+        fused_graph = ReshapeChainFuser()(graph)
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Reshape', 'Relu'])
+        reshape_node = fused_graph.nodes[0]
+        self.assertEqual(reshape_node.inputs[0], 'input')
+        self.assertEqual(reshape_node.outputs, ['s'])
+        npt.assert_equal(reshape_node.input_tensors[reshape_node.inputs[1]], [6, 4])
+
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+        kept_graph = ReshapeChainFuser(collapse_chains=False)(graph)
+        # only the Squeeze, which doesn't change the shape, is removed
+        self.assertEqual([node.op_type for node in kept_graph.nodes], ['Unsqueeze', 'Reshape', 'Flatten', 'Relu'])
+
+    def test_remove_identity(self):  # type: () -> None
+        inputs = [('input', (2, 3))]
+        outputs = [('out', (2, 3), TensorProto.FLOAT)]
+        unsqueeze = helper.make_node("Unsqueeze", inputs=["input"], outputs=["u"], axes=[1])
+        squeeze = helper.make_node("Squeeze", inputs=["u"], outputs=["s"], axes=[1])
+        relu = helper.make_node("Relu", inputs=["s"], outputs=["out"])
+        model = _onnx_create_model([unsqueeze, squeeze, relu], inputs, outputs)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+        fused_graph = ReshapeChainFuser()(graph)
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Relu'])
+        self.assertEqual(fused_graph.nodes[0].inputs, ['input'])
+        self.assertEqual(len(fused_graph.nodes[0].parents), 0)
+
+
+class AlgebraicSimplifierTest(unittest.TestCase):
+    def _model(self, nodes, initializer):  # type: (Sequence[helper.NodeProto], Sequence[TensorProto]) -> Graph
+        inputs = [('input', (2, 3))]
+        outputs = [('out', (2, 3), TensorProto.FLOAT)]
+        model = _onnx_create_model(nodes, inputs, outputs, initializer)
+        return Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+    def test_remove_identities(self):  # type: () -> None
+        initializer = [numpy_helper.from_array(np.asarray(v, dtype=np.float32), name=name)
+                       for v, name in [(1., "one"), (np.zeros((3,)), "zeros"), (np.zeros((4, 1, 1)), "big_zeros")]]
+        nodes = [helper.make_node("Mul", inputs=["one", "input"], outputs=["a"]),
+                 helper.make_node("Add", inputs=["a", "zeros"], outputs=["b"]),
+                 helper.make_node("Neg", inputs=["b"], outputs=["c"]),
+                 helper.make_node("Neg", inputs=["c"], outputs=["d"]),
+                 # adding zeros of a larger shape broadcasts the input, it isn't an identity
+                 helper.make_node("Sub", inputs=["d", "big_zeros"], outputs=["out"])]
+        simplifier = AlgebraicSimplifier()
+        simplified_graph = simplifier(self._model(nodes, initializer))
+        self.assertEqual([node.op_type for node in simplified_graph.nodes], ['Sub'])
+        self.assertEqual(simplified_graph.nodes[0].inputs, ['input', 'big_zeros'])
+        self.assertEqual(simplifier.num_eliminated, 4)
+
+    def test_strength_reduction(self):  # type: () -> None
+        initializer = [numpy_helper.from_array(np.asarray(v, dtype=np.float32), name=name)
+                       for v, name in [(4., "four"), (2., "two"), (0.5, "half")]]
+        nodes = [helper.make_node("Div", inputs=["input", "four"], outputs=["a"]),
+                 helper.make_node("Pow", inputs=["a", "two"], outputs=["b"]),
+                 helper.make_node("Pow", inputs=["b", "half"], outputs=["c"]),
+                 helper.make_node("Reciprocal", inputs=["c"], outputs=["out"])]
+        simplified_graph = AlgebraicSimplifier(supported_op_types=['Mul', 'Sqrt', 'Rsqrt'])(
+            self._model(nodes, initializer))
+        self.assertEqual([node.op_type for node in simplified_graph.nodes], ['Mul', 'Mul', 'Rsqrt'])
+        mul, square, rsqrt = simplified_graph.nodes
+        npt.assert_equal(mul.input_tensors[mul.inputs[1]], np.float32(0.25))
+        self.assertEqual(square.inputs, ['a', 'a'])
+        self.assertEqual(rsqrt.inputs, ['b'])
+        self.assertEqual(rsqrt.outputs, ['out'])
+
+        # without Rsqrt, Sqrt and Reciprocal are kept
+        simplified_graph = AlgebraicSimplifier(supported_op_types=['Mul', 'Sqrt'])(self._model(nodes, initializer))
+        self.assertEqual([node.op_type for node in simplified_graph.nodes], ['Mul', 'Mul', 'Sqrt', 'Reciprocal'])
+
+
+class CommonSubexpressionEliminationTest(unittest.TestCase):
+    def test_merge_duplicates(self):  # type: () -> None
+        inputs = [('input', (2, 3, 4))]
+        outputs = [('out1', (2, 3, 4), TensorProto.FLOAT), ('out2', (2, 3, 4), TensorProto.FLOAT)]
+        scale = _random_array((4,))
+        initializer = [numpy_helper.from_array(scale, name="scale1"), numpy_helper.from_array(scale, name="scale2"),
+                       numpy_helper.from_array(_random_array((4,), random_seed=3), name="other_scale")]
+        nodes = []
+        for i, scale_name in [(1, "scale1"), (2, "scale2")]:
+            nodes.append(helper.make_node("ReduceMean", inputs=["input"], outputs=["mean%d" % i], axes=[-1]))
+            nodes.append(helper.make_node("Sub", inputs=["input", "mean%d" % i], outputs=["sub%d" % i]))
+            nodes.append(helper.make_node("Mul", inputs=["sub%d" % i, scale_name], outputs=["mul%d" % i]))
+        nodes.append(helper.make_node("Mul", inputs=["mul1", "other_scale"], outputs=["out1"]))
+        nodes.append(helper.make_node("Mul", inputs=["mul2", "other_scale"], outputs=["out2"]))
+        model = _onnx_create_model(nodes, inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+        cse_graph = CommonSubexpressionElimination()(graph)
+        self.assertEqual([node.op_type for node in cse_graph.nodes], ['ReduceMean', 'Sub', 'Mul', 'Mul', 'Mul'])
+        mul = cse_graph.nodes[2]
+        self.assertEqual(mul.inputs, ['sub1', 'scale1'])
+        # the graph outputs are kept
+        self.assertEqual([node.inputs for node in cse_graph.nodes[3:]], [['mul1', 'other_scale']] * 2)
+        self.assertEqual(set(mul.children), set(cse_graph.nodes[3:]))
+        # an initializer whose first bytes differ from those of the others is never decoded
+        self.assertFalse(cse_graph.nodes[3].input_tensors.get_lazy("other_scale").is_loaded)
+
+    def test_following_runs_only_key_the_worklist(self):  # type: () -> None
+        inputs = [('input', (2, 3))]
+        outputs = [('out1', (2, 3), TensorProto.FLOAT), ('out2', (2, 3), TensorProto.FLOAT)]
+        nodes = [helper.make_node("Relu", inputs=["input"], outputs=["relu"]),
+                 helper.make_node("Exp", inputs=["relu"], outputs=["exp1"]),
+                 helper.make_node("Neg", inputs=["input"], outputs=["neg"]),
+                 helper.make_node("Exp", inputs=["neg"], outputs=["exp2"]),
+                 helper.make_node("Sigmoid", inputs=["exp1"], outputs=["out1"]),
+                 helper.make_node("Sigmoid", inputs=["exp2"], outputs=["out2"])]
+        model = _onnx_create_model(nodes, inputs, outputs)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+        cse = CommonSubexpressionElimination()
+        graph = cse(graph)
+        self.assertEqual(len(graph.nodes), 6)
+
+        # the Neg becomes a Relu: only it, and then its consumer, are keyed again
+        neg = graph.nodes[2]
+        replaced = Node(neg.name, 'Relu', {}, neg.inputs, neg.outputs)
+        graph = graph.replace_subgraph([neg], [replaced])
+        keyed = []  # type: List[Node]
+        key = cse._key
+        cse._key = lambda node: keyed.append(node) or key(node)  # type: ignore
+        graph.worklist = {replaced}
+        graph = cse(graph)
+        self.assertEqual(keyed, [replaced])
+        self.assertEqual([node.op_type for node in graph.nodes], ['Relu', 'Exp', 'Exp', 'Sigmoid', 'Sigmoid'])
+
+        graph.worklist = set(graph.consumers('relu'))
+        keyed[:] = []
+        graph = cse(graph)
+        self.assertEqual(len(keyed), 2)
+        self.assertEqual([node.op_type for node in graph.nodes], ['Relu', 'Exp', 'Sigmoid', 'Sigmoid'])
+
+
+class LayerNormGeluFuserTest(unittest.TestCase):
+    def test_fuse_layer_norm(self):  # type: () -> None
+        inputs = [('input', (2, 3, 4))]
+        outputs = [('out', (2, 3, 4), TensorProto.FLOAT)]
+        gamma, beta = _random_array((4,)), _random_array((4,), random_seed=3)
+        initializer = [numpy_helper.from_array(np.asarray(v, dtype=np.float32), name=name)
+                       for v, name in [(2., "two"), (1e-5, "epsilon"), (gamma, "gamma"), (beta, "beta")]]
+        nodes = [helper.make_node("ReduceMean", inputs=["input"], outputs=["mean"], axes=[-1]),
+                 helper.make_node("Sub", inputs=["input", "mean"], outputs=["sub"]),
+                 helper.make_node("Pow", inputs=["sub", "two"], outputs=["square"]),
+                 helper.make_node("ReduceMean", inputs=["square"], outputs=["variance"], axes=[2]),
+                 helper.make_node("Add", inputs=["variance", "epsilon"], outputs=["add_epsilon"]),
+                 helper.make_node("Sqrt", inputs=["add_epsilon"], outputs=["std"]),
+                 helper.make_node("Div", inputs=["sub", "std"], outputs=["normalized"]),
+                 helper.make_node("Mul", inputs=["normalized", "gamma"], outputs=["scaled"]),
+                 helper.make_node("Add", inputs=["scaled", "beta"], outputs=["out"])]
+        model = _onnx_create_model(nodes, inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+        fused_graph = FuserGroup([LayerNormFuser(), LayerNormAffineFuser()])(graph)
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['LayerNormalization'])
+        layer_norm = fused_graph.nodes[0]
+        self.assertEqual(layer_norm.attrs['axis'], -1)
+        self.assertAlmostEqual(layer_norm.attrs['epsilon'], 1e-5)
+        self.assertEqual(layer_norm.inputs[0], 'input')
+        self.assertEqual(layer_norm.outputs, ['out'])
+        npt.assert_allclose(layer_norm.input_tensors[layer_norm.inputs[1]], gamma, rtol=1e-6)
+        npt.assert_allclose(layer_norm.input_tensors[layer_norm.inputs[2]], beta, rtol=1e-6)
+
+    def test_layer_norm_not_over_last_axes(self):  # type: () -> None
+        inputs = [('input', (2, 3, 4))]
+        outputs = [('out', (2, 3, 4), TensorProto.FLOAT)]
+        initializer = [numpy_helper.from_array(np.asarray(1e-5, dtype=np.float32), name="epsilon")]
+        nodes = [helper.make_node("ReduceMean", inputs=["input"], outputs=["mean"], axes=[1]),
+                 helper.make_node("Sub", inputs=["input", "mean"], outputs=["sub"]),
+                 helper.make_node("Mul", inputs=["sub", "sub"], outputs=["square"]),
+                 helper.make_node("ReduceMean", inputs=["square"], outputs=["variance"], axes=[1]),
+                 helper.make_node("Add", inputs=["variance", "epsilon"], outputs=["add_epsilon"]),
+                 helper.make_node("Sqrt", inputs=["add_epsilon"], outputs=["std"]),
+                 helper.make_node("Div", inputs=["sub", "std"], outputs=["out"])]
+        model = _onnx_create_model(nodes, inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+        fused_graph = LayerNormFuser()(graph)
+        self.assertEqual(len(fused_graph.nodes), 7)
+
+    def test_fuse_gelu(self):  # type: () -> None
+        inputs = [('input', (2, 3))]
+        outputs = [('out', (2, 3), TensorProto.FLOAT)]
+        initializer = [numpy_helper.from_array(np.asarray(v, dtype=np.float32), name=name)
+                       for v, name in [(np.sqrt(2.), "sqrt2"), (1., "one"), (0.5, "half")]]
+        nodes = [helper.make_node("Div", inputs=["input", "sqrt2"], outputs=["scaled"]),
+                 helper.make_node("Erf", inputs=["scaled"], outputs=["erf"]),
+                 helper.make_node("Add", inputs=["erf", "one"], outputs=["add_one"]),
+                 helper.make_node("Mul", inputs=["add_one", "input"], outputs=["mul"]),
+                 helper.make_node("Mul", inputs=["mul", "half"], outputs=["out"])]
+        model = _onnx_create_model(nodes, inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+        fused_graph = GeluFuser()(graph)
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Gelu'])
+        self.assertEqual(fused_graph.nodes[0].inputs, ['input'])
+        self.assertEqual(fused_graph.nodes[0].outputs, ['out'])
+
+    def test_fuse_gelu_with_half_first(self):  # type: () -> None
+        # x * 0.5 * (1.0 + erf(x / sqrt(2))), as exported from HuggingFace BERT
+        inputs = [('input', (2, 3))]
+        outputs = [('out', (2, 3), TensorProto.FLOAT)]
+        initializer = [numpy_helper.from_array(np.asarray(v, dtype=np.float32), name=name)
+                       for v, name in [(np.sqrt(2.), "sqrt2"), (1., "one"), (0.5, "half")]]
+        nodes = [helper.make_node("Div", inputs=["input", "sqrt2"], outputs=["scaled"]),
+                 helper.make_node("Erf", inputs=["scaled"], outputs=["erf"]),
+                 helper.make_node("Add", inputs=["one", "erf"], outputs=["add_one"]),
+                 helper.make_node("Mul", inputs=["input", "half"], outputs=["halved"]),
+                 helper.make_node("Mul", inputs=["halved", "add_one"], outputs=["out"])]
+        model = _onnx_create_model(nodes, inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+        fused_graph = GeluFuser()(graph)
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Gelu'])
+        self.assertEqual(fused_graph.nodes[0].inputs, ['input'])
+        self.assertEqual(fused_graph.nodes[0].outputs, ['out'])
+
+
+class PadFuserTest(unittest.TestCase):
+    def _model(self, pool_type, pad_pads, value, **kwargs):  # type: (Text, Sequence[int], float, **Any) -> Graph
+        inputs = [('input', (1, 3, 8, 8))]
+        outputs = [('out', (1, 3, 8, 8), TensorProto.FLOAT)]
+        nodes = [helper.make_node("Pad", inputs=["input"], outputs=["padded"], mode="constant", pads=pad_pads, value=value),
+                 helper.make_node(pool_type, inputs=["padded"], outputs=["out"], kernel_shape=[3, 3], **kwargs)]
+        model = _onnx_create_model(nodes, inputs, outputs)
+        return Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+    def test_fuse_pad_into_pool(self):  # type: () -> None
+        graph = self._model("MaxPool", [0, 0, 1, 2, 0, 0, 1, 0], float('-inf'), pads=[1, 0, 0, 0])
+        fused_graph = PadFuser()(graph)
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['MaxPool'])
+        pool = fused_graph.nodes[0]
+        self.assertEqual(pool.inputs, ['input'])
+        self.assertEqual(pool.attrs['pads'], [2, 2, 1, 0])
+
+        graph = self._model("AveragePool", [0, 0, 1, 1, 0, 0, 1, 1], 0., count_include_pad=1)
+        fused_graph = PadFuser()(graph)
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['AveragePool'])
+        self.assertEqual(fused_graph.nodes[0].attrs['pads'], [1, 1, 1, 1])
+
+    def test_keep_pad(self):  # type: () -> None
+        for pool_type, pads, value, kwargs in [
+                # zero padding isn't what max pooling pads with
+                ("MaxPool", [0, 0, 1, 1, 0, 0, 1, 1], 0., {}),
+                # the padded area is excluded from the average
+                ("AveragePool", [0, 0, 1, 1, 0, 0, 1, 1], 0., {}),
+                # padding of the channels
+                ("AveragePool", [0, 1, 1, 1, 0, 0, 1, 1], 0., {'count_include_pad': 1}),
+                ("AveragePool", [0, 0, 1, 1, 0, 0, 1, 1], 0., {'count_include_pad': 1, 'auto_pad': 'SAME_UPPER'})]:
+            graph = self._model(pool_type, pads, value, **kwargs)
+            fused_graph = PadFuser()(graph)
+            self.assertEqual([node.op_type for node in fused_graph.nodes], ['Pad', pool_type])
+
+
+class ImagePreprocessingFuserTest(unittest.TestCase):
+    def _model(self, nodes, initializer):  # type: (Sequence[helper.NodeProto], Sequence[TensorProto]) -> Graph
+        inputs = [('input', (1, 3, 4, 4))]
+        outputs = [('out', (1, 2, 2, 2), TensorProto.FLOAT)]
+        model = _onnx_create_model(nodes, inputs, outputs, initializer)
+        return Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+    def test_fold_uniform_scale(self):  # type: () -> None
+        mean = np.asarray([0.5, 0.25, 0.125], dtype=np.float32).reshape((3, 1, 1))
+        initializer = [numpy_helper.from_array(np.asarray(v, dtype=np.float32), name=name)
+                       for v, name in [(1. / 255, "scale"), (mean, "mean"), (2., "std")]]
+        nodes = [helper.make_node("Mul", inputs=["scale", "input"], outputs=["scaled"]),
+                 helper.make_node("Sub", inputs=["scaled", "mean"], outputs=["centered"]),
+                 helper.make_node("Div", inputs=["centered", "std"], outputs=["normalized"]),
+                 helper.make_node("MaxPool", inputs=["normalized"], outputs=["out"], kernel_shape=[2, 2])]
+        fuser = ImagePreprocessingFuser(['input'])
+        fused_graph = fuser(self._model(nodes, initializer))
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['MaxPool'])
+        self.assertEqual(fused_graph.nodes[0].inputs, ['input'])
+        self.assertAlmostEqual(fuser.preprocessing_args['image_scale']['input'], 0.5 / 255)
+        for color, value in zip(['red', 'green', 'blue'], [-0.25, -0.125, -0.0625]):
+            self.assertAlmostEqual(fuser.preprocessing_args[color + '_bias']['input'], value)
+
+    def test_fold_channel_scale_into_conv(self):  # type: () -> None
+        std = np.asarray([0.5, 0.25, 2.], dtype=np.float32).reshape((1, 3, 1, 1))
+        W = _random_array((2, 3, 3, 3))
+        initializer = [numpy_helper.from_array(np.asarray(1., dtype=np.float32), name="mean"),
+                       numpy_helper.from_array(std, name="std"), numpy_helper.from_array(W, name="W")]
+        nodes = [helper.make_node("Sub", inputs=["input", "mean"], outputs=["centered"]),
+                 helper.make_node("Div", inputs=["centered", "std"], outputs=["normalized"]),
+                 helper.make_node("Conv", inputs=["normalized", "W"], outputs=["out"], kernel_shape=[3, 3])]
+        fuser = ImagePreprocessingFuser(['input'])
+        fused_graph = fuser(self._model(nodes, initializer))
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Conv'])
+        conv = fused_graph.nodes[0]
+        self.assertEqual(conv.inputs[0], 'input')
+        npt.assert_allclose(conv.input_tensors[conv.inputs[1]], W / std, rtol=1e-6)
+        self.assertEqual(fuser.preprocessing_args['image_scale']['input'], 1.0)
+        for color in ['red', 'green', 'blue']:
+            self.assertAlmostEqual(fuser.preprocessing_args[color + '_bias']['input'], -1.)
+
+        # without a conv to absorb the per-channel scale, the ops are kept
+        nodes[-1] = helper.make_node("MaxPool", inputs=["normalized"], outputs=["out"], kernel_shape=[3, 3])
+        fuser = ImagePreprocessingFuser(['input'])
+        fused_graph = fuser(self._model(nodes, initializer))
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Sub', 'Div', 'MaxPool'])
+        self.assertEqual(fuser.preprocessing_args, {})
+
+
+class DeprocessingFuserTest(unittest.TestCase):
+    def test_fold_into_conv_and_batchnorm(self):  # type: () -> None
+        inputs = [('input', (1, 2, 4, 4))]
+        outputs = [('conv_out', (1, 3, 4, 4), TensorProto.FLOAT), ('bn_out', (1, 3, 4, 4), TensorProto.FLOAT),
+                   ('relu_out', (1, 3, 4, 4), TensorProto.FLOAT)]
+        W, B = _random_array((3, 2, 1, 1)), _random_array((3,), random_seed=3)
+        gamma, beta = _random_array((3,), random_seed=4), _random_array((3,), random_seed=5)
+        mean, var = np.zeros((3,), dtype=np.float32), np.ones((3,), dtype=np.float32)
+        initializer = [numpy_helper.from_array(v, name=name)
+                       for v, name in [(W, "W"), (B, "B"), (gamma, "gamma"), (beta, "beta"), (mean, "mean"), (var, "var")]]
+        nodes = [helper.make_node("Conv", inputs=["input", "W", "B"], outputs=["conv_out"], kernel_shape=[1, 1]),
+                 helper.make_node("Conv", inputs=["input", "W"], outputs=["conv"], kernel_shape=[1, 1]),
+                 helper.make_node("BatchNormalization", inputs=["conv", "gamma", "beta", "mean", "var"], outputs=["bn_out"]),
+                 helper.make_node("Relu", inputs=["bn_out"], outputs=["relu_out"])]
+        model = _onnx_create_model(nodes, inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+        scale, bias = np.full((3,), 127.5), np.full((3,), 127.5)
+        fuser = DeprocessingFuser({'conv_out': (scale, bias), 'bn_out': (scale, bias), 'relu_out': (scale, bias)})
+        fused_graph = fuser(graph)
+        # the BatchNormalization output is also used by the Relu
+        self.assertEqual(fuser.fused_output_names, ['conv_out'])
+        conv = fused_graph.nodes[0]
+        npt.assert_allclose(conv.input_tensors[conv.inputs[1]], W * 127.5, rtol=1e-6)
+        npt.assert_allclose(conv.input_tensors[conv.inputs[2]], B * 127.5 + 127.5, rtol=1e-6)
+
+        nodes[-1] = helper.make_node("Relu", inputs=["input"], outputs=["relu_out"])
+        model = _onnx_create_model(nodes, inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+        fuser = DeprocessingFuser({'bn_out': (scale, bias), 'relu_out': (scale, bias)})
+        fused_graph = fuser(graph)
+        self.assertEqual(fuser.fused_output_names, ['bn_out'])
+        bn = fused_graph.nodes[2]
+        npt.assert_allclose(bn.input_tensors[bn.inputs[1]], gamma * 127.5, rtol=1e-6)
+        npt.assert_allclose(bn.input_tensors[bn.inputs[2]], beta * 127.5 + 127.5, rtol=1e-6)
+
+
+class ShapePropagationTest(unittest.TestCase):
+    def test_propagate_shapes(self):  # type: () -> None
+        inputs = [('input', (1, 3, 8, 8))]
+        outputs = [('out', (1, 16, 4), TensorProto.FLOAT)]
+        W = numpy_helper.from_array(_random_array((4, 3, 3, 3)), name="W")
+        shape = numpy_helper.from_array(np.array([0, 4, -1], dtype=np.int64), name="shape")
+        nodes = [helper.make_node("Conv", inputs=["input", "W"], outputs=["conv"],
+                                  kernel_shape=[3, 3], pads=[1, 1, 1, 1], strides=[2, 2]),
+                 helper.make_node("Flatten", inputs=["conv"], outputs=["flat"]),
+                 helper.make_node("Reshape", inputs=["flat", "shape"], outputs=["reshaped"]),
+                 helper.make_node("Transpose", inputs=["reshaped"], outputs=["out"], perm=[0, 2, 1])]
+        model = _onnx_create_model(nodes, inputs, outputs, [W, shape])
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+        self.assertNotIn('conv', graph.shape_dict)
+
+        graph = ShapePropagation()(graph)
+        self.assertEqual(graph.shape_dict['conv'], (1, 4, 4, 4))
+        self.assertEqual(graph.shape_dict['flat'], (1, 64))
+        self.assertEqual(graph.shape_dict['reshaped'], (1, 4, 16))
+        self.assertEqual(graph.shape_dict['out'], (1, 16, 4))
+
+    def test_unknown_dims(self):  # type: () -> None
+        inputs = [('input', ('N', 3, 8, 8))]  # type: Any
+        outputs = [('mean', (4,), TensorProto.FLOAT)]
+        W = numpy_helper.from_array(_random_array((4, 3, 1, 1)), name="W")
+        nodes = [helper.make_node("Conv", inputs=["input", "W"], outputs=["conv"], kernel_shape=[1, 1]),
+                 helper.make_node("ReduceMean", inputs=["conv"], outputs=["mean"], axes=[0, 2, 3], keepdims=0)]
+        model = _onnx_create_model(nodes, inputs, outputs, [W])
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+        del graph.shape_dict['mean']
+
+        graph = ShapePropagation()(graph)
+        # only fully known shapes are recorded
+        self.assertNotIn('conv', graph.shape_dict)
+        self.assertEqual(graph.shape_dict['mean'], (4,))
+
+    def test_symbolic_dims(self):  # type: () -> None
+        inputs = [('input', (1, 'seq', 768))]  # type: Any
+        outputs = [('out', (1, 12, 64), TensorProto.FLOAT)]
+        shape = numpy_helper.from_array(np.array([0, 0, 12, -1], dtype=np.int64), name="shape")
+        nodes = [helper.make_node("Reshape", inputs=["input", "shape"], outputs=["reshaped"]),
+                 helper.make_node("Transpose", inputs=["reshaped"], outputs=["transposed"], perm=[0, 2, 1, 3]),
+                 helper.make_node("ReduceMean", inputs=["transposed"], outputs=["out"], axes=[2], keepdims=0)]
+        model = _onnx_create_model(nodes, inputs, outputs, [shape])
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+        del graph.shape_dict['out']
+
+        symbolic_shapes = _symbolic_shapes(model.graph)
+        self.assertEqual(symbolic_shapes['input'], (1, 'seq', 768))
+        shapes = _propagate_shapes(graph, symbolic_shapes)
+        self.assertEqual([str(d) for d in shapes['transposed']], ['1', '12', 'seq', '64'])
+        # the sequence length is reduced away
+        graph = ShapePropagation(symbolic_shapes)(graph)
+        self.assertNotIn('transposed', graph.shape_dict)
+        self.assertEqual(graph.shape_dict['out'], (1, 12, 64))
+
+
+    def test_incremental_propagation(self):  # type: () -> None
+        inputs = [('input', (0, 0))]
+        outputs = [('out', (0, 0), TensorProto.FLOAT)]
+        nodes = [helper.make_node("Relu", inputs=["input"], outputs=["relu"]),
+                 helper.make_node("Exp", inputs=["relu"], outputs=["out"])]
+        model = _onnx_create_model(nodes, inputs, outputs)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+        class SetInputShape(object):
+            def __call__(self, graph):  # type: (Graph) -> Graph
+                graph.shape_dict['input'] = (2, 3)
+                return graph
+
+        shape_propagation = ShapePropagation()
+        pass_manager = PassManager([shape_propagation, SetInputShape()])
+        graph = pass_manager(graph)
+        # the shape set after the first run is propagated from the consumer of the input
+        self.assertEqual(graph.shape_dict['relu'], (2, 3))
+        self.assertEqual(graph.shape_dict['out'], (2, 3))
+        self.assertEqual(shape_propagation.shapes['out'], (2, 3))
+
+
+class ShapeSubgraphFolderTest(unittest.TestCase):
+    def _make_model(self, input_shape):  # type: (Any) -> Any
+        # the head split of a transformer as exported by PyTorch
+        inputs = [('input', input_shape)]
+        outputs = [('out', (1, 12, 8, 64), TensorProto.FLOAT)]
+        heads = numpy_helper.from_array(np.array([12], dtype=np.int64), name="heads")
+        head_size = numpy_helper.from_array(np.array([64], dtype=np.int64), name="head_size")
+        nodes = [helper.make_node("Shape", inputs=["input"], outputs=["shape"])]
+        for i in range(2):
+            nodes += [helper.make_node("Constant", inputs=[], outputs=["index_%d" % i],
+                                       value=numpy_helper.from_array(np.array(i, dtype=np.int64))),
+                      helper.make_node("Gather", inputs=["shape", "index_%d" % i], outputs=["dim_%d" % i], axis=0),
+                      helper.make_node("Unsqueeze", inputs=["dim_%d" % i], outputs=["unsqueezed_%d" % i], axes=[0])]
+        nodes += [helper.make_node("Concat", inputs=["unsqueezed_0", "unsqueezed_1", "heads", "head_size"],
+                                   outputs=["target"], axis=0),
+                  helper.make_node("Reshape", inputs=["input", "target"], outputs=["reshaped"]),
+                  helper.make_node("Transpose", inputs=["reshaped"], outputs=["out"], perm=[0, 2, 1, 3])]
+        return _onnx_create_model(nodes, inputs, outputs, [heads, head_size])
+
+    def _fold(self, model, symbolic_shapes=None):  # type: (Any, Any) -> Graph
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+        graph = graph.transformed([ConstantsToInitializers()])
+        return ShapeSubgraphFolder(symbolic_shapes)(graph)
+
+    def test_symbolic_dims(self):  # type: () -> None
+        model = self._make_model(('batch', 'seq', 768))
+        graph = self._fold(model, _symbolic_shapes(model.graph))
+        reshape = graph.index.nodes_of_op_type('Reshape')[0]
+        npt.assert_equal(reshape.input_tensors[reshape.inputs[1]], [0, 0, 12, 64])
+
+        graph = DeadCodeElimination()(graph)
+        self.assertEqual([node.op_type for node in graph.nodes], ['Reshape', 'Transpose'])
+
+    def test_merged_dims(self):  # type: () -> None
+        model = self._make_model(('batch', 'seq', 768))
+        mul = helper.make_node("Mul", inputs=["unsqueezed_0", "unsqueezed_1"], outputs=["merged"])
+        concat = [node for node in model.graph.node if node.op_type == 'Concat'][0]
+        concat.ClearField('input')
+        concat.input.extend(["merged", "heads", "head_size"])
+        model.graph.node.insert(list(model.graph.node).index(concat), mul)
+        graph = self._fold(model, _symbolic_shapes(model.graph))
+        reshape = graph.index.nodes_of_op_type('Reshape')[0]
+        # the flattened batch and sequence dimensions are the only unknown ones
+        npt.assert_equal(reshape.input_tensors[reshape.inputs[1]], [-1, 12, 64])
+
+    def test_static_dims(self):  # type: () -> None
+        model = self._make_model((1, 8, 768))
+        graph = self._fold(model)
+        self.assertEqual([node.op_type for node in graph.nodes], ['Reshape', 'Transpose'])
+        reshape = graph.nodes[0]
+        npt.assert_equal(reshape.input_tensors[reshape.inputs[1]], [1, 8, 12, 64])
+
+    def test_float_division_is_not_floored(self):  # type: () -> None
+        # ceil(size / 2) as exported by PyTorch, for an odd size
+        inputs = [('input', (1, 7, 4))]
+        outputs = [('out', (1, 4, 7), TensorProto.FLOAT)]
+        initializer = [numpy_helper.from_array(np.array(1, dtype=np.int64), name="index"),
+                       numpy_helper.from_array(np.array(2., dtype=np.float32), name="two"),
+                       numpy_helper.from_array(np.array([1], dtype=np.int64), name="one"),
+                       numpy_helper.from_array(np.array([-1], dtype=np.int64), name="minus_one")]
+        nodes = [helper.make_node("Shape", inputs=["input"], outputs=["shape"]),
+                 helper.make_node("Gather", inputs=["shape", "index"], outputs=["size"], axis=0),
+                 helper.make_node("Cast", inputs=["size"], outputs=["float_size"], to=TensorProto.FLOAT),
+                 helper.make_node("Div", inputs=["float_size", "two"], outputs=["half"]),
+                 helper.make_node("Ceil", inputs=["half"], outputs=["ceil"]),
+                 helper.make_node("Cast", inputs=["ceil"], outputs=["int_ceil"], to=TensorProto.INT64),
+                 helper.make_node("Unsqueeze", inputs=["int_ceil"], outputs=["unsqueezed"], axes=[0]),
+                 helper.make_node("Concat", inputs=["one", "unsqueezed", "minus_one"], outputs=["target"], axis=0),
+                 helper.make_node("Reshape", inputs=["input", "target"], outputs=["out"])]
+        model = _onnx_create_model(nodes, inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+        graph = ShapeSubgraphFolder()(graph)
+        self.assertIn('Div', [node.op_type for node in graph.nodes])
+        graph = ConstantRemover()(graph)
+        self.assertEqual([node.op_type for node in graph.nodes], ['Reshape'])
+        reshape = graph.nodes[0]
+        npt.assert_equal(reshape.input_tensors[reshape.inputs[1]], [1, 4, -1])
+
+    def test_integer_division_truncates(self):  # type: () -> None
+        # -(-size / 2), which differs from -floor(-size / 2) for an odd size
+        inputs = [('input', (1, 7, 6))]
+        outputs = [('out', (1, 3, 14), TensorProto.FLOAT)]
+        initializer = [numpy_helper.from_array(np.array(1, dtype=np.int64), name="index"),
+                       numpy_helper.from_array(np.array(-1, dtype=np.int64), name="negative"),
+                       numpy_helper.from_array(np.array(2, dtype=np.int64), name="two"),
+                       numpy_helper.from_array(np.array([1], dtype=np.int64), name="one"),
+                       numpy_helper.from_array(np.array([-1], dtype=np.int64), name="minus_one")]
+        nodes = [helper.make_node("Shape", inputs=["input"], outputs=["shape"]),
+                 helper.make_node("Gather", inputs=["shape", "index"], outputs=["size"], axis=0),
+                 helper.make_node("Mul", inputs=["size", "negative"], outputs=["negated"]),
+                 helper.make_node("Div", inputs=["negated", "two"], outputs=["half"]),
+                 helper.make_node("Mul", inputs=["half", "negative"], outputs=["positive_half"]),
+                 helper.make_node("Unsqueeze", inputs=["positive_half"], outputs=["unsqueezed"], axes=[0]),
+                 helper.make_node("Concat", inputs=["one", "unsqueezed", "minus_one"], outputs=["target"], axis=0),
+                 helper.make_node("Reshape", inputs=["input", "target"], outputs=["out"])]
+        model = _onnx_create_model(nodes, inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=7)
+
+        graph = ShapeSubgraphFolder()(graph)
+        self.assertEqual([node.op_type for node in graph.nodes], ['Reshape'])
+        reshape = graph.nodes[0]
+        npt.assert_equal(reshape.input_tensors[reshape.inputs[1]], [1, 3, -1])
+
+
+class FuserGroupTest(unittest.TestCase):
+    def test_fusers_in_one_traversal(self):  # type: () -> None
+        inputs = [('input', (1, 3, 50, 50))]
+        outputs = [('out', (1, 5, 50, 50), TensorProto.FLOAT)]
+        weight = numpy_helper.from_array(_random_array((5, 3, 1, 1)), name="weight")
+        b = _random_array((5,))
+        bias = numpy_helper.from_array(b, name="bias")
+        conv = helper.make_node("Conv", inputs=["input", "weight"], outputs=["conv_output"],
+                                kernel_shape=(1, 1))
+        drop = helper.make_node("Dropout", inputs=["conv_output"], outputs=["drop_output"])
+        add = helper.make_node("Add", inputs=["drop_output", "bias"], outputs=["add_output"],
+                               broadcast=1, axis=1)
+        relu = helper.make_node("Relu", inputs=["add_output"], outputs=["out"])
+        model = _onnx_create_model([conv, drop, add, relu], inputs, outputs, [weight, bias])
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+
+        group = FuserGroup([DropoutRemover(), ConvAddFuser(), BNBroadcastedMulFuser()])
+        self.assertEqual(set(group.op_types), {'Dropout', 'Conv', 'ConvTranspose', 'Gemm', 'Add', 'BatchNormalization', 'Mul'})
+        # only nodes the patterns end with are looked at
+        self.assertEqual([node.op_type for node in group.matcher.candidates(graph)], ['Dropout', 'Add'])
+
+        fused_graph = group(graph)
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Conv', 'Relu'])
+        conv_node = fused_graph.nodes[0]
+        self.assertEqual(conv_node.outputs, ['add_output'])
+        npt.assert_equal(conv_node.input_tensors[conv_node.inputs[2]], b)
+
+    def test_pattern_predicates(self):  # type: () -> None
+        inputs = [('input', (1, 3, 50, 50))]
+        outputs = [('out', (1, 3, 50, 50), TensorProto.FLOAT)]
+        scale = numpy_helper.from_array(_random_array((3, 1, 1)), name="scale")
+        mul = helper.make_node("Mul", inputs=["input", "scale"], outputs=["mul_output"])
+        transpose = helper.make_node("Transpose", inputs=["mul_output"], outputs=["out"], perm=[0, 1, 3, 2])
+        model = _onnx_create_model([mul, transpose], inputs, outputs, [scale])
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+        mul_node, transpose_node = graph.nodes
+
+        self.assertTrue(Op('Mul', const_inputs={1: lambda t: t.shape == (3, 1, 1)}).matches(graph, mul_node))
+        self.assertFalse(Op('Mul', const_inputs=[0]).matches(graph, mul_node))
+        self.assertTrue(Op(('Transpose', 'Reshape'), attrs={'perm': [0, 1, 3, 2]}).matches(graph, transpose_node))
+        self.assertFalse(Op('Transpose', attrs={'perm': lambda perm: perm[1] == 2}).matches(graph, transpose_node))
+
+        matcher = PatternMatcher([Chain(Op('Mul'), Op('Transpose')), Chain(Op(), Op('Transpose'))])
+        self.assertEqual(list(matcher.matches(graph, transpose_node)),
+                         [(0, [mul_node, transpose_node]), (1, [mul_node, transpose_node])])
+        self.assertEqual(list(matcher.matches(graph, mul_node)), [])
+
+class _SwishFuser(NodesFuser):
+    pattern = DAG([
+        ('sigmoid', Op('Sigmoid', inputs=[Var('x')])),
+        ('mul', Op('Mul', inputs=[Var('x'), 'sigmoid'], commutative=True)),
+    ])
+
+    def merge(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> Sequence[Node]
+        return [Node(nodes[1].name, 'Swish', {}, [nodes.inputs['x']], nodes[1].outputs)]
+
+
+class _ResidualFuser(NodesFuser):
+    pattern = DAG([
+        ('relu', Op('Relu', inputs=[Var('x')])),
+        ('add', Op('Add', inputs=['relu', Var('skip')], commutative=True)),
+    ])
+
+    def merge(self, graph, nodes):  # type: (Graph, Sequence[Node]) -> Sequence[Node]
+        return [Node(nodes[1].name, 'ReluAdd', {},
+                     [nodes.inputs['x'], nodes.inputs['skip']], nodes[1].outputs)]
+
+
+class DAGFuserTest(unittest.TestCase):
+    def test_fuse_diamond(self):  # type: () -> None
+        inputs = [('input', (1, 3, 5, 5))]
+        outputs = [('out', (1, 3, 5, 5), TensorProto.FLOAT)]
+        relu = helper.make_node("Relu", inputs=["input"], outputs=["x"])
+        sigmoid = helper.make_node("Sigmoid", inputs=["x"], outputs=["sig"])
+        mul = helper.make_node("Mul", inputs=["sig", "x"], outputs=["out"])
+        model = _onnx_create_model([relu, sigmoid, mul], inputs, outputs)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+        fused_graph = graph.transformed([_SwishFuser()])
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Relu', 'Swish'])
+        self.assertEqual(fused_graph.nodes[1].inputs, ['x'])
+        self.assertEqual(list(fused_graph.nodes[0].children), [fused_graph.nodes[1]])
+
+    def test_interior_value_escapes(self):  # type: () -> None
+        inputs = [('input', (1, 3, 5, 5))]
+        outputs = [('out', (1, 3, 5, 5), TensorProto.FLOAT), ('out2', (1, 3, 5, 5), TensorProto.FLOAT)]
+        sigmoid = helper.make_node("Sigmoid", inputs=["input"], outputs=["sig"])
+        mul = helper.make_node("Mul", inputs=["input", "sig"], outputs=["out"])
+        exp = helper.make_node("Exp", inputs=["sig"], outputs=["out2"])
+        model = _onnx_create_model([sigmoid, mul, exp], inputs, outputs)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+        fused_graph = graph.transformed([_SwishFuser()])
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Sigmoid', 'Mul', 'Exp'])
+
+    def test_fused_node_stays_topologically_sorted(self):  # type: () -> None
+        inputs = [('input', (1, 3, 5, 5))]
+        outputs = [('out', (1, 3, 5, 5), TensorProto.FLOAT)]
+        relu = helper.make_node("Relu", inputs=["input"], outputs=["r"])
+        exp = helper.make_node("Exp", inputs=["input"], outputs=["skip"])
+        add = helper.make_node("Add", inputs=["skip", "r"], outputs=["out"])
+        model = _onnx_create_model([relu, exp, add], inputs, outputs)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+        fused_graph = graph.transformed([_ResidualFuser()])
+        self.assertEqual([node.op_type for node in fused_graph.nodes], ['Exp', 'ReluAdd'])
+        self.assertEqual(fused_graph.nodes[1].inputs, ['input', 'skip'])
+
+class ConstantRemoverTest(unittest.TestCase):
+    def test_fold_constant_subgraph_in_one_sweep(self):  # type: () -> None
+        inputs = [('input', (2, 3))]
+        outputs = [('out', (2, 3), TensorProto.FLOAT)]
+        a = _random_array((3, 2))
+        b = _random_array((1, 3))
+        shape = np.asarray([2, 3], dtype=np.int64)
+        initializer = [numpy_helper.from_array(a, name="a"), numpy_helper.from_array(b, name="b"),
+                       numpy_helper.from_array(shape, name="shape")]
+        transpose = helper.make_node("Transpose", inputs=["a"], outputs=["a_t"], perm=[1, 0])
+        sub = helper.make_node("Sub", inputs=["a_t", "b"], outputs=["a_b"])
+        exp = helper.make_node("Exp", inputs=["a_b"], outputs=["a_exp"])
+        reduce = helper.make_node("ReduceSum", inputs=["a_exp"], outputs=["a_sum"], axes=[-1], keepdims=1)
+        expand = helper.make_node("Expand", inputs=["a_sum", "shape"], outputs=["a_expanded"])
+        add = helper.make_node("Add", inputs=["input", "a_expanded"], outputs=["out"])
+        model = _onnx_create_model([transpose, sub, exp, reduce, expand, add], inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+
+        folded_graph = ConstantRemover()(graph)
+        self.assertEqual([node.op_type for node in folded_graph.nodes], ['Add'])
+        add_node = folded_graph.nodes[0]
+        self.assertEqual(len(add_node.parents), 0)
+        expected = np.sum(np.exp(a.T - b), axis=-1, keepdims=True) * np.ones((2, 3))
+        npt.assert_almost_equal(add_node.input_tensors["a_expanded"], expected)
+        self.assertEqual(folded_graph.shape_dict["a_expanded"], (2, 3))
+
+    def test_fold_indexing_and_layout_ops(self):  # type: () -> None
+        inputs = [('input', (1, 2))]
+        outputs = [('out', (1, 2), TensorProto.FLOAT)]
+        x = np.asarray([[[[3., 1.]], [[2., 5.]], [[4., 0.]], [[1., 6.]]]], dtype=np.float32)
+        initializer = [numpy_helper.from_array(x, name="x")]
+        depth_to_space = helper.make_node("DepthToSpace", inputs=["x"], outputs=["d"], blocksize=2)
+        pad = helper.make_node("Pad", inputs=["d"], outputs=["p"], pads=[0, 0, 1, 0, 0, 0, 0, 0], value=-1.)
+        flatten = helper.make_node("Flatten", inputs=["p"], outputs=["f"], axis=0)
+        topk = helper.make_node("TopK", inputs=["f"], outputs=["values", "indices"], k=2, axis=1)
+        add = helper.make_node("Add", inputs=["input", "values"], outputs=["out"])
+        model = _onnx_create_model([depth_to_space, pad, flatten, topk, add], inputs, outputs, initializer)
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+
+        folded_graph = ConstantRemover()(graph)
+        self.assertEqual([node.op_type for node in folded_graph.nodes], ['Add'])
+        expected = np.sort(np.concatenate([np.full(4, -1.), x.reshape(-1)]))[::-1][:2].reshape((1, 2))
+        npt.assert_equal(folded_graph.nodes[0].input_tensors["values"], expected)
+
+    def _expand_model(self, consumer):  # type: (Text) -> Graph
+        inputs = [('input', (8, 16))]
+        outputs = [('out', (8, 16), TensorProto.FLOAT)]
+        initializer = [numpy_helper.from_array(np.asarray([2.], dtype=np.float32), name="two"),
+                       numpy_helper.from_array(np.asarray([8, 16], dtype=np.int64), name="shape")]
+        expand = helper.make_node("Expand", inputs=["two", "shape"], outputs=["twos"])
+        if consumer == 'Mul':
+            node = helper.make_node("Mul", inputs=["input", "twos"], outputs=["out"])
+        else:
+            node = helper.make_node(consumer, inputs=["twos"], outputs=["out"])
+        model = _onnx_create_model([expand, node], inputs, outputs, initializer)
+        return Graph.from_onnx(model.graph, onnx_ir_version=5)
+
+    def test_large_constant_is_broadcast(self):  # type: () -> None
+        graph = self._expand_model('Mul')
+        folded_graph = ConstantRemover(max_folded_bytes=64)(graph)
+        self.assertEqual([node.op_type for node in folded_graph.nodes], ['Mul'])
+        npt.assert_equal(folded_graph.nodes[0].input_tensors["twos"], np.full((1, 1), 2., dtype=np.float32))
+
+    def test_large_constant_is_kept_as_layer(self):  # type: () -> None
+        graph = self._expand_model('Relu')
+        kept_graph = ConstantRemover(max_folded_bytes=64, runtime_op_types=['Expand', 'Relu'])(graph)
+        self.assertEqual([node.op_type for node in kept_graph.nodes], ['Expand', 'Relu'])
+
+        # folding is the only option when the op can't be converted
+        graph = self._expand_model('Relu')
+        folded_graph = ConstantRemover(max_folded_bytes=64, runtime_op_types=['Relu'])(graph)
+        self.assertEqual([node.op_type for node in folded_graph.nodes], ['Relu'])
+        self.assertEqual(folded_graph.nodes[0].input_tensors["twos"].shape, (8, 16))
+
+        graph = self._expand_model('Relu')
+        folded_graph = ConstantRemover(runtime_op_types=['Expand', 'Relu'])(graph)
+        self.assertEqual([node.op_type for node in folded_graph.nodes], ['Relu'])
+
+    def test_large_constant_fill_is_kept_as_layer(self):  # type: () -> None
+        inputs = [('input', (8, 16))]
+        outputs = [('out', (8, 16), TensorProto.FLOAT)]
+        initializer = [numpy_helper.from_array(np.asarray([8, 16], dtype=np.int64), name="shape")]
+        fill = helper.make_node("ConstantFill", inputs=["shape"], outputs=["twos"], input_as_shape=1, value=2.)
+        relu = helper.make_node("Relu", inputs=["twos"], outputs=["out"])
+        model = _onnx_create_model([fill, relu], inputs, outputs, initializer)
+
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+        kept_graph = ConstantFillToInitializers(max_folded_bytes=64, runtime_op_types=['ConstantFill', 'Relu'])(graph)
+        self.assertEqual([node.op_type for node in kept_graph.nodes], ['ConstantFill', 'Relu'])
+
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+        folded_graph = ConstantFillToInitializers(max_folded_bytes=64, runtime_op_types=['Relu'])(graph)
+        self.assertEqual([node.op_type for node in folded_graph.nodes], ['Relu'])
+        self.assertEqual(folded_graph.nodes[0].input_tensors["twos"].shape, (8, 16))
+
+    def test_unsupported_and_output_nodes_are_kept(self):  # type: () -> None
+        inputs = [('input', (2, 3))]
+        outputs = [('out', (2, 3), TensorProto.FLOAT), ('a_neg', (2, 3), TensorProto.FLOAT)]
+        a = _random_array((2, 3))
+        neg = helper.make_node("Neg", inputs=["a"], outputs=["a_neg"])
+        softmax = helper.make_node("Softmax", inputs=["a_neg"], outputs=["a_softmax"])
+        add = helper.make_node("Add", inputs=["input", "a_softmax"], outputs=["out"])
+        model = _onnx_create_model([neg, softmax, add], inputs, outputs,
+                                   [numpy_helper.from_array(a, name="a")])
+        graph = Graph.from_onnx(model.graph, onnx_ir_version=5)
+        folded_graph = ConstantRemover()(graph)
+        self.assertEqual([node.op_type for node in folded_graph.nodes], ['Neg', 'Softmax', 'Add'])
+
 class NodeRemoverTests(unittest.TestCase):
 
     def test_dropout_remover(self): # type: () -> None